@@ -24,10 +24,10 @@ class diagnostics(SFRdata):
 
     def __init__(self, sfrobject=None, Mat1=None, Mat2=None, sfr=None, node_column=None,
                      mfpath=None, mfnam=None, mfdis=None,
-                     xll=0, yll=0, outpath=os.getcwd()):
+                     xll=0, yll=0, outpath=os.getcwd(), dis_cache=False):
 
         SFRdata.__init__(self, sfrobject=sfrobject, Mat1=Mat1, Mat2=Mat2, sfr=sfr, node_column=node_column,
-                         mfpath=mfpath, mfnam=mfnam, mfdis=mfdis, xll=xll, yll=yll)
+                         mfpath=mfpath, mfnam=mfnam, mfdis=mfdis, xll=xll, yll=yll, dis_cache=dis_cache)
 
     def check_numbering(self):
         """checks for continuity in segment and reach numbering
@@ -41,13 +41,15 @@ class diagnostics(SFRdata):
             return
         segments, reaches = self.m1.segment.values, self.m1.reach.values
 
-        for seg in uniquesegs:
-            r = reaches[segments == seg]
-            if len(r) > 1:
-                if np.max(np.diff(r)) != 1 or np.min(np.diff(r)) != 1:
-                    print('Invalid reach numbering at segment {:.0f}!'.format(seg))
-                    print(self.m1.reach[self.m1.segment == seg])
-                    break
+        # reach numbers must increase by one between consecutive reaches in the same segment
+        same_segment = segments[1:] == segments[:-1]
+        invalid = same_segment & (np.diff(reaches) != 1)
+        if np.any(invalid):
+            topology = self.topology
+            i = np.searchsorted(uniquesegs, segments[1:][invalid][0])
+            print('Invalid reach numbering at segment {:.0f}!'.format(uniquesegs[i]))
+            print(self.m1.reach.iloc[topology.reach_start[i]:topology.reach_stop[i]])
+            return
         print('passed.')
 
     def check_routing(self, max_levels=1000):
@@ -72,21 +74,14 @@ class diagnostics(SFRdata):
             m1['SFRlength'] = m1.length
 
         # Calculate SFR conductance for each reach
-        def cond(X):
-            c = X['sbK'] * X['width'] * X['SFRlength'] / X['sbthick']
-            return c
-
-        m1['Cond'] = m1.apply(cond, axis=1)
+        m1['Cond'] = m1.sbK * m1.width * m1.SFRlength / m1.sbthick
 
-        nodes_with_multiple_conductance = []
-        for c in self.shared_cells:
-
-            # select the collocated reaches for this cell
-            df = m1[m1nodes == c].sort('Cond', ascending=False)
-            cnd = df.Cond.values
-
-            if cnd[1] / cnd[0] > tol:
-                nodes_with_multiple_conductance.append(c)
+        # compare the two largest conductances in each cell with multiple reaches
+        node_reaches = self.node_reaches
+        cnd = m1.Cond.values[node_reaches.sorted_reaches(m1.Cond.values, ascending=False)]
+        shared = node_reaches.counts > 1
+        first = node_reaches.indptr[:-1][shared]
+        nodes_with_multiple_conductance = node_reaches.unique_nodes[shared][cnd[first + 1] / cnd[first] > tol]
 
         if len(nodes_with_multiple_conductance) > 0:
             print('{} model cells with multiple non-zero SFR conductances found. ' \
@@ -95,9 +90,9 @@ class diagnostics(SFRdata):
                   '\nRun consolidate_conductance() to establish a dominant reach in each SFR cell ' \
                   '(sets remaining reaches to zero-conductance).'.format(len(nodes_with_multiple_conductance)))
 
-            df = m1.ix[np.in1d(m1nodes, nodes_with_multiple_conductance),
-                       ['node', 'segment', 'reach', 'length', 'SFRlength', 'width', 'sbK', 'Cond']]
-            df.sort('node', inplace=True)
+            df = m1.loc[np.isin(m1nodes, nodes_with_multiple_conductance),
+                        ['node', 'segment', 'reach', 'length', 'SFRlength', 'width', 'sbK', 'Cond']]
+            df = df.sort_values(by='node', kind='mergesort')
             df.to_csv('collocated_reaches.csv', index=False)
         else:
             print('passed.')
@@ -121,13 +116,11 @@ class diagnostics(SFRdata):
             print('passed.')
 
         print('\nChecking Mat1 for segments with reach 1 higher than last reach ...')
+        topology = self.topology
         sbtop = self.m1.sbtop.values
-        m1segments = self.m1.segment.values
-        m1reaches = self.m1.reach.values
         m2segments = self.m2.segment.values
-        r1elev = np.array([sbtop[(m1segments == s) & (m1reaches == 1)][0] for s in m2segments])
-        lr = [np.max(m1reaches[(m1segments == s)]) for s in m2segments]
-        lrelev = np.array([sbtop[(m1segments == s) & (m1reaches == lr[i])][0] for i, s in enumerate(m2segments)])
+        r1elev = sbtop[topology.reach_start]
+        lrelev = sbtop[topology.reach_stop - 1]
         diffs = m2segments[(lrelev - r1elev) > 0]
         if len(diffs) > 0:
             print('Found {} segments with lower reach 1, see Mat1_backwards_segments.csv'.format(len(diffs)))
@@ -264,27 +257,19 @@ class diagnostics(SFRdata):
                               np.min(self.dis.delc)])
             except:
                 tol = 0
-        # get number of reaches for each segment
-        max_reach_numbers = [np.max(m1.reach[m1.segment == s]) for s in m2.segment]
-
-        # get cell centroids for last reach in each segment
-        end_centroids = [m1.geometry[(m1.segment == s) &
-                                         (m1.reach == max_reach_numbers[i])].values[0].centroid
-                         for i, s in enumerate(m2.segment.tolist())]
+        topology = self.topology
+        geoms = m1.geometry.values
 
-        # get cell centroids for first reach in each segment
-        start_centroids = [m1.geometry[(m1.segment == s) &
-                                           (m1.reach == 1)].values[0].centroid
-                           for s in m2.segment]
+        # get cell geometries for the first and last reaches in each segment
+        start_geoms = geoms[topology.reach_start]
+        end_geoms = geoms[topology.reach_stop - 1]
 
         # compute distances between end reach cell centroid, and cell centroid of outseg reach 1
-        distances = [end_centroids[i].distance(start_centroids[os-1]) if 0 < os < 999999 else 0
-             for i, os in enumerate(m2.outseg.astype(int))]
+        distances = [end_geoms[i].centroid.distance(start_geoms[os].centroid) if os >= 0 else 0
+                     for i, os in enumerate(topology.parent)]
 
         m2['routing_distance'] = distances
-        m2['end_reach_geom'] = [m1.geometry[(m1.segment == s) &
-                                            (m1.reach == max_reach_numbers[i])].values[0]
-                                for i, s in enumerate(m2.segment.tolist())]
+        m2['end_reach_geom'] = end_geoms
 
         routing = m2.ix[m2.routing_distance > tol, ['segment', 'outseg', 'routing_distance', 'end_reach_geom']]\
             .sort('routing_distance', ascending=False)
@@ -0,0 +1,344 @@
+__author__ = 'aleaf'
+import os
+import json
+import hashlib
+import numpy as np
+
+try:
+    from rtree import index
+except:
+    print('Warning: rtree not imported.')
+
+
+class GridIndex(object):
+
+    def __init__(self, grid, node_col=None, basename=None, rebuild=False):
+        """Persistent (file-backed) R-tree index of model grid cells.
+
+        The index is built once, written next to the grid shapefile
+        (<grid shapefile name>_rtree.idx and .dat), and reused in subsequent
+        preproc, postproc and diagnostics sessions. A small metadata file
+        (<grid shapefile name>_rtree.json) records the modification times, sizes and
+        md5 hash of the grid shapefile geometries (.shp) and attributes (.dbf, containing the node numbers);
+        the index is rebuilt if either changes.
+
+        Parameters
+        ----------
+        grid : str or flopy SpatialReference
+            Shapefile of the MODFLOW grid, or flopy SpatialReference instance
+            describing a structured grid.
+        node_col : str, optional
+            Attribute field in grid shapefile with (one-based) model node numbers.
+            If None, cells are numbered in the order they appear in the shapefile.
+        basename : str, optional
+            Path (without extension) for the index files. By default, the index is stored next to
+            the grid shapefile, or for a SpatialReference, in the current folder with a name
+            unique to the grid (grid_rtree_<hash>).
+        rebuild : bool
+            Rebuild the index even if an up-to-date index is found.
+
+        Notes
+        -----
+        Ids in the index are zero-based cell numbers (node - 1), consistent with the
+        position of each cell in a list of grid geometries sorted by node number.
+        """
+        self.grid = grid
+        self.node_col = node_col
+        self.is_shapefile = isinstance(grid, str)
+        if basename is None:
+            if self.is_shapefile:
+                basename = os.path.splitext(grid)[0] + '_rtree'
+            else:
+                basename = 'grid_rtree_{}'.format(self._file_info()['md5'][:10])
+        self.basename = basename
+        self.metadata_file = basename + '.json'
+
+        if rebuild or not self.is_valid():
+            self.build()
+        else:
+            print('using spatial index {}.idx'.format(self.basename))
+            self.idx = index.Index(self.basename)
+
+    def _grid_files(self):
+        """Grid shapefile geometry and attribute (node number) files."""
+        dbf = os.path.splitext(self.grid)[0] + '.dbf'
+        return [self.grid, dbf] if os.path.exists(dbf) else [self.grid]
+
+    def _stat(self):
+        """Modification times and sizes of the grid shapefile files."""
+        files = self._grid_files()
+        return [os.path.getmtime(f) for f in files], [os.path.getsize(f) for f in files]
+
+    def _file_info(self):
+        """Modification time, size, and a hash of the grid input."""
+        md5 = hashlib.md5()
+        if self.is_shapefile:
+            for f in self._grid_files():
+                with open(f, 'rb') as src:
+                    for chunk in iter(lambda: src.read(2**20), b''):
+                        md5.update(chunk)
+            mtime, size = self._stat()
+            return {'mtime': mtime,
+                    'size': size,
+                    'md5': md5.hexdigest(),
+                    'node_col': self.node_col}
+        sr = self.grid
+        # include the grid layout and units, so that grids with the same spacings don't share an index
+        md5.update(np.array([sr.nrow, sr.ncol], dtype=np.int64).tobytes())
+        md5.update(str((getattr(sr, 'units', None), getattr(sr, 'length_multiplier', None))).encode())
+        for v in [sr.delr, sr.delc, [sr.xul, sr.yul, sr.rotation]]:
+            md5.update(np.array(v, dtype=float).tobytes())
+        return {'mtime': None, 'size': None, 'md5': md5.hexdigest(), 'node_col': None}
+
+    def is_valid(self):
+        """Check that an index exists, and that it was built from the current grid."""
+        if not os.path.exists(self.metadata_file) or not os.path.exists(self.basename + '.idx'):
+            return False
+        with open(self.metadata_file) as src:
+            metadata = json.load(src)
+        if metadata.get('node_col') != self.node_col:
+            return False
+
+        # skip the hash if the shapefile hasn't been touched
+        if self.is_shapefile and [metadata['mtime'], metadata['size']] == list(self._stat()):
+            return True
+        info = self._file_info()
+        if info['md5'] != metadata['md5']:
+            return False
+        # shapefile was touched but not changed; update the modification time
+        self._write_metadata(info)
+        return True
+
+    def _write_metadata(self, info):
+        with open(self.metadata_file, 'w') as dest:
+            json.dump(info, dest)
+
+    def _cell_bounds(self):
+        """Generate (id, bounds, None) tuples for the grid cells (rtree stream loading)."""
+        if self.is_shapefile:
+            import fiona
+            from shapely.geometry import shape
+            with fiona.open(self.grid) as src:
+                for i, f in enumerate(src):
+                    id = i if self.node_col is None else int(f['properties'][self.node_col]) - 1
+                    yield (id, shape(f['geometry']).bounds, None)
+        else:
+            for i, vrts in enumerate(self.grid.vertices):
+                vrts = np.array(vrts)
+                yield (i, (vrts[:, 0].min(), vrts[:, 1].min(), vrts[:, 0].max(), vrts[:, 1].max()), None)
+
+    def build(self):
+        print('building spatial index {}.idx (only needs to be done once)...'.format(self.basename))
+        for ext in ['.idx', '.dat']:
+            if os.path.exists(self.basename + ext):
+                os.remove(self.basename + ext)
+        p = index.Property()
+        p.overwrite = True
+        self.idx = index.Index(self.basename, self._cell_bounds(), properties=p)
+        # flush the index to disk before recording it as valid
+        self.idx.close()
+        self.idx = index.Index(self.basename)
+        self._write_metadata(self._file_info())
+
+    def query(self, bounds):
+        """Zero-based cell numbers with bounding boxes intersecting bounds (minx, miny, maxx, maxy)."""
+        return list(self.idx.intersection(bounds))
+
+    def intersect(self, geoms, cell_geoms):
+        """Intersect geometries with the model cells.
+
+        Parameters
+        ----------
+        geoms : list of shapely geometries
+        cell_geoms : list or dict of Polygons
+            Cell geometries, indexed by zero-based cell number. If a dictionary is supplied,
+            only intersections with the cells in the dictionary are returned (e.g. for a subset
+            of cells containing SFR reaches).
+
+        Returns
+        -------
+        intersections : list of lists
+            Zero-based cell numbers intersecting each geometry in geoms.
+        """
+        if isinstance(cell_geoms, dict):
+            get = cell_geoms.get
+        else:
+            get = lambda i: cell_geoms[i]
+        intersections = []
+        for g in geoms:
+            hits = []
+            for i in self.idx.intersection(g.bounds):
+                cell = get(i)
+                if cell is not None and g.intersects(cell):
+                    hits.append(i)
+            intersections.append(sorted(hits))
+        return intersections
+
+
+def read_grid_attributes(shapefile, fields):
+    """Read attribute fields from a grid shapefile, skipping the geometries (if fiona supports it).
+
+    Returns
+    -------
+    attributes : pandas DataFrame
+        Attribute values, indexed by (zero-based) feature id.
+    """
+    import fiona
+    import pandas as pd
+    try:
+        src = fiona.open(shapefile, ignore_geometry=True)
+    except TypeError:
+        src = fiona.open(shapefile)
+    with src:
+        fids, values = [], []
+        for f in src:
+            fids.append(int(f['id']))
+            values.append([f['properties'][c] for c in fields])
+    return pd.DataFrame(values, index=fids, columns=fields)
+
+
+def index_grid_nodes(shapefile, node_col=None, row_col=None, column_col=None, ncol=None):
+    """Map (one-based) node numbers to feature ids in a grid shapefile, from the attribute table.
+
+    Parameters
+    ----------
+    shapefile : str
+        Shapefile of the MODFLOW grid.
+    node_col : str, optional
+        Attribute field with node numbers.
+    row_col, column_col : str, optional
+        Attribute fields with (one-based) row and column numbers, used to compute node numbers
+        if node_col is None.
+    ncol : int, optional
+        Number of columns in the grid; by default the largest value in column_col.
+
+    Returns
+    -------
+    node_fid : pandas Series
+        Zero-based feature ids, indexed by node number.
+    """
+    import pandas as pd
+    if node_col is not None:
+        df = read_grid_attributes(shapefile, [node_col])
+        nodes = df[node_col].values.astype(int)
+    else:
+        df = read_grid_attributes(shapefile, [row_col, column_col])
+        rows, columns = df[row_col].values.astype(int), df[column_col].values.astype(int)
+        if ncol is None:
+            ncol = columns.max()
+        nodes = ncol * (rows - 1) + columns
+    return pd.Series(df.index.values, index=nodes)
+
+
+def read_grid_cells(shapefile, nodes, node_col=None, row_col=None, column_col=None, ncol=None):
+    """Read the records for a subset of model cells (e.g. cells with SFR reaches) from a grid shapefile.
+
+    Features are fetched by feature id, assuming first that the shapefile is in node order
+    (feature id = node - 1), which is checked against the node (or row and column) attributes.
+    Otherwise the feature ids are looked up from the attribute table (see index_grid_nodes).
+    The full grid is never read into memory. If neither the node nor the row and column
+    fields are in the shapefile, the features are assumed to be in node order.
+
+    Parameters
+    ----------
+    shapefile : str
+        Shapefile of the MODFLOW grid.
+    nodes : sequence of ints
+        One-based node numbers of the cells to read.
+    node_col : str, optional
+        Attribute field with node numbers.
+    row_col, column_col : str, optional
+        Attribute fields with (one-based) row and column numbers, used to compute node numbers
+        if node_col is None.
+    ncol : int, optional
+        Number of columns in the grid (needed to compute node numbers from rows and columns);
+        by default the largest value in column_col.
+
+    Returns
+    -------
+    cells : pandas DataFrame
+        Geometries and attributes of the cells, indexed by node number.
+    """
+    import fiona
+    import pandas as pd
+    from shapely.geometry import shape
+    nodes = np.unique(np.asarray(nodes, dtype=int))
+
+    with fiona.open(shapefile) as src:
+        fields = src.schema['properties'].keys()
+        if node_col not in fields:
+            node_col = None
+        if row_col not in fields or column_col not in fields:
+            row_col, column_col = None, None
+        # without node or row/column information, the features are assumed to be in node order
+        in_node_order = node_col is None and row_col is None
+
+        def get_node(properties):
+            if node_col is not None:
+                return int(properties[node_col])
+            return ncol * (int(properties[row_col]) - 1) + int(properties[column_col])
+
+        nfeatures = len(src)
+        records = None
+        # try reading the features by id, assuming they are in node order
+        if len(nodes) > 0 and nodes.min() > 0 and nodes.max() <= nfeatures:
+            records = [src[int(n) - 1] for n in nodes]
+            if not in_node_order and (node_col is not None or ncol is not None):
+                if np.any(np.array([get_node(f['properties']) for f in records]) != nodes):
+                    records = None
+            elif not in_node_order:
+                records = None
+        elif in_node_order:
+            raise IndexError('Nodes outside of the range of features in {}'.format(shapefile))
+        if records is None:
+            node_fid = index_grid_nodes(shapefile, node_col=node_col, row_col=row_col, column_col=column_col,
+                                        ncol=ncol)
+            missing = nodes[~pd.Series(nodes).isin(node_fid.index).values]
+            if len(missing) > 0:
+                raise IndexError('Nodes {} not found in {}'.format(', '.join(map(str, missing[:10])), shapefile))
+            node_fid = node_fid[~node_fid.index.duplicated()]
+            records = [src[int(fid)] for fid in node_fid[nodes].values]
+
+    cells = pd.DataFrame([dict(f['properties']) for f in records], index=nodes)
+    cells['geometry'] = [shape(f['geometry']) for f in records]
+    return cells
+
+
+def cell_polygons(nodes, delr, delc, xul=0., yul=0., rotation=0.):
+    """Polygons for cells in a structured grid, computed from the grid spacing and origin.
+
+    Parameters
+    ----------
+    nodes : sequence of ints
+        One-based (layer 1) node numbers.
+    delr, delc : 1D arrays
+        Column widths and row heights.
+    xul, yul : float
+        Coordinates of the upper left corner of the grid.
+    rotation : float
+        Counter-clockwise rotation of the grid about the upper left corner, in degrees
+        (same convention as flopy SpatialReference).
+
+    Returns
+    -------
+    polygons : list of shapely Polygons
+    """
+    from shapely.geometry import Polygon
+    delr, delc = np.asarray(delr, dtype=float), np.asarray(delc, dtype=float)
+    ncol = len(delr)
+    i, j = np.divmod(np.asarray(nodes, dtype=int) - 1, ncol)
+    xedges = np.concatenate(([0.], np.cumsum(delr)))
+    yedges = -np.concatenate(([0.], np.cumsum(delc)))
+    x0, x1 = xedges[j], xedges[j + 1]
+    y0, y1 = yedges[i], yedges[i + 1]
+    x = np.array([x0, x1, x1, x0]).T
+    y = np.array([y0, y0, y1, y1]).T
+    theta = np.radians(rotation)
+    xr = xul + x * np.cos(theta) - y * np.sin(theta)
+    yr = yul + x * np.sin(theta) + y * np.cos(theta)
+    vertices = np.stack([xr, yr], axis=-1)
+    try:
+        import shapely
+        return list(shapely.polygons(vertices))
+    except (ImportError, AttributeError):
+        return [Polygon(v) for v in vertices]
@@ -4,15 +4,18 @@ import sys
 sys.path.append('/Users/aleaf/Documents/GitHub/flopy3')
 sys.path.append('D:/ATLData/Documents/GitHub/flopy')
 import os
+import json
+import heapq
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from shapely.geometry import Polygon, LineString, MultiLineString
-try:
-    from rasterstats import zonal_stats
-except:
-    print('Warning: rasterstats not imported.')
 import flopy
 import GISio, GISops
 
@@ -31,6 +34,407 @@ def header(infile):
             continue
     return knt
 
+
+def read_landsurface(landsurfacefile, dtype=None):
+    """Read an array of land surface elevations for all model cells (in node order).
+
+    Parameters
+    ----------
+    landsurfacefile : str
+        .npy file, raw binary file (with dtype specified), or text file of elevations.
+    dtype : str or numpy dtype, optional
+        Data type of a raw binary file (e.g. 'float32' or 'float64', in native byte order).
+        If None, landsurfacefile is read as text, unless it is a .npy file.
+
+    Returns
+    -------
+    landsurface : 1-D array
+        Binary files are memory-mapped, so that only the pages containing the
+        sampled cells are read from disk.
+    """
+    if landsurfacefile.lower().endswith('.npy'):
+        return np.load(landsurfacefile, mmap_mode='r').ravel()
+    elif dtype is not None:
+        return np.memmap(landsurfacefile, dtype=dtype, mode='r')
+    return np.fromfile(landsurfacefile, sep=' ')
+
+
+def write_external_array(filename, array, binary=False, fmt='%.2f', text='', ilay=1):
+    """Write a 2-D array to an external file for a MODFLOW OPEN/CLOSE array control record.
+
+    Parameters
+    ----------
+    filename : str
+    array : 2-D array
+    binary : bool
+        Write a MODFLOW binary array (single precision, with the standard header record
+        of KSTP, KPER, PERTIM, TOTIM, TEXT, NCOL, NROW, ILAY), instead of text.
+    fmt : str
+        Format for text arrays (see np.savetxt).
+    text : str
+        Text label in the binary header record (up to 16 characters).
+    ilay : int
+        Layer number in the binary header record.
+
+    Returns
+    -------
+    control_record : str
+        OPEN/CLOSE record for reading the array.
+    """
+    if not binary:
+        np.savetxt(filename, array, fmt=fmt)
+        return 'OPEN/CLOSE {} 1.0 (FREE) -1'.format(filename)
+    nrow, ncol = array.shape
+    header = np.array([(1, 1, 1., 1., text.rjust(16)[:16], ncol, nrow, ilay)],
+                      dtype=[('kstp', '<i4'), ('kper', '<i4'), ('pertim', '<f4'), ('totim', '<f4'),
+                             ('text', 'S16'), ('ncol', '<i4'), ('nrow', '<i4'), ('ilay', '<i4')])
+    with open(filename, 'wb') as dest:
+        header.tofile(dest)
+        np.asarray(array, dtype='<f4').tofile(dest)
+    return 'OPEN/CLOSE {} 1.0 (BINARY) -1'.format(filename)
+
+
+class Topology(object):
+
+    def __init__(self, segments, outsegs):
+        """Routing connections between SFR segments, from the segment and outseg columns of Mat2.
+
+        Everything beyond the parent (outseg) array is computed on first access, and kept
+        for as long as the routing doesn't change. SFRdata.topology shares one instance
+        between an SFRdata object and all of the objects created from it
+        (Elevations, Widths, Outsegs, Segments, diagnostics, etc.).
+
+        Parameters
+        ----------
+        segments : 1D array
+            Segment numbers (Mat2 segment column).
+        outsegs : 1D array
+            Downstream segment number for each segment (Mat2 outseg column);
+            0, 999999, or any number that is not in segments designates an outlet.
+
+        Notes
+        -----
+        Segments are referenced by their zero-based position in segments (the order of Mat2).
+        """
+        self.segments = np.array(segments, dtype=int)
+        self.outsegs = np.array(outsegs, dtype=int)
+        self.nseg = len(self.segments)
+
+        # position of the outseg for each segment; -1 for outlets
+        self.parent = -np.ones(self.nseg, dtype=int)
+        if self.nseg > 0:
+            sorter = np.argsort(self.segments, kind='mergesort')
+            pos = np.searchsorted(self.segments, self.outsegs, sorter=sorter)
+            pos = sorter[np.minimum(pos, self.nseg - 1)]
+            routed = self.segments[pos] == self.outsegs
+            self.parent[routed] = pos[routed]
+
+        self._children = None
+        self._levels = None
+        self._outlets = None
+        self._reach_segments = None
+        self.reach_start = None
+        self.reach_stop = None
+
+    def matches(self, segments, outsegs):
+        """Check whether the topology was built from the given segment and outseg columns."""
+        return np.array_equal(self.segments, segments) and np.array_equal(self.outsegs, outsegs)
+
+    def set_reaches(self, reach_segments):
+        """Index the reaches in Mat1 by segment. Mat1 must be sorted by segment and reach;
+        the reaches in segment i are then reach_start[i]:reach_stop[i] (positions in Mat1).
+        Only recomputed if the segment column in Mat1 has changed."""
+        if self._reach_segments is not None and np.array_equal(self._reach_segments, reach_segments):
+            return
+        reach_segments = np.array(reach_segments, dtype=int)
+        if np.any(np.diff(reach_segments) < 0):
+            raise ValueError('Mat1 must be sorted by segment and reach.')
+        self._reach_segments = reach_segments
+        self.reach_start = np.searchsorted(reach_segments, self.segments, side='left')
+        self.reach_stop = np.searchsorted(reach_segments, self.segments, side='right')
+
+    @property
+    def nreaches(self):
+        """Number of reaches in each segment."""
+        return self.reach_stop - self.reach_start
+
+    @property
+    def children(self):
+        """Upstream segments of each segment, as (indptr, indices) in compressed sparse row form;
+        the upsegs of segment i are indices[indptr[i]:indptr[i+1]], in Mat2 order."""
+        if self._children is None:
+            routed = np.where(self.parent >= 0)[0]
+            indices = routed[np.argsort(self.parent[routed], kind='mergesort')]
+            counts = np.bincount(self.parent[routed], minlength=self.nseg)
+            indptr = np.concatenate(([0], np.cumsum(counts))).astype(int)
+            self._children = indptr, indices
+        return self._children
+
+    @property
+    def nupsegs(self):
+        """Number of segments routed to each segment (0 for headwaters)."""
+        return np.diff(self.children[0])
+
+    @property
+    def levels(self):
+        """Segments grouped into levels that can be processed together, starting at the headwaters;
+        every segment comes in a later level than all of its upsegs (topological sort).
+        Segments in circular routing are not included."""
+        if self._levels is None:
+            nupsegs = self.nupsegs.copy()
+            levels = []
+            current = np.where(nupsegs == 0)[0]
+            while len(current) > 0:
+                levels.append(current)
+                downstream = self.parent[current]
+                downstream = downstream[downstream >= 0]
+                nupsegs -= np.bincount(downstream, minlength=self.nseg)
+                downstream = np.unique(downstream)
+                current = downstream[nupsegs[downstream] == 0]
+            self._levels = levels
+        return self._levels
+
+    @property
+    def order(self):
+        """Segment positions sorted from headwaters to outlets (see levels)."""
+        if len(self.levels) == 0:
+            return np.array([], dtype=int)
+        return np.concatenate(self.levels)
+
+    @property
+    def outlets(self):
+        """Outlet segment number for each segment; 0 for segments that are in, or route to, a routing circle."""
+        if self._outlets is None:
+            outlets = np.zeros(self.nseg, dtype=int)
+            for level in self.levels[::-1]:
+                downstream = self.parent[level]
+                outlets[level] = np.where(downstream < 0, self.segments[level],
+                                          outlets[np.maximum(downstream, 0)])
+            self._outlets = outlets
+        return self._outlets
+
+    @property
+    def circular(self):
+        """Boolean array indicating segments that are in, or route to, a routing circle."""
+        return self.outlets == 0
+
+    def accumulate(self, values, ufunc=np.add):
+        """Reduce values over each segment and all of the segments upstream of it,
+        e.g. total upstream length (np.add) or the lowest elevation upstream (np.minimum).
+
+        Parameters
+        ----------
+        values : 1D array of length nseg
+        ufunc : numpy ufunc
+
+        Returns
+        -------
+        accumulated : 1D array of length nseg
+        """
+        accumulated = np.array(values, dtype=float)
+        for level in self.levels:
+            downstream = self.parent[level]
+            routed = downstream >= 0
+            ufunc.at(accumulated, downstream[routed], accumulated[level[routed]])
+        return accumulated
+
+    def reduce_upsegs(self, values, ufunc=np.add, fill=0.):
+        """Reduce values over the segments immediately upstream of each segment;
+        segments without upsegs (headwaters) are assigned fill."""
+        indptr, indices = self.children
+        reduced = np.empty(self.nseg, dtype=float)
+        reduced[:] = fill
+        has_upsegs = np.diff(indptr) > 0
+        if np.any(has_upsegs):
+            reduced[has_upsegs] = ufunc.reduceat(np.asarray(values, dtype=float)[indices],
+                                                 indptr[:-1][has_upsegs])
+        return reduced
+
+    def reduce_reaches(self, values, ufunc=np.add):
+        """Reduce reach values (in Mat1 order) by segment; segments without reaches are assigned nan."""
+        reduced = np.empty(self.nseg, dtype=float)
+        reduced[:] = np.nan
+        has_reaches = self.reach_stop > self.reach_start
+        if np.any(has_reaches):
+            reduced[has_reaches] = ufunc.reduceat(np.asarray(values, dtype=float),
+                                                  self.reach_start[has_reaches])
+        return reduced
+
+
+    def reach_connections(self):
+        """Upstream and downstream reach positions (in Mat1) for every routing connection between reaches:
+        each reach to the next reach in the segment, and the last reach of each segment to reach 1 of its outseg."""
+        has_reaches = self.reach_stop > self.reach_start
+        nreach = len(self._reach_segments)
+        upstream = np.arange(nreach)
+        last = np.zeros(nreach, dtype=bool)
+        last[self.reach_stop[has_reaches] - 1] = True
+        downstream = upstream + 1
+
+        # last reaches route to reach 1 of the outseg, if any
+        routed = has_reaches & (self.parent >= 0)
+        routed[routed] = has_reaches[self.parent[routed]]
+        last_routed = self.reach_stop[routed] - 1
+        downstream[last_routed] = self.reach_start[self.parent[routed]]
+        keep = ~last
+        keep[last_routed] = True
+        return upstream[keep], downstream[keep]
+
+
+class NodeValues(Mapping):
+
+    def __init__(self, array):
+        """Read-only mapping of one-based node (cell) numbers to the values in an array
+        of model cells (e.g. the model top), without making a dictionary entry for each cell.
+        Values are looked up in the array, so they reflect any changes made to it."""
+        self.array = np.ravel(array)
+
+    def __getitem__(self, node):
+        if not 0 < node <= len(self.array):
+            raise KeyError(node)
+        return self.array[node - 1]
+
+    def __iter__(self):
+        return iter(range(1, len(self.array) + 1))
+
+    def __len__(self):
+        return len(self.array)
+
+
+class CachedArray(object):
+
+    def __init__(self, array):
+        """Array attribute of DisArrays, with the .array interface of flopy Util2d/Util3d objects."""
+        self.array = array
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
+
+
+class DisArrays(object):
+
+    names = ['top', 'botm', 'laycbd', 'delr', 'delc']
+
+    def __init__(self, top, botm, laycbd, delr, delc):
+        """Model discretization arrays read from a binary cache of a MODFLOW DIS file.
+        Stands in for flopy.modflow.ModflowDis in postproc (nlay, nrow, ncol, top, botm,
+        laycbd, delr, delc and get_lrc).
+
+        The cache consists of one .npy file per array (<DIS file name>.<array>.npy),
+        which are opened as memory maps, and a .json file recording the path,
+        size and modification time of the DIS file the arrays were read from.
+        """
+        self.top = CachedArray(top)
+        self.botm = CachedArray(botm)
+        self.laycbd = CachedArray(laycbd)
+        self.delr = CachedArray(delr)
+        self.delc = CachedArray(delc)
+        self.nrow, self.ncol = self.top.array.shape
+        self.nlay = len(self.laycbd.array)
+
+    @staticmethod
+    def _paths(mfdis, cache_dir):
+        basename = os.path.join(cache_dir, os.path.split(mfdis)[1])
+        return basename + '.json', {n: '{}.{}.npy'.format(basename, n) for n in DisArrays.names}
+
+    @staticmethod
+    def _key(mfdis):
+        return {'path': os.path.abspath(mfdis),
+                'size': os.path.getsize(mfdis),
+                'mtime': os.path.getmtime(mfdis)}
+
+    @classmethod
+    def load(cls, mfdis, cache_dir):
+        """Open the cached arrays for mfdis, or return None if there is no cache,
+        or if it was made from a different version of the DIS file."""
+        metadata_file, array_files = cls._paths(mfdis, cache_dir)
+        if not os.path.exists(metadata_file) or \
+                not all([os.path.exists(f) for f in array_files.values()]):
+            return None
+        with open(metadata_file) as src:
+            if json.load(src) != cls._key(mfdis):
+                return None
+        return cls(**{n: np.load(f, mmap_mode='r') for n, f in array_files.items()})
+
+    @classmethod
+    def save(cls, dis, mfdis, cache_dir):
+        """Write the arrays from a flopy DIS object to the cache for mfdis."""
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        metadata_file, array_files = cls._paths(mfdis, cache_dir)
+        for n, f in array_files.items():
+            np.save(f, np.array(getattr(dis, n).array))
+        # write the key last, so that an incomplete cache is never used
+        with open(metadata_file, 'w') as dest:
+            json.dump(cls._key(mfdis), dest)
+
+    def get_lrc(self, nodes):
+        """Get one-based (layer, row, column) tuples for one-based node numbers (as in flopy)."""
+        nodes = np.atleast_1d(nodes).astype(int) - 1
+        k, ij = np.divmod(nodes, self.nrow * self.ncol)
+        i, j = np.divmod(ij, self.ncol)
+        return list(zip(k + 1, i + 1, j + 1))
+
+
+class NodeReaches(object):
+
+    def __init__(self, nodes):
+        """Index of the reaches (rows) in each model cell, in compressed sparse row form.
+
+        The reaches in the cell at position k in unique_nodes are
+        order[indptr[k]:indptr[k+1]] (positions in the table the node numbers came from,
+        in table order).
+
+        Parameters
+        ----------
+        nodes : 1D array
+            Node number for each reach (e.g. Mat1 node column).
+        """
+        self.nodes = np.array(nodes, dtype=int)
+        self.order = np.argsort(self.nodes, kind='mergesort')
+        self.unique_nodes, starts = np.unique(self.nodes[self.order], return_index=True)
+        self.indptr = np.append(starts, len(self.nodes)).astype(int)
+        self.counts = np.diff(self.indptr)
+        self._slots = None
+
+    def matches(self, nodes):
+        """Check whether the index was built from the given node numbers."""
+        return np.array_equal(self.nodes, nodes)
+
+    @property
+    def shared_cells(self):
+        """Nodes with more than one reach."""
+        return self.unique_nodes[self.counts > 1]
+
+    def reaches(self, node):
+        """Positions of the reaches in a model cell (empty if the cell has no reaches)."""
+        if self._slots is None:
+            self._slots = dict(zip(self.unique_nodes, range(len(self.unique_nodes))))
+        k = self._slots.get(node)
+        if k is None:
+            return np.array([], dtype=int)
+        return self.order[self.indptr[k]:self.indptr[k+1]]
+
+    def reduce(self, values, ufunc=np.add):
+        """Reduce reach values by model cell (in the order of unique_nodes)."""
+        if len(self.nodes) == 0:
+            return np.array([], dtype=float)
+        return ufunc.reduceat(np.asarray(values)[self.order], self.indptr[:-1])
+
+    def broadcast(self, cell_values):
+        """Assign values by model cell (in the order of unique_nodes) to each reach."""
+        cell_values = np.asarray(cell_values)
+        values = np.empty(len(self.nodes), dtype=cell_values.dtype)
+        values[self.order] = np.repeat(cell_values, self.counts)
+        return values
+
+    def sorted_reaches(self, values, ascending=True):
+        """Positions of the reaches, grouped by model cell as in order, and sorted by values within each cell."""
+        values = np.asarray(values, dtype=float)[self.order]
+        slot = np.repeat(np.arange(len(self.unique_nodes)), self.counts)
+        return self.order[np.lexsort((values if ascending else -values, slot))]
+
+
 class SFRdata(object):
 
     # dictionary to convert different variations on column names to internally consistent names
@@ -68,7 +472,7 @@ class SFRdata(object):
                  dem=None, dem_units_mult=1, landsurfacefile=None, landsurface_column=None,
                  GIS_mult=1, to_meters_mult=0.3048,
                  Mat2_out=None, xll=0.0, yll=0.0, prj=None, proj4=None, epsg=None,
-                 minimum_slope=1e-4, maximum_slope=1, streamflow_file=None):
+                 minimum_slope=1e-4, maximum_slope=1, streamflow_file=None, dis_cache=False):
         """
         base object class for SFR information in the SFRmaker postproc module.
 
@@ -95,6 +499,11 @@ class SFRdata(object):
             Path to MODFLOW files
         mfnam : str
             MODFLOW nam file
+        dis_cache : bool or str
+            Option to keep a binary (.npy) copy of the DIS arrays, which is memory-mapped
+            in subsequent sessions instead of re-reading the DIS file. True stores the cache
+            next to the DIS file; a string specifies a folder for it. The cache is refreshed
+            if the path, size or modification time of the DIS file changes.
 
 
         GIS_mult: float
@@ -107,6 +516,7 @@ class SFRdata(object):
         self.elevs = None
         self.node_column = 'node'
         self.dis = None
+        self.dis_cache = dis_cache
         self.gridtype = gridtype
 
         if sfrobject is not None:
@@ -151,7 +561,6 @@ class SFRdata(object):
                 raise AssertionError("Please specify either Mat1 and Mat2 files or an SFR package file.")
 
             # Discretization
-            self.elevs_by_cellnum = {} # dictionary to store the model top elevation by cellnumber
             self.cell_geometries = {}
 
             self.mfnam = mfnam
@@ -171,7 +580,7 @@ class SFRdata(object):
                         self._compute_mat1_rc()
                 else:
                     pass
-                self.m1['model_top'] = [self.elevs_by_cellnum[c] for c in self.m1.node]
+                self.m1['model_top'] = np.take(self.elevs[0], self.m1.node.values - 1)
             else:
                 self.mfpath = ''
                 self.mfnam = None
@@ -187,6 +596,8 @@ class SFRdata(object):
             if proj4 is None and prj is not None:
                 self.proj4 = GISio.get_proj4(prj)
 
+            self.mfgridshp = mfgridshp
+            self.mfgridshp_node_field = mfgridshp_node_field
             if mfgridshp is not None:
                 self._read_geoms_from_mfgridshp(mfgridshp, node_field=mfgridshp_node_field,
                                                 row_field=mfgridshp_row_field,
@@ -223,18 +634,23 @@ class SFRdata(object):
             if 'reachID' not in self.m1.columns:
                 self.m1['reachID'] = self.m1.index.values
 
-            # assign upstream segments to Mat2
-            self.m2['upsegs'] = [self.m2.segment[self.m2.outseg == s].tolist() for s in self.segments]
-
-            # assign outsegs to Mat1
-            self.m1['outseg'] = [self.m2.outseg[s] for s in self.m1.segment]
+            # assign upstream segments to Mat2, and outsegs to Mat1
+            self._update_routing_columns()
 
             # check for circular routing
-            c = [s for s in self.m2.segment if s == self.m2.outseg[s]]
+            c = self.m2.segment.values[self.m2.segment.values == self.m2.outseg.values]
             if len(c) > 0:
                 raise ValueError('Warning! Circular routing in segments {}.\n'
                                  'Fix manually in Mat2 before continuing'.format(', '.join(map(str, c))))
 
+    def _update_routing_columns(self):
+        """Assign lists of upstream segments to Mat2, and outsegs to Mat1,
+        from the segment and outseg columns in Mat2 (Mat2 index is segment number)."""
+        upsegs = self.m2.groupby('outseg').segment.apply(list)
+        upsegs = self.m2.segment.map(upsegs)
+        self.m2['upsegs'] = [u if isinstance(u, list) else [] for u in upsegs]
+        self.m1['outseg'] = self.m1.segment.map(self.m2.outseg).values
+
     def _compute_mat1_node_numbers(self, ncols):
         self.m1['node'] = (ncols * (self.m1['row'] - 1) + self.m1['column']).astype('int')
 
@@ -271,21 +687,23 @@ class SFRdata(object):
             strhc1 (hydraulic conductivity) column in reach_data.
 
         """
-        reach_data = self.m1
-        segment_data = self.m2
-        segment_data.sort_values(by='segment')
-        reach_data.sort_values(by=['segment', 'reach'])
-        reach_values = []
-        for seg in segment_data.segment:
-            reaches = reach_data[reach_data.segment == seg]
-            dist = np.cumsum(reaches.length).values - 0.5 * reaches.length.values
-            icalc = segment_data.icalc[segment_data.segment == seg]
-
-            fp = [segment_data.Max[seg],
-                  segment_data.Min[seg]]
-            xp = [dist[0], dist[-1]]
-            reach_values += np.interp(dist, xp, fp).tolist()
-        return np.array(reach_values)
+        topology = self.topology
+        length = self.m1.length.values
+        dist = self.m1.groupby('segment', sort=False).length.cumsum().values - 0.5 * length
+
+        # linear interpolation between the first and last reaches in each segment
+        has_reaches = topology.nreaches > 0
+        nreaches = topology.nreaches[has_reaches]
+        first = topology.reach_start[has_reaches]
+        last = topology.reach_stop[has_reaches] - 1
+        x0 = np.repeat(dist[first], nreaches)
+        x1 = np.repeat(dist[last], nreaches)
+        fp0 = np.repeat(self.m2.Max.values[has_reaches], nreaches)
+        fp1 = np.repeat(self.m2.Min.values[has_reaches], nreaches)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reach_values = (fp1 - fp0) / (x1 - x0) * (dist - x0) + fp0
+        reach_values[last] = fp1[last]
+        return reach_values
 
     def parse_columns(self):
 
@@ -301,17 +719,48 @@ class SFRdata(object):
             if k in self.m1.columns:
                 self.m1[v] = self.m1[k] +1
 
-    @ property
+    @property
+    def topology(self):
+        """Routing connections between segments (see Topology); computed on first use,
+        shared with the objects created from this one, and only recomputed
+        if the segment or outseg columns in Mat2 change."""
+        topology = self.__dict__.get('_topology')
+        if topology is None or not topology.matches(self.m2.segment.values, self.m2.outseg.values):
+            topology = Topology(self.m2.segment.values, self.m2.outseg.values)
+            self._topology = topology
+        topology.set_reaches(self.m1.segment.values)
+        return topology
+
+    @property
+    def elevs_by_cellnum(self):
+        """Model top elevations by (one-based) cell number.
+        Read-only view of elevs[0], for compatibility; index elevs directly where possible."""
+        if self.elevs is None:
+            return {}
+        return NodeValues(self.elevs[0])
+
+    @property
+    def node_reaches(self):
+        """Index of the reaches in each model cell (see NodeReaches);
+        computed on first use, and only recomputed if the node column in Mat1 changes."""
+        node_reaches = self.__dict__.get('_node_reaches')
+        if node_reaches is None or not node_reaches.matches(self.m1.node.values):
+            node_reaches = NodeReaches(self.m1.node.values)
+            self._node_reaches = node_reaches
+        return node_reaches
+
+    @property
     def shared_cells(self):
-        return np.unique(self.m1.ix[self.m1.node.duplicated(), 'node'])
+        return self.node_reaches.shared_cells
 
     def read_sfr_package(self):
         """method to read in SFR file
         """
         pass
 
-    def read_dis2(self, mfdis=None, mfnam=None):
-        """read in model grid information using flopy
+    def read_dis2(self, mfdis=None, mfnam=None, cache=None):
+        """read in model grid information using flopy,
+        or from a binary cache of the DIS arrays (see dis_cache argument to SFRdata)
         """
         if mfdis is not None:
             self.mfdis = mfdis
@@ -319,19 +768,31 @@ class SFRdata(object):
                 self.mfpath = os.path.split(self.mfdis)[0]
         if mfnam is not None:
             self.mfnam = mfnam
+        if cache is None:
+            cache = self.dis_cache
 
-        print('reading {}...'.format(self.mfdis))
-        try:
-            self.m = flopy.modflow.Modflow(model_ws=self.mfpath)
-            self.dis = flopy.modflow.ModflowDis.load(self.mfdis, self.m)
-        except:
-            #  Modflow.load() may load dis successfully, even if ModflowDis.load() fails
-            self.m = flopy.modflow.Modflow.load(self.mfnam, model_ws=self.mfpath, load_only='dis')
-            self.dis = self.m.dis
+        cache_dir = None
+        if cache:
+            cache_dir = cache if isinstance(cache, str) else os.path.split(os.path.abspath(self.mfdis))[0]
+            self.dis = DisArrays.load(self.mfdis, cache_dir)
+
+        if cache_dir is not None and self.dis is not None:
+            print('reading cached arrays for {} from {}...'.format(self.mfdis, cache_dir))
+        else:
+            print('reading {}...'.format(self.mfdis))
+            try:
+                self.m = flopy.modflow.Modflow(model_ws=self.mfpath)
+                self.dis = flopy.modflow.ModflowDis.load(self.mfdis, self.m)
+            except:
+                #  Modflow.load() may load dis successfully, even if ModflowDis.load() fails
+                self.m = flopy.modflow.Modflow.load(self.mfnam, model_ws=self.mfpath, load_only='dis')
+                self.dis = self.m.dis
+            if cache_dir is not None:
+                print('caching DIS arrays in {}...'.format(cache_dir))
+                DisArrays.save(self.dis, self.mfdis, cache_dir)
 
         self.elevs = np.zeros((self.dis.nlay + 1, self.dis.nrow, self.dis.ncol))
         self.elevs[0, :, :] = self.dis.top.array
-        self.elevs[1:, :, :] = self.dis.botm.array
 
         # check if there Quasi-3D confining beds
         if np.sum(self.dis.laycbd.array) > 0:
@@ -346,29 +807,19 @@ class SFRdata(object):
         else:
             self.elevs[1:, :, :] = self.dis.botm.array
 
-        # make dictionary of model top elevations by cellnum
-        for c in range(self.dis.ncol):
-            for r in range(self.dis.nrow):
-                cellnum = r * self.dis.ncol + c + 1
-                self.elevs_by_cellnum[cellnum] = self.elevs[0, r, c]
-
     def _read_geoms_from_mfgridshp(self, mfgridshp, node_field=None, row_field=None, column_field=None, ncol=None):
+        """Assign cell geometries (and rows and columns, if needed) from the grid shapefile to Mat1.
+        Only the records for the cells with SFR reaches are read (see gridindex.read_grid_cells).
+        """
+        from gridindex import read_grid_cells, read_grid_attributes
 
-        df = GISio.shp2df(mfgridshp)
-        # set the index for the model grid;
-        # create the index from the rows and columns if they are provided
-        if node_field is None: # and row_field is not None and column_field is not None:
-            if row_field is not None and column_field is not None:
-                ncol = df[column_field].max()
-                df['node'] = (ncol * (df[row_field] - 1) + df[column_field]).astype('int')
-                node_field = 'node'
-            else:
-                raise IOError('No node field or row/column field given for grid shapefile.')
-        df.index = df[node_field] if node_field in df.columns else df.index
-        df.sort_index(level=0, inplace=True)
+        if node_field is None and (row_field is None or column_field is None):
+            raise IOError('No node field or row/column field given for grid shapefile.')
+        if ncol is None and self.dis is not None:
+            ncol = self.dis.ncol
         if 'node' not in self.m1.columns:
             if ncol is None and column_field:
-                ncol = df[column_field].max()
+                ncol = read_grid_attributes(mfgridshp, [column_field])[column_field].max()
             if ncol is not None:
                 self._compute_mat1_node_numbers(ncol)
             else:
@@ -376,22 +827,27 @@ class SFRdata(object):
                               'cannot compute node numbers without number of columns.' \
                               'Please provide ncol argument or row and column fields for grid shapefile.')
 
-        if self.gridtype == 'structured' and 'row' not in self.m1.columns or 'column' not in self.m1.columns:
+        cells = read_grid_cells(mfgridshp, self.m1.node.values, node_col=node_field,
+                                row_col=row_field, column_col=column_field, ncol=ncol)
+
+        if self.gridtype == 'structured' and ('row' not in self.m1.columns or 'column' not in self.m1.columns):
             if row_field is not None and column_field is not None:
-                self.m1['row'] = df.ix[self.m1.node.tolist(), row_field].tolist()
-                self.m1['column'] = df.ix[self.m1.node.tolist(), column_field].tolist()
+                self.m1['row'] = cells.loc[self.m1.node.values, row_field].values
+                self.m1['column'] = cells.loc[self.m1.node.values, column_field].values
             elif self.mfdis is not None:
                 self._compute_mat1_rc()
             else:
                 print('No row and column fields in Mat1, and no row and column fields given for {}'.format(mfgridshp))
                 print('SFR input for structured grid requires row and column info.')
-        self.m1['geometry'] = df.iloc[self.m1.node.astype(int) -1]['geometry'].tolist() # back to zero-based!
+        self.m1['geometry'] = cells.loc[self.m1.node.values, 'geometry'].values
 
     def get_cell_geometries(self, mfgridshp=None, node_field='node'):
 
         if mfgridshp is None:
-            cell_polys = np.array([Polygon(p) for p in self.sr.vertices])
-            self.m1['geometry'] = cell_polys[self.m1.node.values -1]
+            # compute polygons for the SFR cells only, from the grid spacing and origin
+            from gridindex import cell_polygons
+            self.m1['geometry'] = cell_polygons(self.m1.node.values, self.sr.delr, self.sr.delc,
+                                                xul=self.sr.xul, yul=self.sr.yul, rotation=self.sr.rotation)
         else:
             self._read_geoms_from_mfgridshp(mfgridshp=mfgridshp, node_field=node_field)
 
@@ -410,64 +866,88 @@ class SFRdata(object):
             centroids = [g.centroid for g in self.m1.geometry]
         self.m1['centroids'] = centroids
 
-    def map_outsegs(self, max_levels=1000):
-        '''
-        from Mat2, returns dataframe of all downstream segments (will not work with circular routing!)
-        '''
-        outsegsmap = pd.DataFrame(self.m2.outseg)
-        outsegs = self.m2.outseg
-        max_outseg = np.max(outsegsmap[outsegsmap.columns[-1]])
-        knt = 2
-        nsegs = len(self.m2)
-        while max_outseg > 0:
-            outsegsmap['outseg{}'.format(knt)] = [outsegs[s] if s > 0 and s < 999999 else 0
-                                                    for s in outsegsmap[outsegsmap.columns[-1]]]
-            max_outseg = np.max(outsegsmap[outsegsmap.columns[-1]].values)
-            if max_outseg == 0:
-                break
-            knt +=1
-            if knt > max_levels:
-                # subset outsegs map to all rows outseg number > 0 at iteration 1000
-                circular_segs = outsegsmap[outsegsmap[outsegsmap.columns[-1]] > 0]
-
-                # only retain one instance of each outseg number at iteration 1000
-                circular_segs.drop_duplicates(subset=outsegsmap.columns[-1], inplace=True)
-
-                # cull the dataframe again to remove duplicate instances of routing circles
-                circles = []
-                duplicates = []
-                for i in circular_segs.index:
-                    repeat_start_ind = np.where(circular_segs.ix[i, :] ==
-                                                circular_segs.ix[i, circular_segs.columns[-1:]]
-                                                .values[0])[0][-2:][0]
-                    circular_seq = circular_segs.ix[i, circular_segs.columns[repeat_start_ind:]].tolist()
-
-                    if set(circular_seq) not in circles:
-                        circles.append(set(circular_seq))
-                    else:
-                        duplicates.append(i)
-                circular_segs.drop(duplicates, axis=0, inplace=True)
+    def map_outsegs(self, max_levels=None, table=False):
+        """Assign the outlet segment for each segment and reach to Mat1 and Mat2 (Outlet columns),
+        using the routing topology (see Topology).
 
-                rf = 'Circular_routing_outsegs_table.csv'
-                circular_segs.to_csv(rf)
-                return '{0} instances where an outlet was not found after {1} consecutive segments! ' \
-                       '\nThese may indicate circular routing, or if there are many segments' \
-                       '\n(~10,000 or more), some segment sequences may be longer than {1}.' \
-                       '\nIn that case, try re-running map_outsegs() and diagnostics with max_levels set higher.'\
-                       '\nSee {1} for details.'\
-                        .format(len(circular_segs), max_levels, rf)
+        Parameters
+        ----------
+        max_levels : int
+            Not used; circular routing is detected directly from the routing connections,
+            regardless of the length of the segment sequences. Retained for compatibility.
+        table : bool
+            If True, also make the outsegs attribute, a dataframe listing the successive outsegs
+            from each segment (index) to its outlet (one column per level).
 
-        self.outsegs = outsegsmap
+        Returns
+        -------
+        If there is circular routing, a message describing it (and the circles are written
+        to Circular_routing_outsegs_table.csv); otherwise None.
+        """
+        topology = self.topology
+
+        if np.any(topology.circular):
+            # segments in circles are the ones that were left out of the topological sort
+            in_circle = np.ones(topology.nseg, dtype=bool)
+            in_circle[topology.order] = False
+            circles = []
+            for i in np.where(in_circle)[0]:
+                if not in_circle[i]:
+                    continue
+                circle = [i]
+                j = topology.parent[i]
+                while j != i:
+                    circle.append(j)
+                    j = topology.parent[j]
+                in_circle[circle] = False
+                circles.append(topology.segments[circle])
+            circular_segs = pd.DataFrame([c.tolist() for c in circles],
+                                         index=[c[0] for c in circles]).fillna(0).astype(int)
+            circular_segs.columns = ['outseg{}'.format(i) if i > 0 else 'segment' for i in circular_segs.columns]
+
+            rf = 'Circular_routing_outsegs_table.csv'
+            circular_segs.to_csv(rf)
+            return '{0} instances of circular routing found, involving {1} segments ' \
+                   '({2} segments in total route to the circles).' \
+                   '\nSee {3} for details.' \
+                   .format(len(circles), np.sum([len(c) for c in circles]), np.sum(topology.circular), rf)
+
+        if table:
+            # one column for each level of outsegs, until all sequences have reached an outlet
+            outsegsmap = pd.DataFrame(self.m2.outseg)
+            pos = topology.parent.copy()
+            outseg = topology.outsegs.copy()
+            knt = 2
+            while np.max(outseg) > 0:
+                routed = pos >= 0
+                next_outseg = np.zeros(topology.nseg, dtype=int)
+                next_outseg[routed] = topology.outsegs[pos[routed]]
+                pos[routed] = topology.parent[pos[routed]]
+                pos[~routed] = -1
+                outseg = next_outseg
+                outsegsmap['outseg{}'.format(knt)] = outseg
+                knt += 1
+            self.outsegs = outsegsmap
 
         # create new column in Mat2 listing outlets associated with each segment
-        self.m2['Outlet'] = [r[(r != 0) & (r != 999999)][-1] if len(r[(r != 0) & (r != 999999)]) > 0
-                             else i for i, r in self.outsegs.iterrows()]
+        self.m2['Outlet'] = topology.outlets
 
         # assign the outlets to each reach listed in Mat1
-        self.m1['Outlet'] = [self.m2.ix[seg, 'Outlet'] for seg in self.m1.segment]
+        self.m1['Outlet'] = np.repeat(topology.outlets, topology.nreaches)
 
     def map_confluences(self, dem=None, landsurfacefile=None, landsurface_column=None):
+        """Runs the Elevations.map_confluences() method.
 
+        Parameters
+        ----------
+        dem : Any raster data source supported by GDAL, optional
+            DEM from which to sample the landsurface column in Mat1 (minimum elevation in each SFR cell).
+            Existing streambed tops (sbtop) are kept; sbtop is only set from the DEM if it isn't populated.
+        landsurfacefile : str, optional
+            Land surface elevations by model node (see Elevations).
+        landsurface_column : str, optional
+            Column in Mat1 to use as the landsurface column.
+        """
         if landsurfacefile is None and self.landsurfacefile is not None:
             landsurfacefile = self.landsurfacefile
 
@@ -506,44 +986,27 @@ class SFRdata(object):
         """
         print('Assigning total SFR conductance to dominant reach in cells with multiple reaches...')
         # Calculate SFR conductance for each reach
-        def cond(X):
-            c = X['sbK'] * X['width'] * X['length'] / X['sbthick']
-            return c
-
-        self.m1['Cond'] = self.m1.apply(cond, axis=1)
-
-        #shared_cells = np.unique(self.m1.ix[self.m1.node.duplicated(), 'node'])
+        self.m1['Cond'] = self.m1.sbK * self.m1.width * self.m1.length / self.m1.sbthick
 
         # make a new column that designates whether a reach is dominant in each cell
-        # dominant reaches include those not collocated with other reaches, and the longest collocated reach
-        self.m1['Dominant'] = [True] * len(self.m1)
-
-        for c in self.shared_cells:
-
-            # select the collocated reaches for this cell
-            df = self.m1[self.m1.node == c].sort_values(by='width', ascending=False)
-
-            # set all of these reaches except the largest to not Dominant
-            self.m1.loc[df.index[1:], 'Dominant'] = False
+        # dominant reaches include those not collocated with other reaches, and the widest collocated reach
+        # (the first one in Mat1, in case of ties)
+        nodes = self.m1.node.values
+        widest = pd.Series(self.m1.width.values).groupby(nodes).idxmax().values
+        dominant = np.zeros(len(self.m1), dtype=bool)
+        dominant[widest] = True
+        self.m1['Dominant'] = dominant
 
         # Sum up the conductances for all of the collocated reaches
         # returns a series of conductance sums by model cell, put these into a new column in Mat1
-        Cond_sums = self.m1[['node', 'Cond']].groupby('node').agg('sum').Cond
-        self.m1['Cond_sum'] = [Cond_sums[c] for c in self.m1.node]
+        self.m1['Cond_sum'] = self.m1.groupby('node').Cond.transform('sum').values
 
         # Calculate a new length for widest reaches, set length in secondary collocated reaches to 1
         # also set the K values in the secondary cells to bedKmin
-        self.m1['length'] = self.m1.length
-
-        def consolidate_lengths(X):
-            if X['Dominant']:
-                lnew = X['Cond_sum'] * X['sbthick'] / (X['sbK'] * X['width'])
-            else:
-                lnew = 1.0
-            return lnew
-
-        self.m1['SFRlength'] = self.m1.apply(consolidate_lengths, axis=1)
-        self.m1['sbK'] = [r['sbK'] if r['Dominant'] else bedKmin for i, r in self.m1.iterrows()]
+        self.m1['SFRlength'] = np.where(dominant,
+                                        self.m1.Cond_sum * self.m1.sbthick / (self.m1.sbK * self.m1.width),
+                                        1.0)
+        self.m1['sbK'] = np.where(dominant, self.m1.sbK, bedKmin)
 
     def smooth_segment_ends(self, landsurfacefile=None, landsurface_column=None,
                             report_file='smooth_segment_ends.txt'):
@@ -556,7 +1019,7 @@ class SFRdata(object):
         self.m2 = self.Elevations.m2
 
     def smooth_interior_elevations(self, dem=None, landsurfacefile=None, landsurface_column=None,
-                                   report_file='smooth_segment_interiors.txt'):
+                                   report_file=None):
         """Allow elevations smoothing to be run on SFRdata instance (Composition)
         """
         if hasattr(self, 'Elevations'):
@@ -567,38 +1030,88 @@ class SFRdata(object):
             self.Elevations.smooth_segment_interiors(report_file=report_file)
         self.m1 = self.Elevations.m1
 
+    def optimize_elevations(self, **kwargs):
+        """Allow the streambed elevation optimization (Elevations.optimize_streambed) to be run on SFRdata instance
+        """
+        if not hasattr(self, 'Elevations'):
+            self.Elevations = Elevations(sfrobject=self)
+        self.Elevations.optimize_streambed(**kwargs)
+        self.m1 = self.Elevations.m1
+        self.m2 = self.Elevations.m2
+
+    def smooth_isotonic_elevations(self, target_column='landsurface', weight_column=None):
+        """Allow the isotonic elevation fit (Elevations.smooth_isotonic) to be run on SFRdata instance
+        """
+        if not hasattr(self, 'Elevations'):
+            self.Elevations = Elevations(sfrobject=self)
+        self.Elevations.smooth_isotonic(target_column=target_column, weight_column=weight_column)
+        self.m1 = self.Elevations.m1
+        self.m2 = self.Elevations.m2
+
     def calculate_slopes(self):
         '''
         assign a slope value for each stream cell based on streambed elevations
         this method is run at the end of smooth_segment_interiors, after the interior elevations have been assigned
         '''
         print('calculating slopes...')
-        self.m1['slope'] = np.zeros(len(self.m1))
-        for s in self.segments:
+        topology = self.topology
+        sbtop = self.m1.sbtop.values
+        last = topology.reach_stop - 1
+        nreaches = topology.nreaches
 
-            # calculate the right-hand elevation differences (not perfect, but easy)
-            diffs = self.m1[self.m1.segment == s].sbtop.diff()[1:].tolist()
+        # calculate the right-hand elevation differences (not perfect, but easy)
+        diffs = np.zeros(len(sbtop))
+        diffs[:-1] = np.diff(sbtop)
 
-            if len(diffs) > 0:
-                diffs.append(diffs[-1])  # use the left-hand difference for the last reach
+        # use the left-hand difference for the last reach
+        multiple = nreaches > 1
+        diffs[last[multiple]] = diffs[last[multiple] - 1]
 
-            # edge case where segment only has 1 reach
-            else:
-                diffs = self.m2.Min[s] - self.m2.Max[s]
+        # edge case where segment only has 1 reach
+        single = nreaches == 1
+        diffs[last[single]] = (self.m2.Min.values - self.m2.Max.values)[single]
 
-            # divide by length in cell; reverse sign so downstream = positive (as in SFR package)
-            slopes = diffs / self.m1[self.m1.segment == s].length * -1
-
-            # assign to Mat1
-            self.m1.loc[self.m1.segment == s, 'slope'] = slopes
+        # divide by length in cell; reverse sign so downstream = positive (as in SFR package)
+        self.m1['slope'] = diffs / self.m1.length.values * -1
 
         # enforce minimum slope
         self.m1.loc[self.m1['slope'] > self.maximum_slope, 'slope'] = self.maximum_slope
         self.m1.loc[self.m1['slope'] < self.minimum_slope, 'slope'] = self.minimum_slope
 
-    def reset_m1_streambed_top_from_dem(self, dem=None, dem_units_mult=None, stat='min'):
-        """Computes streambed top elevations via zonal statistics, using the
-        rasterstats package (https://github.com/perrygeo/python-raster-stats).
+    def sample_dem(self, dem=None, processes=1):
+        """Zonal statistics of the DEM within each model cell containing SFR reaches
+        (see rasterops.zonal_statistics). The pixels within each cell are indexed once for each
+        grid/DEM pair (see rasterops.CellPixelIndex), the DEM is read through a tile cache shared with
+        the other routines sampling it (see rasterops.open_raster), and cells with multiple reaches
+        are only sampled once.
+
+        Parameters
+        ----------
+        dem : Any raster data source supported by GDAL, optional
+            Surface from which to sample elevation values (by default, the dem attribute).
+        processes : int
+            Number of processes for computing the statistics (see rasterops.zonal_statistics)
+
+        Returns
+        -------
+        zstats: Dataframe with dem min, max, mean and count for each reach in Mat1 (in DEM units)
+        """
+        from rasterops import CellPixelIndex, zonal_statistics
+
+        if 'geometry' not in self.m1.columns:
+            self.get_cell_geometries()
+        if dem is None:
+            dem = self.dem
+        node_reaches = self.node_reaches
+        cell_geoms = self.m1.geometry.values[node_reaches.order[node_reaches.indptr[:-1]]]
+        index = CellPixelIndex(cell_geoms, dem, nodes=node_reaches.unique_nodes)
+        zstats = zonal_statistics(dem, index, processes=processes)
+        return pd.DataFrame({c: node_reaches.broadcast(zstats[c].values) for c in ['min', 'max', 'mean', 'count']},
+                            columns=['min', 'max', 'mean', 'count'])
+
+    def reset_m1_streambed_top_from_dem(self, dem=None, dem_units_mult=None, stat='min', processes=1):
+        """Computes streambed top elevations via zonal statistics of the DEM within each model cell
+        containing SFR reaches (see sample_dem).
 
         Parameters
         ----------
@@ -608,91 +1121,148 @@ class SFRdata(object):
             Multiplier for converting the raster z units to the model z units
         stat : string
             min (recommended), mean, or max
+        processes : int
+            Number of processes for computing the statistics (see rasterops.zonal_statistics)
 
         Returns
         -------
         zstats: Dataframe with dem min, max, mean and count for each model cell in Mat1
         """
-        if 'geometry' not in self.m1.columns:
-            self.get_cell_geometries()
         if dem is not None:
             self.dem = dem
         if dem_units_mult is not None:
             self.dem_units_mult = dem_units_mult
         print('computing zonal statistics...')
-        self.dem_zstats = pd.DataFrame(zonal_stats(self.m1.geometry, self.dem))
-        self.m1['sbtop'] = self.dem_zstats['min'].values * self.dem_units_mult
+        self.dem_zstats = self.sample_dem(processes=processes)
+        self.m1['sbtop'] = self.dem_zstats[stat].values * self.dem_units_mult
         DEM_col_name = 'DEM{}'.format(stat)
         self.m1[DEM_col_name] = self.m1['sbtop'].values
         print('DEM {} elevations assigned to sbtop column in m1'.format(stat))
 
+    def sample_dem_along_reaches(self, lines=None, dem=None, dem_units_mult=None, spacing=None,
+                                 percentiles=(), stat=None):
+        """Sample the DEM along the linework for each SFR reach (at the line vertices, or at a fixed spacing),
+        as an alternative to zonal statistics within the model cells (see rasterops.sample_lines).
+        In coarse model cells, this gives elevations that are more representative of the stream channel.
+
+        Parameters
+        ----------
+        lines : str or DataFrame, optional
+            Shapefile or DataFrame of reach linework, with segment, reach and geometry columns
+            (e.g. the output from segment_reach2linework_shapefile). By default, the linework_geoms attribute.
+        dem : Any raster data source supported by GDAL, optional
+            Surface from which to sample elevation values (by default, the dem attribute).
+        dem_units_mult : float
+            Multiplier for converting the raster z units to the model z units
+        spacing : float, optional
+            Distance between sample points along each reach, in the linework coordinate units.
+            By default, the linework vertices are sampled.
+        percentiles : sequence of floats, optional
+            Percentiles (0-100) of the sampled elevations to compute for each reach.
+        stat : str, optional
+            Statistic (e.g. 'min', 'mean' or 'pct10') to assign to the sbtop column in Mat1;
+            reaches without any valid samples keep their existing sbtop values.
+
+        Returns
+        -------
+        line_stats: Dataframe with elevation min, mean, max, count, any percentiles, and the along-channel
+        slope (assuming that the linework coordinates are in model length units) for each reach in Mat1
+        """
+        from rasterops import sample_lines
+
+        if dem is not None:
+            self.dem = dem
+        if dem_units_mult is not None:
+            self.dem_units_mult = dem_units_mult
+        if lines is None:
+            lines = self.linework_geoms
+        elif isinstance(lines, str):
+            lines = GISio.shp2df(lines)
+
+        # align the linework with the reaches in Mat1
+        lines = self.m1[['segment', 'reach']].merge(lines[['segment', 'reach', 'geometry']],
+                                                    on=['segment', 'reach'], how='left')
+        has_line = lines.geometry.notnull().values
+        stats = sample_lines(self.dem, lines.geometry.values[has_line], spacing=spacing,
+                             percentiles=percentiles)
+        line_stats = pd.DataFrame(np.nan, index=self.m1.index, columns=stats.columns)
+        line_stats.loc[has_line] = stats.values
+        line_stats['count'] = line_stats['count'].fillna(0).astype(int)
+        elevation_columns = [c for c in stats.columns if c not in ['count']]
+        line_stats[elevation_columns] *= self.dem_units_mult
+        self.dem_line_stats = line_stats
+
+        if stat is not None:
+            print('assigning DEM {} elevations along the reach linework to sbtop column in m1'.format(stat))
+            self.m1['sbtop'] = np.where(line_stats[stat].notnull(), line_stats[stat].values, self.m1['sbtop'].values)
+        return line_stats
+
     def reset_segment_ends_from_dem(self):
         """Often the NHDPlus elevations don't match DEM at scales below 100k.
-        Starting at outlets and iterating by segment level, adjust segment end elevations downward
-        if a lower elevation was sampled from the DEM in the current segment, or any upstream segments.
+        Adjust segment end elevations downward if a lower elevation was sampled from the DEM
+        in the current segment, or any upstream segments.
         Adjust downstream segment start elevation to keep it consistent with upseg end elevations."""
-        nseg = self.m2.segment.values
+        topology = self.topology
         outseg = self.m2.outseg.values
-        elevmin = self.m2.Min.values
-        elevmax = self.m2.Max.values
-        dem_min = np.array([self.m1.ix[self.m1.segment == s, 'DEMmin'].min() for s in nseg])
-        dem_reach1 = np.array([self.m1.ix[(self.m1.segment.values == s) &
-                                      (self.m1.reach.values ==1), 'DEMmin'].values[0] for s in nseg])
-        def get_nextupsegs(upsegs):
-            nextupsegs = []
-            for s in upsegs:
-                nextupsegs += nseg[outseg == s].tolist()
-            return nextupsegs
-
-        def get_upsegs(seg):
-            upsegs = nseg[outseg == seg].tolist()
-            all_upsegs = upsegs
-            for i in range(len(nseg)):
-                upsegs = get_nextupsegs(upsegs)
-                if len(upsegs) > 0:
-                    all_upsegs.extend(upsegs)
-                else:
-                    break
-            return all_upsegs
-
-        def get_upseg_levels(seg):
-            upsegs = nseg[outseg == seg].tolist()
-            all_upsegs = [upsegs]
-            for i in range(len(nseg)):
-                upsegs = get_nextupsegs(upsegs)
-                if len(upsegs) > 0:
-                    all_upsegs.append(upsegs)
-                else:
-                    break
-            return all_upsegs
-
-        def reset_elevations(seg):
-            # reset segment elevations above (upsegs) and below (outseg) a node
-            oseg = outseg[seg -1]
-            all_upsegs = np.array(get_upsegs(seg) + [seg]) # all segments upstream of node
-            oldmin = elevmin[(all_upsegs-1)].min() # minimum current elevation upstream of node
-            smin = dem_min[(all_upsegs-1)].min() # minimum sampled DEM elevation upstream of node
-            if oseg > 0:
-                outseg_max = elevmax[oseg - 1] # outseg reach 1 elevation (already updated)
-                smin = np.min([outseg_max, smin])
-            if smin < oldmin: # reset if the DEM is lower
-                elevmin[seg - 1] = smin
-            if oseg > 0: # if the node is not an outlet, reset the outseg max
-                elevmax[outseg[seg -1] -1] = np.min([smin, oldmin, outseg_max])
-            if len(all_upsegs) == 1:
-                elevmax[seg -1] = np.min([elevmax[seg-1], dem_reach1[seg-1]])
-
-        # get list of segments at each level, starting with 0 (outlet)
-        segment_levels = get_upseg_levels(0)
-        # at each level, reset all of the segment elevations as necessary
-        for level in segment_levels:
-            [reset_elevations(s) for s in level]
+        elevmin = self.m2.Min.values.astype(float)
+        elevmax = self.m2.Max.values.astype(float)
+        dem = self.m1.DEMmin.values
+        dem_min = topology.reduce_reaches(dem, np.fmin)
+        dem_reach1 = dem[topology.reach_start]
+
+        # only segments draining to an outseg of 0 are considered
+        segment_position = pd.Series(np.arange(topology.nseg), index=topology.segments)
+        outlet_outseg = np.zeros(topology.nseg, dtype=int)
+        has_outlet = topology.outlets > 0
+        outlet_outseg[has_outlet] = outseg[segment_position[topology.outlets[has_outlet]].values]
+        process = has_outlet & (outlet_outseg == 0)
+
+        # minimum sampled DEM elevation, and minimum current elevation,
+        # in each segment and all of the segments upstream of it (post-order pass)
+        upstream_dem_min = topology.accumulate(dem_min, np.minimum)
+        upstream_min = topology.accumulate(elevmin, np.minimum)
+
+        # downstream consistency (pre-order pass):
+        # the upsegs of each segment are visited in Mat2 order; each lowers the outseg start elevation
+        # to the lowest elevation upstream, and is itself lowered to the outseg start elevation
+        # as it stood after the previous upsegs
+        smin = upstream_dem_min.copy()
+        indptr, indices = topology.children
+        indices = indices[process[indices]]
+        if len(indices) > 0:
+            downstream = topology.parent[indices]
+            lowest = np.minimum(upstream_dem_min[indices], upstream_min[indices])
+            isnan = np.isnan(lowest)
+            lowest = pd.Series(np.where(isnan, np.inf, lowest)).groupby(downstream).cummin().values
+            isnan = pd.Series(isnan).groupby(downstream).cummax().values.astype(bool)
+            lowest = np.where(isnan, np.nan, lowest)
+
+            # outseg start elevation before each upseg is visited
+            first = np.ones(len(indices), dtype=bool)
+            first[1:] = downstream[1:] != downstream[:-1]
+            outseg_max = np.empty(len(indices))
+            outseg_max[first] = elevmax[downstream[first]]
+            outseg_max[~first] = np.minimum(elevmax[downstream[~first]], lowest[:-1][~first[1:]])
+            smin[indices] = np.minimum(outseg_max, upstream_dem_min[indices])
+
+            last = np.ones(len(indices), dtype=bool)
+            last[:-1] = first[1:]
+            elevmax[downstream[last]] = np.minimum(elevmax[downstream[last]], lowest[last])
+
+        # reset if the DEM is lower
+        lower = process & (smin < upstream_min)
+        elevmin[lower] = smin[lower]
+
+        # headwaters start no higher than the DEM elevation at reach 1
+        headwaters = process & (topology.nupsegs == 0)
+        elevmax[headwaters] = np.minimum(elevmax[headwaters], dem_reach1[headwaters])
 
         # update mat 2 with new elevations
         self.m2['Max'] = elevmax
         self.m2['Min'] = elevmin
 
-    def reset_model_top_2streambed(self, minimum_thickness=1, outdisfile=None, outsummary=None, external_files=False):
+    def reset_model_top_2streambed(self, minimum_thickness=1, outdisfile=None, outsummary=None, external_files=False,
+                                   external_path='', threads=4):
         #if hasattr(self, 'Elevations'):
         #    self.Elevations.reset_model_top_2streambed(minimum_thickness=minimum_thickness,
         #                                               outdisfile=outdisfile, outsummary=outsummary)
@@ -700,9 +1270,70 @@ class SFRdata(object):
         self.Elevations = Elevations(sfrobject=self)
         self.Elevations.reset_model_top_2streambed(minimum_thickness=minimum_thickness,
                                                    outdisfile=outdisfile, outsummary=outsummary,
-                                                   external_files=external_files)
+                                                   external_files=external_files,
+                                                   external_path=external_path, threads=threads)
         self.__dict__ = self.Elevations.__dict__.copy()
 
+    def assign_layers(self, buffer=0., lower_bottom=False, outfile=None):
+        """Assign each SFR reach to the model layer containing its streambed bottom
+        (streambed top - streambed thickness - buffer). Reaches with streambed bottoms
+        below the model bottom are assigned to the bottom layer.
+
+        Parameters
+        ----------
+        buffer : float
+            Additional distance below the streambed bottom that must be within the layer.
+        lower_bottom : bool
+            Option to lower the model bottom (in the elevs array) to the lowest streambed bottom in each
+            cell where reaches extend below it. Use reset_model_top_2streambed or write a new DIS file
+            to apply the changes to the model.
+        outfile : str, optional
+            csv file for reporting the reaches with streambed bottoms below the model bottom.
+
+        Returns
+        -------
+        summary : DataFrame
+            Number of reaches assigned to each layer, and the number of these
+            with streambed bottoms below the model bottom.
+        """
+        if self.elevs is None:
+            self.read_dis2()
+        nlay = self.elevs.shape[0] - 1
+        nodes = self.m1.node.values
+        sbbot = (self.m1.sbtop - self.m1.sbthick).values - buffer
+
+        # layer bottoms for each reach; the layer is the first one with a bottom at or below the streambed bottom
+        botm = self.elevs[1:].reshape(nlay, -1)
+        cellbotms = botm[:, nodes - 1]
+        in_layer = cellbotms <= sbbot
+        below_bottom = ~in_layer[-1]
+        self.m1['layer'] = np.where(below_bottom, nlay, np.argmax(in_layer, axis=0) + 1)
+
+        below = pd.DataFrame({'segment': self.m1.segment.values[below_bottom],
+                              'reach': self.m1.reach.values[below_bottom],
+                              'node': nodes[below_bottom],
+                              'sbbot': sbbot[below_bottom],
+                              'model_bottom': cellbotms[-1, below_bottom],
+                              'model_top': self.elevs[0].ravel()[nodes[below_bottom] - 1]},
+                             columns=['segment', 'reach', 'node', 'sbbot', 'model_bottom', 'model_top'])
+        if len(below) > 0:
+            print('{} reaches have streambed bottoms below the model bottom'.format(len(below)))
+        if outfile is not None:
+            below.to_csv(outfile, index=False)
+        self.below_bottom = below
+
+        if lower_bottom and len(below) > 0:
+            lowest = below.groupby('node').sbbot.min()
+            botm[-1, lowest.index.values - 1] = np.minimum(botm[-1, lowest.index.values - 1], lowest.values)
+            print('lowered the model bottom in {} cells'.format(len(lowest)))
+
+        layers = np.arange(1, nlay + 1)
+        summary = pd.DataFrame({'nreaches': np.bincount(self.m1.layer.values, minlength=nlay + 1)[1:],
+                                'below_bottom': 0}, index=layers, columns=['nreaches', 'below_bottom'])
+        summary.loc[nlay, 'below_bottom'] = len(below)
+        summary.index.name = 'layer'
+        return summary
+
     def incorporate_field_elevations(self, shpfile, elevs_field, distance_tol):
         if hasattr(self, 'Elevations'):
             self.Elevations.incorporate_field_elevations(shpfile=shpfile, elevs_field=elevs_field,
@@ -740,7 +1371,7 @@ class SFRdata(object):
 
     def renumber_sfr_cells_from_polygons(self, intersect_df=None, intersect_shapefile=None, intersect_prj=None,
                                          sfr_shapefile=None,
-                                         node_attribute=None, GIS_mult=None):
+                                         node_attribute=None, GIS_mult=None, grid_index=None):
         """
         Subdivides SFR segments where they intersect polygon features supplied in a dataframe or a shapefile.
         Contiguous sequences of SFR reaches (within a segment)
@@ -753,6 +1384,7 @@ class SFRdata(object):
         :param sfr_shapefile:
         :param node_attribute:
         :param GIS_mult:
+        :param grid_index: bool or gridindex.GridIndex instance (see Spatial.intersect_with_SFR_cells)
         :return:
         """
 
@@ -760,7 +1392,8 @@ class SFRdata(object):
         self._intersected = self.Spatial.intersect_with_SFR_cells(intersect_df=intersect_df, intersect_shapefile=intersect_shapefile,
                                                     intersect_prj=intersect_prj,
                                                     sfr_shapefile=sfr_shapefile,
-                                                    node_attribute=node_attribute, GIS_mult=GIS_mult)
+                                                    node_attribute=node_attribute, GIS_mult=GIS_mult,
+                                                    grid_index=grid_index)
 
         '''
         sfr_cells = pd.read_csv('waterbodies_intersected.csv').sfr_cells.tolist()
@@ -840,9 +1473,13 @@ class SFRdata(object):
 
             df_lines = GISio.shp2df(lines_shapefile)
             print("Adding segment and reach information to linework shapefile...")
+            # index the linework geometries and the SFR reaches by model cell
+            line_index = NodeReaches(df_lines[node_col].values)
+            node_reaches = self.node_reaches
+
             # first assign geometries for model cells with only 1 SFR reach
             df_lines_geoms = df_lines.geometry.values
-            geom_idx = [df_lines.index[df_lines[node_col] == n] for n in df.node.values]
+            geom_idx = [line_index.reaches(n) for n in df.node.values]
             df['geometry'] = [df_lines_geoms[g[0]] if len(g) == 1 else
                               MultiLineString(df_lines_geoms[g].tolist()) if len(g) > 1
                               else None
@@ -850,22 +1487,20 @@ class SFRdata(object):
 
             # then assign geometries for model cells with multiple SFR reaches
             # use length to figure out which geometry goes with which reach
-            shared_cells = np.unique(df.ix[df.node.duplicated(), self.node_attribute])
-            for n in shared_cells:
-                # make dataframe of all reache geometries within the model cell
-                reaches = pd.DataFrame(df_lines.ix[df_lines[node_col] == n, 'geometry'].copy())
-                reaches['length'] = [g.length for g in reaches.geometry]
+            for n in node_reaches.shared_cells:
+                # reach geometries within the model cell
+                geoms = df_lines_geoms[line_index.reaches(n)]
 
                 # SFR reaches in that model cell
-                dfs = df.ix[df[self.node_attribute] == n]
+                dfs = df.iloc[node_reaches.reaches(n)]
                 # if there are an equal number of reaches for the cell in m1, and in the linework geometry
                 # (i.e. the collocated reaches aren't consolidated)
                 if len(dfs) > 1:
-                    for i, r in reaches.iterrows():
+                    for g in geoms:
                         # index of SFR reaches with length closest to reach
-                        ind = np.argmin(np.abs(dfs.length - r.length))
+                        ind = dfs.index[np.argmin(np.abs(dfs.length.values - g.length))]
                         # assign the reach geometry to the streamflow results at that index
-                        df.loc[ind, 'geometry'] = r.geometry
+                        df.loc[ind, 'geometry'] = g
                 # seems like Howard's code consolidates multiple reaches of the same segment
                 #else:
                 #    ind = dfs.index[0]
@@ -990,11 +1625,10 @@ class SFRdata(object):
 
     def update_Mat2_elevations(self):
         print('Updating min/max elevations in Mat2 from elevations in Mat1...')
+        topology = self.topology
         sbtop = self.m1.sbtop.values
-        m1segments = self.m1.segment.values
-        m2segments = self.m2.segment.values
-        self.m2['Max'] = [np.max(sbtop[m1segments == s]) for s in m2segments]
-        self.m2['Min'] = [np.min(sbtop[m1segments == s]) for s in m2segments]
+        self.m2['Max'] = topology.reduce_reaches(sbtop, np.maximum)
+        self.m2['Min'] = topology.reduce_reaches(sbtop, np.minimum)
 
     def write_shapefile(self, outshp='SFR_postproc.shp', xll=None, yll=None, epsg=None, proj4=None, prj=None):
 
@@ -1176,25 +1810,40 @@ class Elevations(SFRdata):
     def __init__(self, sfrobject=None, Mat1=None, Mat2=None, sfr=None, node_column=False,
                  mfpath=None, mfnam=None, mfdis=None, to_meters_mult=0.3048,
                  minimum_slope=1e-4, dem=None, landsurfacefile=None, landsurface_column=None,
-                 smoothing_iterations=0):
+                 landsurface_dtype=None, smoothing_iterations=0, dis_cache=False):
         """
         Smooth streambed elevations outside of the context of the objects in SFR classes
         (works off of information in Mat1 and Mat2; generates updated versions of these files
+
+        landsurfacefile can be a text file, a .npy file, or a raw binary file of
+        land surface elevations by model node (with landsurface_dtype specified; see read_landsurface).
         """
         SFRdata.__init__(self, sfrobject=sfrobject, Mat1=Mat1, Mat2=Mat2, sfr=sfr, node_column=node_column,
                  mfpath=mfpath, mfnam=mfnam, mfdis=mfdis,
                  dem=dem, landsurfacefile=landsurfacefile, to_meters_mult=to_meters_mult,
-                 minimum_slope=minimum_slope)
-
-        if self.dem:
-            pass
+                 minimum_slope=minimum_slope, dis_cache=dis_cache)
 
-        elif self.landsurfacefile and self.landsurface is None:
-            self.landsurface = np.fromfile(self.landsurfacefile, sep=' ') # array of elevations to use (sorted by cellnumber)
-
-            print('assigning elevations in {} to landsurface column in Mat1...'.format(landsurfacefile))
+        if dem is not None:
+            self.dem = dem
+            print('assigning minimum elevations in {} to landsurface column in Mat1...'.format(dem))
+            self.dem_zstats = self.sample_dem()
+            self.m1['landsurface'] = self.dem_zstats['min'].values * self.dem_units_mult
+            # keep any streambed tops that were already assigned (e.g. by reset_m1_streambed_top_from_dem)
+            if 'sbtop' not in self.m1.columns or self.m1['sbtop'].isnull().all():
+                self.m1['sbtop'] = self.m1['landsurface']
+
+        elif (landsurfacefile or self.landsurfacefile) and self.landsurface is None:
+            if landsurfacefile is not None:
+                self.landsurfacefile = landsurfacefile
+            # array of elevations to use (sorted by cellnumber)
+            self.landsurface = read_landsurface(self.landsurfacefile, dtype=landsurface_dtype)
+
+            print('assigning elevations in {} to landsurface column in Mat1...'.format(self.landsurfacefile))
             # assign land surface elevations based on node number
-            self.m1['landsurface'] = [self.landsurface[n-1] for n in self.m1[self.node_column]]
+            # (gathering each cell once, in node order, to minimize reads from memory-mapped files)
+            node_reaches = self.node_reaches
+            cell_elevations = np.take(self.landsurface, node_reaches.unique_nodes - 1)
+            self.m1['landsurface'] = node_reaches.broadcast(cell_elevations)
             self.m1['sbtop'] = self.m1['landsurface'] # might consider getting rid of landsurface column and only working with top_streambed
 
         elif not landsurfacefile and landsurface_column is not None:
@@ -1343,48 +1992,25 @@ class Elevations(SFRdata):
         self.smoothing_iterations = knt
 
 
-    def interpolate(self, istart, istop):
-        '''
-        istart = index of previous minimum elevation
-        istop = index of current minimum elevation
-        dx = interpolation distance
-        dS = change in streambed top over interpolation distance
-        '''
-        dx = self.cdist[istart] - self.cdist[istop]
-        dS = self.minelev - self.segelevs[istop]
-
-        dist = 0
-
-        if dS == 0:
-            slope = 0
-        else:
-            slope = dS/dx
-
-        for i in np.arange(istart+1, istop+1):
-
-            dist += self.cdist[i-1] - self.cdist[i]
-            self.sm.append(self.minelev - dist * slope)
-
-            self.ofp.write('{:.0f},{:.0f},{:.2f},{:.2f},{:.2f},{:.2e},{:.2f}\n'
-                           .format(self.seg, i, self.segelevs[i-1], self.minelev, dist, slope, self.sm[-1]))
-
-        # reset the minimum elevation to current
-        self.minelev = self.sm[-1]
-
-
-    def smooth_segment_interiors(self, report_file='smooth_segment_interiors.txt', tol=1e-5):
+    def smooth_segment_interiors(self, report_file=None, tol=1e-5):
+        """Smooth streambed elevations within each segment so that they decrease monotonically
+        from the segment Max to the segment Min in Mat2. Starting at reach 1, each reach with a
+        land surface elevation below all of the previous minima (and above the segment end) is a new minimum;
+        elevations between minima are linearly interpolated by distance along the segment. Reaches after the first
+        land surface elevation below the segment end are interpolated to the segment end.
+        All segments are processed at once.
 
+        Parameters
+        ----------
+        report_file : str, optional
+            Table (csv) of the minimum elevation, distance from the minimum, and slope used
+            to compute the streambed elevation of each reach. No report is written by default.
+        tol : float
+            Land surface elevations within tol of the segment end are considered equal to the end.
+        """
         print('\nSmoothing segment interiors...\n')
 
-        # open a file to report on interpolations
-        self.ofp = open(report_file, 'w')
-        self.ofp.write('segment, reach, land_surface, minelev, dist, slope, sb_elev\n')
-
-        try:
-            self.m2['Max'], self.m2['Min']
-            m2minmax = True
-        except:
-            m2minmax = False
+        if 'Max' not in self.m2.columns or 'Min' not in self.m2.columns:
             print("Max, Min elevation columns not found in Mat2" \
                   "Run map_confluences() first.")
             return
@@ -1394,98 +2020,265 @@ class Elevations(SFRdata):
         else:
             print('starting from elevations in m1.landsurface')
 
-        for seg in self.segments:
-            self.seg = seg
-
-            # make a view of the Mat 1 dataframe that only includes the segment
-            df = self.m1[self.m1.segment == seg].sort_values(by='reach')
-
-            # start with land surface elevations along segment
-            self.segelevs = df.landsurface.values
-
-            start, end = self.m2.ix[seg, ['Max', 'Min']]
-
-            # get start and end elevations from Mat2; if they are equal, continue
-            if start == end:
-                self.sm = [start] * len(self.segelevs)
-                self.m1.loc[self.m1.segment == seg, 'sbtop'] = self.sm
-                continue
-            else:
-                self.sm = [start]
-                self.segelevs[-1] = end
-
-            # calculate cumulative distances at cell centers
-            lengths = df.length.values
-            self.cdist = np.cumsum(lengths) - 0.5 * lengths
-
-            self.minelev = start
-            minloc = 0
-            nreaches = len(self.segelevs)
-
-            for i in range(nreaches)[1:]:
-
-                # if the current elevation is equal to or below the minimum
-                if self.segelevs[i] < self.minelev or abs(self.segelevs[i] - self.minelev) < tol:
-
-                    # if the current elevation is above the end, interpolate from previous minimum to current
-                    # only interpolate to current reach if it is below the previous minimum
-                    # (that is, do not allow flat stretches unless the segment minimum elevation is reached)
-                    if self.minelev > self.segelevs[i] > end or abs(self.segelevs[i] - end) < tol:
-                        self.interpolate(minloc, i)
-                        minloc = i
-
-                    # otherwise if it is below the end, interpolate from previous minimum to end
-                    elif self.segelevs[i] < end:
-                        self.interpolate(minloc, nreaches-1)
-                        break
-                else:
-                    continue
-
-            # update Mat1 with smoothed streambed tops
-            self.m1.loc[self.m1.segment == seg, 'sbtop'] = self.sm
+        topology = self.topology
+        has_reaches = topology.nreaches > 0
+        nreaches = topology.nreaches[has_reaches]
+        first = topology.reach_start[has_reaches]
+        last = topology.reach_stop[has_reaches] - 1
+        group = np.repeat(np.arange(len(nreaches)), nreaches)
+        start = np.repeat(self.m2.Max.values[has_reaches], nreaches)
+        end = np.repeat(self.m2.Min.values[has_reaches], nreaches)
+
+        # start with land surface elevations along each segment, and the start and end elevations from Mat2
+        landsurface = self.m1.landsurface.values
+        elevs = landsurface.astype(float)
+        elevs[last] = end[last]
+        elevs[first] = start[first]
+
+        # reaches after the first elevation below the segment end are interpolated to the end
+        below_end = (elevs < end) & (np.abs(elevs - end) >= tol)
+        past_end = pd.Series(below_end).groupby(group).cummax().values.astype(bool)
+        elevs = np.where(past_end, np.inf, np.maximum(elevs, end))
+        elevs[last] = end[last]
+        elevs[first] = start[first]
+
+        # minima are the reaches below the running minimum elevation in the segment
+        running_min = pd.Series(elevs).groupby(group).cummin().values
+        minima = np.ones(len(elevs), dtype=bool)
+        minima[1:] = elevs[1:] < running_min[:-1]
+        minima[first] = True
+        minima[last] = True
+
+        # linear interpolation between minima, by distance at cell centers
+        lengths = self.m1.length.values
+        cdist = self.m1.groupby('segment', sort=False).length.cumsum().values - 0.5 * lengths
+        positions = np.arange(len(elevs))
+        previous = np.maximum.accumulate(np.where(minima, positions, 0))
+        following = np.minimum.accumulate(np.where(minima, positions, len(elevs))[::-1])[::-1]
+        dist = cdist - cdist[previous]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (elevs[previous] - elevs[following]) / (cdist[following] - cdist[previous])
+        slope[following == previous] = 0
+        sbtop = elevs[previous] - dist * slope
+
+        # segments with equal start and end elevations are flat
+        flat = start == end
+        sbtop[flat] = start[flat]
+        self.m1['sbtop'] = sbtop
+
+        if report_file is not None:
+            report = pd.DataFrame({'segment': self.m1.segment.values,
+                                   'reach': self.m1.reach.values,
+                                   'land_surface': landsurface,
+                                   'minelev': np.where(flat, start, elevs[previous]),
+                                   'dist': np.where(flat, 0, dist),
+                                   'slope': np.where(flat, 0, slope),
+                                   'sb_elev': sbtop},
+                                  columns=['segment', 'reach', 'land_surface', 'minelev', 'dist', 'slope', 'sb_elev'])
+            report.to_csv(report_file, index=False)
 
         # assign slopes to Mat 1 based on the smoothed elevations
         self.calculate_slopes()
 
-        # save updated Mat1
-        #self.m1.to_csv(self.Mat1[:-4] + '_elevs.csv', index=False)
-        self.ofp.close()
-        print('Done, see {} for report.'.format(report_file))
+        if report_file is not None:
+            print('Done, see {} for report.'.format(report_file))
+        else:
+            print('Done.')
 
+    def smooth_isotonic(self, target_column='landsurface', weight_column=None):
+        """Set streambed elevations to the (weighted) least-squares fit to target elevations
+        that never increase downstream, across reaches and confluences (isotonic regression on the
+        stream network). Reaches are visited from the headwaters to the outlets; each reach starts as a block
+        with its own target, and absorbs the adjacent upstream blocks with the lowest means until no
+        upstream block is lower than it. Upstream blocks are kept in heaps (merged smaller into larger).
 
-    def calculate_slopes(self):
-        '''
-        assign a slope value for each stream cell based on streambed elevations
-        this method is run at the end of smooth_segment_interiors, after the interior elevations have been assigned
-        '''
-        print('calculating slopes...')
-        for s in self.segments:
+        Parameters
+        ----------
+        target_column : str
+            Column in Mat1 with target elevations for each reach (e.g. sampled DEM minimums, elevations
+            interpolated from NHDPlus, or field measurements)
+        weight_column : str, optional
+            Column in Mat1 with weights for the target elevations (e.g. higher for field measurements).
+            By default all targets are weighted equally.
 
-            # calculate the right-hand elevation differences (not perfect, but easy)
-            diffs = self.m1[self.m1.segment == s].sbtop.diff()[1:].tolist()
+        Notes
+        -----
+        Segments in circular routing are not included; their elevations are left as is.
+        Mat2 Max/Min elevations and Mat1 slopes are updated from the results.
+        """
+        print('\nFitting monotonic streambed elevations to {} in Mat1...'.format(target_column))
+        topology = self.topology
+        targets = self.m1[target_column].values.astype(float)
+        if weight_column is None:
+            weights = np.ones(len(targets))
+        else:
+            weights = self.m1[weight_column].values.astype(float)
+
+        # reaches from the headwaters to the outlets
+        order = topology.order
+        order = order[topology.nreaches[order] > 0]
+        reaches = np.concatenate([np.arange(topology.reach_start[s], topology.reach_stop[s]) for s in order]) \
+            if len(order) > 0 else np.array([], dtype=int)
+        if not np.all(np.isfinite(targets[reaches])) or not np.all(weights[reaches] > 0):
+            raise ValueError('{} must be finite, and weights positive, for all reaches.'.format(target_column))
+
+        # reaches upstream of each reach 1: the last reaches of the upsegs
+        indptr, indices = topology.children
+        first_reach = topology.reach_start
+        last_reach = topology.reach_stop - 1
+        has_reaches = topology.nreaches > 0
+        upreaches = {}
+        for s in order:
+            upsegs = indices[indptr[s]:indptr[s+1]]
+            upreaches[first_reach[s]] = last_reach[upsegs[has_reaches[upsegs]]].tolist()
+        is_first = np.zeros(len(targets), dtype=bool)
+        is_first[first_reach[has_reaches]] = True
+
+        wsum = weights.tolist()
+        wysum = (weights * targets).tolist()
+        absorbed_by = list(range(len(targets)))
+        heaps = {}
+        for r in reaches.tolist():
+            upstream = upreaches[r] if is_first[r] else [r - 1]
+
+            # blocks are identified by their most downstream reach; the block containing
+            # the most downstream reach of each upstream subtree is adjacent to this reach
+            heap = [(wysum[u] / wsum[u], u) for u in upstream]
+            heapq.heapify(heap)
+
+            # absorb adjacent upstream blocks that are lower than this one;
+            # the blocks adjacent to an absorbed block become adjacent to this one
+            while len(heap) > 0 and heap[0][0] < wysum[r] / wsum[r]:
+                mean, b = heapq.heappop(heap)
+                wsum[r] += wsum[b]
+                wysum[r] += wysum[b]
+                absorbed_by[b] = r
+                bheap = heaps.pop(b)
+                if len(bheap) > len(heap):
+                    heap, bheap = bheap, heap
+                for item in bheap:
+                    heapq.heappush(heap, item)
+            heaps[r] = heap
+
+        # blocks are absorbed by reaches further downstream, so working upstream from the outlets,
+        # the block of the absorbing reach is already known
+        block = np.arange(len(targets))
+        for r in reaches[::-1].tolist():
+            b = absorbed_by[r]
+            if b != r:
+                block[r] = block[b]
+        fitted = np.array(wysum)[block] / np.array(wsum)[block]
+
+        sbtop = self.m1.sbtop.values.astype(float)
+        sbtop[reaches] = fitted[reaches]
+        self.m1['sbtop'] = sbtop
+        ncircular = np.sum(topology.circular)
+        if ncircular > 0:
+            print('{} segments in circular routing were not included.'.format(ncircular))
+        print('sum of squared differences from {}: {:.2f}'.format(target_column,
+                                                                   np.sum((fitted[reaches] - targets[reaches])**2)))
 
-            if len(diffs) > 0:
-                diffs.append(diffs[-1]) # use the left-hand difference for the last reach
+        self.update_Mat2_elevations()
+        self.calculate_slopes()
+        print('Done.')
 
-            # edge case where segment only has 1 reach
-            else:
-                diffs = self.m2.Min[s] - self.m2.Max[s]
+    def optimize_streambed(self, grid_elevation_column='model_top', weight_float=1000., weight_incise=1.,
+                           max_float=1., max_incise=50., weight_fit=1e-3, minimum_slope=None):
+        """Optimize streambed elevations so that they are routed (never increase downstream)
+        while minimizing floating and incised reaches relative to the model grid, as outlined by
+        H.W. Reeves in archive/optimizeSFR.py. The routing constraints (Ax >= 0, with a row for each
+        connection between reaches) are built as a sparse matrix, and the problem is solved as a
+        linear program with scipy (HiGHS), so penalties are proportional to the height of streambed
+        above max_float, or depth below max_incise.
 
-            # divide by length in cell; reverse sign so downstream = positive (as in SFR package)
-            slopes = diffs / self.m1[self.m1.segment == s].length * -1
+        Parameters
+        ----------
+        grid_elevation_column : str
+            Column in Mat1 with grid cell elevations (e.g. model top) to compare the streambed to
+        weight_float : float
+            Weight for streambed elevations more than max_float above the grid elevation
+        weight_incise : float
+            Weight for streambed elevations more than max_incise below the grid elevation
+        max_float : float
+            Allowable height of streambed above the grid elevation
+        max_incise : float
+            Maximum incision of the streambed below the grid elevation before a penalty is added
+        weight_fit : float
+            Weight for differences from the current streambed elevations (sbtop);
+            keeps streambed elevations that aren't penalized from moving.
+        minimum_slope : float, optional
+            If specified, the elevation drop between connected reaches must be at least minimum_slope
+            times the distance between the reach midpoints.
 
-            # assign to Mat1
-            self.m1.loc[self.m1.segment == s, 'slope'] = slopes
-        
-        # enforce minimum slope
-        self.m1.loc[self.m1['slope'] > self.maximum_slope, 'slope'] = self.maximum_slope
-        self.m1.loc[self.m1['slope'] < self.minimum_slope, 'slope'] = self.minimum_slope
+        Notes
+        -----
+        Requires scipy. Mat2 Max/Min elevations and Mat1 slopes are updated from the results.
+        """
+        from scipy import sparse
+        from scipy.optimize import linprog
+
+        print('\nOptimizing streambed elevations relative to {}...'.format(grid_elevation_column))
+        topology = self.topology
+        sbtop = self.m1.sbtop.values.astype(float)
+        gridelev = self.m1[grid_elevation_column].values.astype(float)
+        lengths = self.m1.length.values
+        nreach = len(sbtop)
+        if not np.all(np.isfinite(sbtop)):
+            raise ValueError('Streambed elevations (sbtop) must be finite for all reaches.')
+
+        # connection matrix; SFR(upstream) - SFR(downstream) >= minimum drop
+        upstream, downstream = topology.reach_connections()
+        nconnections = len(upstream)
+        rows = np.arange(nconnections)
+        A = sparse.coo_matrix((np.concatenate((np.ones(nconnections), -np.ones(nconnections))),
+                               (np.concatenate((rows, rows)), np.concatenate((upstream, downstream)))),
+                              shape=(nconnections, nreach))
+        min_drop = np.zeros(nconnections)
+        if minimum_slope is not None:
+            min_drop = minimum_slope * 0.5 * (lengths[upstream] + lengths[downstream])
+
+        # variables are the streambed elevations, the heights above max_float and depths below max_incise,
+        # and the positive and negative differences from the current streambed elevations
+        has_grid = np.where(np.isfinite(gridelev))[0]
+        ngrid = len(has_grid)
+        identity = sparse.identity(nreach, format='csr')
+        penalized = identity[has_grid]
+        grid_identity = sparse.identity(ngrid, format='csr')
+        zeros = sparse.csr_matrix((ngrid, ngrid))
+        A_ub = sparse.vstack([sparse.hstack([-A, sparse.csr_matrix((nconnections, 2 * ngrid + 2 * nreach))]),
+                              sparse.hstack([penalized, -grid_identity, zeros,
+                                             sparse.csr_matrix((ngrid, 2 * nreach))]),
+                              sparse.hstack([-penalized, zeros, -grid_identity,
+                                             sparse.csr_matrix((ngrid, 2 * nreach))])], format='csr')
+        b_ub = np.concatenate((-min_drop, gridelev[has_grid] + max_float, -(gridelev[has_grid] - max_incise)))
+        A_eq = sparse.hstack([identity, sparse.csr_matrix((nreach, 2 * ngrid)), -identity, identity], format='csr')
+        b_eq = sbtop
+        c = np.concatenate((np.zeros(nreach), weight_float * np.ones(ngrid), weight_incise * np.ones(ngrid),
+                            weight_fit * np.ones(2 * nreach)))
+        bounds = [(None, None)] * nreach + [(0, None)] * (2 * ngrid + 2 * nreach)
+
+        result = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs')
+        if result.status != 0:
+            print('Optimization failed: {}\nStreambed elevations were not changed.'.format(result.message))
+            return
+
+        def report(elevations):
+            height = elevations[has_grid] - gridelev[has_grid]
+            return np.sum(height > max_float), np.sum(-height > max_incise)
+        print('{} floating and {} incised reaches before optimization'.format(*report(sbtop)))
+        self.m1['sbtop'] = result.x[:nreach]
+        print('{} floating and {} incised reaches after optimization'.format(*report(result.x[:nreach])))
 
+        self.update_Mat2_elevations()
+        self.calculate_slopes()
+        print('Done.')
 
     def reset_model_top_2streambed(self, minimum_thickness=1, outdisfile=None, outsummary=None,
-                                   external_files=False):
+                                   external_files=False, external_path='', threads=4):
         """Make the model top elevation consistent with the SFR streambed elevations;
-        Adjust other layers downward (this puts all SFR cells in layer1)
+        Adjust other layers downward (this puts all SFR cells in layer1).
+        Starts from the elevs array, so that earlier changes to it (e.g. from assign_layers)
+        are included in the new discretization.
 
         Parameters
         ----------
@@ -1500,6 +2293,18 @@ class Elevations(SFRdata):
             If specified, will save a summary (in SFR Mat1 style format)
             of adjustments made to the model top
 
+        external_files : bool or str
+            Option to write the top and bottom arrays to external files (top.dat, botm0.dat, ...)
+            instead of a new discretization file. True or 'text' writes text arrays;
+            'binary' writes MODFLOW binary arrays (top.bin, botm0.bin, ...), which are much faster to write
+            for large grids. The OPEN/CLOSE control records for the arrays are stored
+            in the external_arrays attribute (see write_external_array).
+
+        external_path : str
+            Folder for the external files.
+
+        threads : int
+            Number of threads for writing the external files.
         """
 
         if outdisfile is None:
@@ -1516,30 +2321,27 @@ class Elevations(SFRdata):
             self.m1.sbthick = 0.9 * minimum_thickness
 
         # make a vector of lowest streambed values for each cell containing SFR (for collocated SFR cells)
-        self.m1['lowest_top'] = self.m1.sbtop
-
-        #shared_cells = np.unique(self.m1.ix[self.m1.node.duplicated(), 'node'])
-        for c in self.shared_cells:
+        # (np.fmin skips nan values, like the pandas minimum)
+        node_reaches = self.node_reaches
+        self.m1['lowest_top'] = node_reaches.broadcast(node_reaches.reduce(self.m1.sbtop.values, np.fmin))
 
-            # select the collocated reaches for this cell
-            df = self.m1[self.m1.node == c].sort_values(by='sbtop', ascending=False)
-
-            # make column of lowest streambed elevation in each cell with SFR
-            self.m1.loc[df.index, 'lowest_top'] = np.min(df.sbtop)
+        # start from the elevs array, which includes any changes made since the DIS file was read
+        # (e.g. a model bottom lowered by assign_layers); bottoms of Quasi-3D confining beds come from the DIS file
+        botm = np.array(self.dis.botm.array, dtype=float)
+        laycbd = (np.asarray(self.dis.laycbd.array) == 1).astype(int)
+        layer_botm = np.arange(len(laycbd)) + np.append(0, np.cumsum(laycbd)[:-1])
+        botm[layer_botm] = self.elevs[1:]
 
         # make a new model top array; assign lowest streambed tops to it
-        newtop = self.dis.top.array.copy()
+        newtop = self.elevs[0].copy()
         newtop[self.m1.row.values-1, self.m1.column.values-1] = self.m1.lowest_top.values
 
         # Now straighten out the other layers, removing any negative thicknesses
-        # do layer 1 first
-        newbots = self.dis.botm.array.copy()
-        conflicts = newbots[0, :, :] > newtop - minimum_thickness
-        newbots[0, conflicts] = newtop[conflicts] - minimum_thickness
-
-        for i in range(self.dis.nlay - 1):
-            conflicts = newbots[i+1, :, :] > (newbots[i, :, :] - minimum_thickness)
-            newbots[i+1, conflicts] = newbots[i, conflicts] - minimum_thickness
+        # each bottom is lowered to (the new elevation of the surface above) - minimum_thickness;
+        # offsetting surface k by k * minimum_thickness turns this into a running minimum down the layers
+        offsets = minimum_thickness * np.arange(1, botm.shape[0] + 1)[:, np.newaxis, np.newaxis]
+        lowest = np.minimum.accumulate(np.concatenate([newtop[np.newaxis], botm + offsets]), axis=0)[1:]
+        newbots = np.where(lowest < botm + offsets, lowest - offsets, botm)
 
         # make a dataframe that shows the largest adjustments made to model top
         self.m1['top_height'] = self.m1.model_top - self.m1.sbtop
@@ -1551,7 +2353,7 @@ class Elevations(SFRdata):
 
         # update the elevs array
         self.elevs[0, :, :] = newtop
-        self.elevs[1:, :, :] = newbots
+        self.elevs[1:, :, :] = newbots[layer_botm]
 
         # update the layer in Mat1 to 1 for all SFR cells
         self.m1['layer'] = 1
@@ -1560,7 +2362,8 @@ class Elevations(SFRdata):
             new_m = flopy.modflow.mf.Modflow(model_ws=os.path.split(outdisfile)[0],
                                              modelname=os.path.split(outdisfile)[1][:-4])
             newdis = flopy.modflow.ModflowDis(new_m, nlay=self.dis.nlay, nrow=self.dis.nrow, ncol=self.dis.ncol,
-                                              delr=self.dis.delr, delc=self.dis.delc, top=newtop, botm=newbots)
+                                              delr=self.dis.delr.array, delc=self.dis.delc.array,
+                                              laycbd=self.dis.laycbd.array, top=newtop, botm=newbots)
 
             if isinstance(newdis.fn_path, list):
                 newdis.fn_path = newdis.fn_path[0]
@@ -1568,9 +2371,25 @@ class Elevations(SFRdata):
             print('writing new discretization file {} using flopy...'.format(outdisfile))
             newdis.write_file()
         else:
-            np.savetxt('top.dat', newtop, fmt='%.2f')
-            for i in range(newbots.shape[0]):
-                np.savetxt('botm{}.dat'.format(i), newbots[i], fmt='%.2f')
+            from multiprocessing.pool import ThreadPool
+
+            binary = external_files == 'binary'
+            ext = '.bin' if binary else '.dat'
+            if len(external_path) > 0 and not os.path.isdir(external_path):
+                os.makedirs(external_path)
+            arrays = [('top', newtop, 'top', 1)] + [('botm{}'.format(i), newbots[i], 'botm', i + 1)
+                                                    for i in range(newbots.shape[0])]
+            tasks = [(os.path.join(external_path, name + ext), array, text, ilay)
+                     for name, array, text, ilay in arrays]
+            print('writing {} external arrays to {}...'.format(len(tasks), os.path.abspath(external_path)))
+            pool = ThreadPool(max(1, threads))
+            try:
+                records = pool.map(lambda t: write_external_array(t[0], t[1], binary=binary, text=t[2], ilay=t[3]),
+                                   tasks)
+            finally:
+                pool.close()
+                pool.join()
+            self.external_arrays = OrderedDict(zip([name for name, _, _, _ in arrays], records))
         print('Done.')
 
     def incorporate_field_elevations(self, shpfile, elevs_field, distance_tol):
@@ -1670,56 +2489,66 @@ class Elevations(SFRdata):
         self.confluences = confluences
         print('Done, see confluences attribute.')
 
-    def map_confluences(self, dem=None, landsurfacefile=None, landsurface_column=None):
+    def _routing_rises(self, m2=None):
+        """Table of segments with Min elevations below the Max (start) elevation of their outseg."""
+        if m2 is None:
+            m2 = self.m2
+        topology = self.topology
+        routed = np.where(topology.parent >= 0)[0]
+        dnseg_max = m2.Max.values[topology.parent[routed]]
+        rises = m2.Min.values[routed] < dnseg_max
+        rises_df = m2.iloc[routed[rises]][['segment', 'outseg', 'Min']].copy()
+        rises_df['dnseg_Max'] = dnseg_max[rises]
+        rises_df['rise'] = rises_df.dnseg_Max - rises_df.Min
+        return rises_df
 
-        if 'Max' not in self.m2.columns:
-            #self.update_Mat2_elevations()
-            pass
+    def map_confluences(self, dem=None, landsurfacefile=None, landsurface_column=None):
+        """Make the elevations at confluences consistent, by setting the Max (start) elevation of each segment
+        to the lowest Min (end) elevation of its upsegs (if lower), and the segment Min elevation to its Max
+        (if higher). Segments are visited from the headwaters to the outlets,
+        so that every upseg is finished before the segment it routes to.
+        """
         m2 = self.m2.copy()
-
-        print("{} segments with min > max".format(len(m2.loc[(m2.Max - m2.Min) < 0, 'Min'])))
-        diffs = np.diff(m2.ix[self.outsegs.ix[1].values[self.outsegs.ix[1].values != 0], 'Max'].values)
-        total_elevation_rise = np.sum(diffs[diffs > 0])
-        print(total_elevation_rise)
-        #m2Max = m2.Max.tolist()
-
-        segments = self.m1.groupby('segment')
+        topology = self.topology
+
+        print("{} segments with min > max".format(np.sum((m2.Max - m2.Min).values < 0)))
+        rises_df = self._routing_rises(m2)
+        print("{} segments with min < downstream segment max".format(len(rises_df)))
+        print("{} total elevation rise (in model length units)".format(rises_df.rise.sum()))
+
+        elevmax = m2.Max.values.astype(float)
+        elevmin = m2.Min.values.astype(float)
+        original_max = elevmax.copy()
+
+        # lowest Min elevation of the upsegs of each segment, filled in as the upsegs are finished
+        upsegs_min = np.empty(topology.nseg)
+        upsegs_min[:] = np.nan
+        has_upsegs = topology.nupsegs > 0
+        for level in topology.levels:
+            confluences = level[has_upsegs[level]]
+            elevmax[confluences] = np.minimum(elevmax[confluences], upsegs_min[confluences])
+            elevmin[level] = np.where(elevmax[level] < elevmin[level], elevmax[level], elevmin[level])
+
+            downstream = topology.parent[level]
+            routed = downstream >= 0
+            np.fmin.at(upsegs_min, downstream[routed], elevmin[level[routed]])
+
+        m2['Max'] = elevmax
+        m2['Min'] = elevmin
+        print("{} segments with min > max".format(np.sum((m2.Max - m2.Min).values < 0)))
+        rises_df = self._routing_rises(m2)
+        print("{} segments with min < downstream segment max".format(len(rises_df)))
+        print("{} total elevation rise (in model length units)".format(rises_df.rise.sum()))
 
         # setup dataframe of confluences
         # confluences are where segments have upsegs (no upsegs means the reach 1 is a headwater)
-        confluences_inds = np.array([False if len(u) == 0 else True for u in m2.upsegs])
-        confluences = m2.ix[confluences_inds, ['segment', 'upsegs', 'Max']].copy()
-        upsegs = confluences.upsegs.tolist()
-
-        # run this loop multiple times so that m2 can be updated and the minimum elevations taken again
-        for i in range(10):
-            elevs = m2.loc[confluences.segment.values, 'Max'].tolist()
-            elevs = [np.min([m2.Min[m2.segment.isin(u)].min(), elevs[i]]) for i, u in enumerate(upsegs)]
-            m2.loc[confluences.segment.values, 'Max'] = elevs
-
-            print("{} segments with min > max".format(len(m2.loc[(m2.Max - m2.Min) < 0, 'Min'])))
-            m2.loc[(m2.Max - m2.Min) < 0, 'Min'] = m2.loc[(m2.Max - m2.Min) < 0, 'Max']
-
-            # get number of instances where elevation rises from end of segment to beginning of next
-            non_outlets = (self.m2.outseg != 0).values
-            m2_non_outlets = self.m2[non_outlets].copy()
-            routing_elevation_diffs = m2_non_outlets.Min.values - self.m2.Max[m2_non_outlets.outseg.values].values
-            rises = routing_elevation_diffs < 0
-            rises_df = m2_non_outlets[rises][['segment', 'outseg', 'Min']].copy()
-            rises_dnsegs = self.m2.ix[m2_non_outlets.outseg[rises].values, ['segment', 'Max']].copy()
-            rises_df['dnseg_Max'] = rises_dnsegs.Max.values
-            rises_df['rise'] = rises_df.dnseg_Max - rises_df.Min
-            print("{} segments with min < downstream segment max".format(len(rises_df)))
-            total_elevation_rise = rises_df.rise.sum()
-            print("{} total elevation rise (in model length units)".format(total_elevation_rise))
-            if total_elevation_rise == 0:
-                break
-        print("{} segments with min > max".format(len(m2.loc[(m2.Max - m2.Min) < 0, 'Min'])))
-        confluences['elev'] = elevs
+        confluences = m2.loc[has_upsegs, ['segment', 'upsegs']].copy()
+        confluences['Max'] = original_max[has_upsegs]
+        confluences['elev'] = elevmax[has_upsegs]
 
-        # get node number for each confluence by getting first node value for each segment dataframe group
+        # get node number for each confluence from reach 1 of the segment
         # (mat1 was already sorted by segment)
-        confluences['node'] = np.array([g.node.values[0] for s, g in segments])[confluences.segment.values - 1]
+        confluences['node'] = self.m1.node.values[topology.reach_start[has_upsegs]]
         self.m2 = m2
         self.confluences = confluences
 
@@ -1778,35 +2607,25 @@ class Widths(SFRdata):
 
         self.m2.in_arbolate = self.m2.in_arbolate.fillna(0) # replace any nan values with zeros
 
-        # map upsegments for each outlet segment
-        self.map_upsegs()
-
-        # compute starting arbolate sum values for all segments (sum lengths of all mapped upsegs)
-        asum_start = {}
-        for oseg in self.outsegs:
-            asum_start[oseg] = 0
-            for us in self.upsegs[oseg]:
-                # add the sum of all lengths for the upsegment
-                asum_start[oseg] += self.m1.ix[self.m1.segment == us, 'length'].sum() * self.to_km
+        topology = self.topology
+        in_arbolate = self.m2.in_arbolate.values
 
-                # add on any starting arbolate sum values from outside the model (will add zero if nothing was entered)
-                asum_start[oseg] += self.m2.in_arbolate[us]
-            #print 'outseg: {}, starting arbolate sum: {}'.format(oseg, asum_start[oseg])
+        # compute starting arbolate sum values for all segments
+        # (sum of the lengths of all upsegs, plus any starting arbolate sum values from outside the model)
+        seg_arbolate = topology.reduce_reaches(self.m1.length.values) * self.to_km + in_arbolate
+        upstream_arbolate = topology.reduce_upsegs(topology.accumulate(seg_arbolate))
 
         # assign the starting arbolate sum values to Mat2
-        asum_starts = [asum_start[i] if i in self.outsegs
-                       else self.m2.ix[i, 'in_arbolate'] for i, r in self.m2.iterrows()]
-        self.m2['starting_arbolate'] = asum_starts
+        # (segments without upsegs start with their in_arbolate value)
+        self.m2['starting_arbolate'] = np.where(topology.nupsegs > 0, upstream_arbolate, in_arbolate)
 
-        for s in self.segments:
+        # compute arbolate sum at each reach, in km, including starting values from upstream segments
+        # (Mat1 was sorted by segment and reach in __init__)
+        asums = self.m1.groupby('segment').length.cumsum().values * self.to_km + \
+                np.repeat(self.m2.starting_arbolate.values, topology.nreaches)
 
-            segdata = self.m1[self.m1.segment == s] # shouldn't need to sort, as that was done in __init__
-
-            # compute arbolate sum at each reach, in km, including starting values from upstream segments
-            asums = segdata.length.cumsum() * self.to_km + self.m2.ix[s, 'starting_arbolate']
-
-            # compute width, assign to Mat1
-            self.m1.loc[self.m1.segment == s, 'width'] = [self.widthcorrelation(asum) for asum in asums]
+        # compute width, assign to Mat1
+        self.m1['width'] = self.widthcorrelation(asums)
 
         #self.m1.to_csv(self.Mat1_out, index=False)
         print('Done')
@@ -1829,13 +2648,12 @@ class Outsegs(SFRdata):
 
         # make a dataframe of all outsegs
         if self.outsegs is None:
-            self.map_outsegs()
+            self.map_outsegs(table=True)
 
         print("Plotting elevations along segment sequences, starting with order {}...".format(minimum_order))
         o = minimum_order - 1
 
-        headwater_segments = self.m2.segment.values[np.array(
-            [i for i, u in enumerate(self.m2.upsegs) if len(u) == 0])] # segments that do not have any upsegs
+        headwater_segments = self.m2.segment.values[self.topology.nupsegs == 0] # segments that do not have any upsegs
 
         unique_seglists = self.outsegs.ix[headwater_segments]
         if o > 0:
@@ -1927,11 +2745,11 @@ class Outsegs(SFRdata):
         self.watersheds = np.empty((nrow * ncol))
         self.watersheds[:] = np.nan
 
-        for s in self.segments:
-
-            segdata = self.m1[self.m1.segment == s]
-            cns = segdata[self.node_column].values
-            self.watersheds[cns] = segdata.Outlet.values[0]
+        topology = self.topology
+        has_reaches = topology.nreaches > 0
+        outlets = self.m1.Outlet.values[topology.reach_start[has_reaches]]
+        self.watersheds[self.m1[self.node_column].values - 1] = \
+            np.repeat(outlets, topology.nreaches[has_reaches])
 
         self.watersheds = np.reshape(self.watersheds, (nrow, ncol))
 
@@ -2191,7 +3009,7 @@ class Segments(SFRdata):
             if len(new_seg_nodes) == 0:
                 continue
 
-            old_segments = np.unique(m1segments[np.in1d(m1nodes, new_seg_nodes)])
+            old_segments = np.unique(m1segments[np.isin(m1nodes, new_seg_nodes)])
             #old_segments = np.unique(self.m1.ix[self.m1.node.isin(new_seg_nodes), 'segment'])
 
             # iterate through each segment intersecting the feature
@@ -2199,11 +3017,11 @@ class Segments(SFRdata):
 
                 #print '{}\t-->\t'.format(seg),
                 # reaches that do not intersect the polygon feature
-                inds1 = (~np.in1d(m1nodes, new_seg_nodes) & (m1segments == seg))
+                inds1 = (~np.isin(m1nodes, new_seg_nodes) & (m1segments == seg))
                 #inds1 = ((~self.m1['node'].isin(new_seg_nodes)) & (m1segments == seg)).values
 
                 # reaches that intersect the polygon feature
-                inds2 = (np.in1d(m1nodes, new_seg_nodes) & (m1segments == seg))
+                inds2 = (np.isin(m1nodes, new_seg_nodes) & (m1segments == seg))
                 #inds2 = (self.m1['node'].isin(new_seg_nodes) & (m1segments == seg)).values
 
                 # renumber the reaches
@@ -2263,25 +3081,24 @@ class Segments(SFRdata):
                     #m2.loc[newseg, ['outseg', 'segment']] = outseg, newseg # update to new segment and outsegment numbers
 
         print('\nupdating routing...')
-        m2.sort(inplace=True)
+        m2.sort_index(inplace=True)
         m2['segment'] = m2.index.values
-        lastreach_numbers = [np.max(m1reaches[m1segments == s])
-                             for s in m2.segment]
-        downreaches = [downreachID[(m1segments == s) & (m1reaches == lastreach_numbers[i])][0]
-                       for i, s in enumerate(m2.segment.tolist())]
-        outsegs = [m1segments[reachID == d][0] if d != -999999 else 0
-                   for d in downreaches]
-        m2['outseg'] = outsegs
+
+        # the outseg for each segment is the segment of the reach downstream of its last reach
+        reaches = pd.DataFrame({'segment': m1segments, 'reach': m1reaches, 'downreachID': downreachID})
+        downreaches = reaches.sort_values(by=['segment', 'reach']).groupby('segment').downreachID.last()
+        downreaches = downreaches[m2.segment.values].values
+        segment_by_reachID = pd.Series(m1segments, index=reachID)
+        outsegs = segment_by_reachID.reindex(downreaches).values
+        m2['outseg'] = np.where(downreaches != -999999, outsegs, 0).astype(int)
 
         self.m1['segment'] = m1segments
         self.m1['reach'] = m1reaches
+        self.m1.sort_values(by=['segment', 'reach'], inplace=True)
         self.m2 = m2
 
-        # update upseg references in Mat2
-        self.m2['upsegs'] = [self.m2.segment[self.m2.outseg == s].tolist() for s in self.m2.segment.values]
-
-        # update outseg references in Mat1
-        self.m1['outseg'] = [self.m2.outseg[s] for s in self.m1.segment]
+        # update upseg references in Mat2, and outseg references in Mat1
+        self._update_routing_columns()
 
         print('\nDone')
 
@@ -2296,7 +3113,21 @@ class Spatial(SFRdata):
 
     def intersect_with_SFR_cells(self, intersect_df=None, intersect_shapefile=None, intersect_prj=None,
                                  sfr_shapefile=None,
-                                 node_attribute=None, GIS_mult=None):
+                                 node_attribute=None, GIS_mult=None, grid_index=None):
+        """Intersect polygon features with the SFR cells.
+
+        Parameters
+        ----------
+        grid_index : bool or gridindex.GridIndex instance, optional
+            Persistent spatial index for the model grid. If True, an index is built next to
+            the grid shapefile (mfgridshp) the first time, and reused afterwards.
+            By default (None or False), an index of the SFR cells is built in memory.
+
+        Returns
+        -------
+        dfi : DataFrame
+            Intersect features, with a column (sfr_cells) listing the intersected SFR cells.
+        """
 
         if GIS_mult is not None:
             self.GIS_mult = GIS_mult
@@ -2365,6 +3196,18 @@ class Spatial(SFRdata):
         sfr_geom = self.m1.geometry.tolist()
         sfr_nodes = self.m1.node.tolist()
         poly_geom = dfi.geometry.tolist()
+        if grid_index is False:
+            grid_index = None
+        elif grid_index is True:
+            from gridindex import GridIndex
+            grid_index = GridIndex(self.mfgridshp, node_col=self.mfgridshp_node_field)
+        if grid_index is not None:
+            # query the persistent grid index, only keeping the cells with SFR
+            sfr_cell_geoms = dict(zip(np.array(sfr_nodes) - 1, sfr_geom))
+            intersections = grid_index.intersect(poly_geom, sfr_cell_geoms)
+            dfi['sfr_cells'] = [[n + 1 for n in p] for p in intersections]
+            dfi.to_csv('waterbodies_intersected.csv')
+            return dfi
         try:
             import rtree
             intersections = GISops.intersect_rtree(sfr_geom, poly_geom)
@@ -1,12 +1,13 @@
 __author__ = 'aleaf'
+import os
 import warnings
 import time
 import operator
 import numpy as np
 import pandas as pd
 import fiona
-from shapely.geometry import Point, LineString, Polygon, shape
-from shapely.ops import unary_union
+from shapely.geometry import Point, LineString, MultiLineString, Polygon, shape, box
+from shapely.ops import unary_union, linemerge
 from GISio import shp2df, df2shp, get_proj4
 from GISops import project, projectdf, build_rtree_index, intersect_rtree
 import GISops
@@ -61,6 +62,7 @@ class linesBase(object):
         """
         self.df = lines
         self.mf_grid = mf_grid
+        self.mf_grid_node_col = mf_grid_node_col
         self.model_domain = model_domain
         self.nrow = nrows
         self.ncol = ncols
@@ -266,6 +268,7 @@ class NHDdata(object):
                       'LevelPathI', 'StreamOrde']
 
         self.mf_grid = mf_grid
+        self.mf_grid_node_col = mf_grid_node_col
         self.model_domain = model_domain
         self.nrow = nrows
         self.ncol = ncols
@@ -321,6 +324,7 @@ class NHDdata(object):
             self.grid = self.grid[['node', 'row', 'column', 'geometry']]
             self.nrow = sr.nrow
             self.ncol = sr.ncol
+            self.sr = sr
             mf_grid_node_col = 'node'
 
         # handle dataframes or shapefiles as arguments
@@ -445,8 +449,30 @@ class NHDdata(object):
     def to_sfr(self, roughness=0.037, streambed_thickness=1, streambedK=1,
                icalc=1,
                iupseg=0, iprior=0, nstrpts=0, flow=0, runoff=0, etsw=0, pptsw=0,
-               roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0):
+               roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0,
+               previous_mat1=None, previous_grid=None, previous_grid_node_col=None,
+               grid_index=None):
+        """Intersect the flowlines with the model grid, and set up the SFR
+        reach (Mat1; m1 attribute) and segment (Mat2; m2 attribute) tables.
 
+        Parameters
+        ----------
+        previous_mat1 : str (shapefile) or dataframe, optional
+            Reach linework from a previous run (e.g. written by write_linework_shapefile(),
+            or the m1 attribute of a previous NHDdata instance), with comid, segment,
+            reach, node and geometry information. If supplied with previous_grid, only the
+            flowlines near model cells that differ between previous_grid and the current grid
+            are re-intersected; reaches for all other flowlines are carried over from previous_mat1
+            (with their node numbers mapped to the current grid).
+        previous_grid : str (shapefile) or dataframe, optional
+            Model grid that was used to create previous_mat1.
+        previous_grid_node_col : str, optional
+            Column in previous_grid with unique node numbers (see mf_grid_node_col).
+        grid_index : bool or gridindex.GridIndex instance, optional
+            Persistent spatial index for the model grid. If True, an index is built
+            next to the grid shapefile (mf_grid) the first time, and reused afterwards.
+            By default, an index is built in memory for the grid cells near the flowlines.
+        """
 
         # create a working dataframe
         self.df = self.fl[self.fl_cols].join(self.pfvaa[self.pfvaa_cols], how='inner')
@@ -456,15 +482,11 @@ class NHDdata(object):
         self.df.rename(columns={'Max': 'elevMax', 'Min': 'elevMin'}, inplace=True)
 
         print('\nclipping flowlines to active area...')
-        inside = np.array([g.intersects(self.domain) for g in self.df.geometry])
-        self.df = self.df.ix[inside].copy()
         self.df.sort_values(by='COMID', inplace=True)
-        flowline_geoms = [g.intersection(self.domain) for g in self.df.geometry]
+        inside, flowline_geoms = clip_lines_to_domain(self.df.geometry.tolist(), self.domain)
+        self.df = self.df.loc[inside].copy()
         grid_geoms = self.grid.geometry.tolist()
 
-        print("intersecting flowlines with grid cells...") # this part crawls in debug mode
-        grid_intersections = GISops.intersect_rtree(grid_geoms, flowline_geoms)
-
         print("setting up segments... (may take a few minutes for large networks)")
         ta = time.time()
         self.list_updown_comids()
@@ -473,10 +495,25 @@ class NHDdata(object):
         fl_comids = self.df.COMID.tolist()
         print("finished in {:.2f}s\n".format(time.time() - ta))
 
-        print("setting up reaches and Mat1... (may take a few minutes for large grids)")
-        ta = time.time()
-        m1 = make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_geoms, tol=.001)
-        print("finished in {:.2f}s\n".format(time.time() - ta))
+        grid_index = _get_grid_index(grid_index, self.mf_grid, self.mf_grid_node_col,
+                                     sr=getattr(self, 'sr', None), mfdis=self.mfdis)
+        if previous_mat1 is not None and previous_grid is not None:
+            print("updating reaches and Mat1 from previous intersection...")
+            ta = time.time()
+            m1 = update_mat1(previous_mat1, previous_grid, grid_geoms,
+                             flowline_geoms, fl_segments, fl_comids,
+                             previous_grid_node_col=previous_grid_node_col,
+                             grid_index=grid_index, tol=.001)
+            print("finished in {:.2f}s\n".format(time.time() - ta))
+        else:
+            print("intersecting flowlines with grid cells...") # this part crawls in debug mode
+            grid_intersections = intersect_grid(grid_geoms, flowline_geoms, nrow=self.nrow, ncol=self.ncol,
+                                                grid_index=grid_index)
+
+            print("setting up reaches and Mat1... (may take a few minutes for large grids)")
+            ta = time.time()
+            m1 = make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_geoms, tol=.001)
+            print("finished in {:.2f}s\n".format(time.time() - ta))
 
         print("computing widths...")
         m1['length'] = np.array([g.length for g in m1.geometry])
@@ -632,10 +669,13 @@ class lines(linesBase):
                     roughch=roughch, roughbk=roughbk, cdepth=cdepth, fdepth=fdepth, awdth=awdth, bwdth=bwdth)
 
     def get_end_elevs_from_dem(self, dem):
-
-        from GISio import get_values_at_points
-        self.df['elevMax'] = get_values_at_points(dem, self.start_cds)
-        self.df['elevMin'] = get_values_at_points(dem, self.end_cds)
+        """Sample the DEM at the start and end of each line (see rasterops.open_raster)."""
+        from rasterops import open_raster
+        reader = open_raster(dem)
+        coords, offsets = get_line_coordinates(self.df.geometry.tolist())
+        start, end = coords[offsets[:-1]], coords[offsets[1:] - 1]
+        self.df['elevMax'] = reader.sample(start[:, 0], start[:, 1])
+        self.df['elevMin'] = reader.sample(end[:, 0], end[:, 1])
 
     def get_segment_asums(self):
         """Using allupsegs dictionary, sum lengths of all upstream segments for each segment
@@ -653,11 +693,13 @@ class lines(linesBase):
 
     @property
     def start_cds(self):
-        return [(g.xy[0][0], g.xy[1][0]) for g in self.df.geometry]
+        coords, offsets = get_line_coordinates(self.df.geometry.tolist())
+        return list(map(tuple, coords[offsets[:-1]]))
 
     @property
     def end_cds(self):
-        return [(g.xy[0][-1], g.xy[1][-1]) for g in self.df.geometry]
+        coords, offsets = get_line_coordinates(self.df.geometry.tolist())
+        return list(map(tuple, coords[offsets[1:] - 1]))
 
     def renumber_segments(self):
         """Renumber segments so that segment numbering is continuous and always increases
@@ -730,6 +772,17 @@ class lines(linesBase):
             If true, linework is routed to closest starting coordinate of an SFR segment.
             Otherwise, routing is to closest starting coordinate of an SFR reach
             (existing SFR segment in that location will have to be subdivided).
+        trim_buffer : float
+            Vertices at the outlet end of each routed line that are within trim_buffer
+            of the outlet are dropped (in case the line overlaps the SFR network),
+            before the line is connected to the start of the SFR segment or reach.
+        routing_tol : float
+            Only route lines with outlets within this distance of an SFR segment or reach start.
+
+        Returns
+        -------
+        routed : dataframe
+            outseg, outreachID and geometry columns of the df attribute
         """
         if not isinstance(sfrlinework, pd.DataFrame):
             self.sfr = shp2df(sfrlinework)
@@ -738,12 +791,14 @@ class lines(linesBase):
 
         tol = self.routing_tol if routing_tol is None else routing_tol
 
+        if 'reachID' not in self.sfr.columns:
+            self.sfr['reachID'] = np.arange(1, len(self.sfr) + 1)
         if route2reach1:
-            segments = self.sfr.ix[self.sfr.reach == 1, 'segment'].tolist()
-            geoms = self.sfr.ix[self.sfr.reach == 1, 'geometry'].tolist()
+            sfr = self.sfr.loc[self.sfr.reach == 1]
         else:
-            segments = self.sfr.segment.tolist()
-            geoms = [g for g in self.sfr.geometry]
+            sfr = self.sfr
+        segments = sfr.segment.values
+        reachIDs = sfr.reachID.values
 
         # update segment numbering so that it starts after highest seg in sfr dataset
         if len(set(self.df.segment).intersection(self.sfr.segment)) != 0:
@@ -752,78 +807,38 @@ class lines(linesBase):
             self.df.loc[self.df.outseg > 0, 'outseg'] += maxseg
             self.df['upsegs'] = [[u + maxseg for u in us] for us in self.df.upsegs.tolist()]
             self.allupsegs = get_upsegs(self.df.segment.values, self.df.outseg.values)
-            # self.allupsegs = {s + maxseg: {ss + maxseg if ss > 0 else ss for ss in v}
-            #                  for s, v in self.allupsegs.items()}
-
-        sfr_start_cds = [(g.xy[0][0], g.xy[1][0]) for g in geoms]
 
         print('routing new lines within {} to SFR...'.format(tol))
 
-        is_outlet = self.df.outseg.values == 0
-        new_lines_outlet_cds = list(map(tuple, np.array(self.end_cds)[is_outlet]))
-
-        # get index of nearest start to each end
+        # start coordinates of the SFR segments or reaches
+        sfr_coords, sfr_offsets = get_line_coordinates(sfr.geometry.tolist())
+        sfr_start_cds = sfr_coords[sfr_offsets[:-1]]
 
-        nearest_sfr = get_nearest(sfr_start_cds, new_lines_outlet_cds)
-        nearest_sfr = np.array(nearest_sfr)
-        next_sfr = np.array(sfr_start_cds)[nearest_sfr]
-        new_lines_outlet_cds = np.array(new_lines_outlet_cds)
+        # outlet (end) coordinates of new lines that aren't routed to other new lines
+        is_outlet = self.df.outseg.values == 0
+        geoms = self.df.geometry.values.copy()
+        coords, offsets = get_line_coordinates(geoms[is_outlet].tolist())
+        outlet_cds = coords[offsets[1:] - 1]
 
-        # record the preliminary seg. number of nearest start if within tol
-        outlets = np.zeros(len(self.df.loc[is_outlet, 'outseg']))
-        distances = distance(new_lines_outlet_cds, next_sfr)
+        # snap all of the outlets to the nearest SFR start in one pass
+        nearest_sfr, distances = get_nearest_points(sfr_start_cds, outlet_cds)
         within_tol = distances < tol
-        outlets[within_tol] = nearest_sfr[within_tol]
-        self.df.loc[is_outlet, 'outseg'] = outlets
-        '''
-        #self.df.loc[is_outlet, 'outseg'] = [segments[n]
-                                       if Point(*sfr_start_cds[n]).distance(\
-                                          Point(*new_lines_outlet_cds[i])) < tol
-                                       else 0 for i, n in enumerate(nearest_sfr)]
-        #if not route2reach1:
-        #reaches = self.sfr.reach.tolist()
-        '''
-        reaches = self.sfr.reach.values
-        outreaches = np.zeros(len(self.df.loc[is_outlet]))
-        outreaches[within_tol] = reaches[within_tol]
-        self.df.loc[is_outlet, 'outreachID'] = outreaches
-
-        '''
-        self.df.loc[is_outlet, 'outreachID'] = [reaches[n]
-                                   if Point(*sfr_start_cds[n]).distance(\
-                                      Point(*new_lines_outlet_cds[i])) < tol
-                                   else 0 for i, n in enumerate(nearest_sfr)]
-        '''
-
-        def fix_newline_end(line, sfr_start_coord, trim_buffer=20):
-            # trim the ends of the new lines (in case of overlap)
-            # and connect them to start of closest segment or reach on SFR network
-            diff = line.difference(Point(line.coords[-1]).buffer(trim_buffer))
-            if diff.length > 0:
-                return LineString(list(diff.coords) + [sfr_start_coord]) \
-                    if sfr_start_cds not in diff.coords else LineString(list(diff.coords))
-            return LineString([line.coords[0], sfr_start_coord])
-
-        # only connect the lines that are within the routing tolerance
-        geoms = self.df.geometry.values
 
-        '''
-        new_outlet_geoms = []
-        for i, l in enumerate(self.df.geometry[is_outlet]):
-            if within_tol[i]:
-                new_geom = fix_newline_end(l, next_sfr[i], trim_buffer=trim_buffer)
-                new_outlet_geoms.append(new_geom)
-            else:
-                new_outlet_geoms.append(i)
-        geoms[is_outlet] = new_outlet_geoms
-
-        geoms[is_outlet] = [fix_newline_end(l, sfr_start_cds[nearest_sfr[i]], trim_buffer=trim_buffer)
-                            if Point(l.coords[-1]).distance(\
-                               Point(sfr_start_cds[nearest_sfr[i]])) < tol
-                            else l
-                            for i, l in enumerate(self.df.geometry[is_outlet])]
-        '''
+        outsegs = np.zeros(len(outlet_cds), dtype=int)
+        outsegs[within_tol] = segments[nearest_sfr[within_tol]]
+        outreachIDs = np.zeros(len(outlet_cds), dtype=int)
+        outreachIDs[within_tol] = reachIDs[nearest_sfr[within_tol]]
+        self.df.loc[is_outlet, 'outseg'] = outsegs
+        self.df.loc[is_outlet, 'outreachID'] = outreachIDs
+
+        # trim the ends of the routed lines (in case of overlap)
+        # and connect them to the start of the closest segment or reach on the SFR network
+        routed = np.where(is_outlet)[0][within_tol]
+        coords, offsets = get_line_coordinates(geoms[routed].tolist())
+        geoms[routed] = trim_line_ends(coords, offsets, sfr_start_cds[nearest_sfr[within_tol]],
+                                       trim_buffer=trim_buffer)
         self.df['geometry'] = geoms
+        return self.df[['outseg', 'outreachID', 'geometry']]
 
 
     def to_sfr(self, starting_reachID=1,
@@ -831,14 +846,19 @@ class lines(linesBase):
                icalc=1,
                iupseg=0, iprior=0, nstrpts=0, flow=0, runoff=0, etsw=0, pptsw=0,
                roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0,
-               tol=0.01):
+               tol=0.01, grid_index=None):
         """Convert linework to SFR input.
 
         Creates Mat1 (m1) and Mat2 (m2) attributes.
+
+        Parameters
+        ----------
+        grid_index : bool or gridindex.GridIndex instance, optional
+            Persistent spatial index for the model grid (see NHDdata.to_sfr).
         """
 
         print('\nclipping lines to active area...')
-        inside = np.array([g.intersects(self.domain) for g in self.df.geometry])
+        inside, line_geoms = clip_lines_to_domain(self.df.geometry.tolist(), self.domain)
         self.df = self.df.loc[inside].copy()
         if 'segment' not in self.df.columns:
             self.df['segment'] = np.arange(1, len(self.df) + 1)
@@ -847,7 +867,6 @@ class lines(linesBase):
         if 'upsegs' not in self.df.columns:
             self.df['upsegs'] = [[]] * len(self.df)
 
-        line_geoms = [g.intersection(self.domain) for g in self.df.geometry]
         grid_geoms = self.grid.geometry.tolist()
 
         # segments may already be routed if appending to SFR
@@ -856,7 +875,10 @@ class lines(linesBase):
             self.route_lines_by_proximity()
 
         print("intersecting lines with grid cells...") # this part crawls in debug mode
-        grid_intersections = GISops.intersect_rtree(grid_geoms, line_geoms)
+        grid_index = _get_grid_index(grid_index, self.mf_grid, self.mf_grid_node_col,
+                                     sr=getattr(self, 'sr', None), mfdis=self.mfdis)
+        grid_intersections = intersect_grid(grid_geoms, line_geoms, nrow=self.nrow, ncol=self.ncol,
+                                            grid_index=grid_index)
 
         print("setting up reaches and Mat1... (may take a few minutes for large grids)")
         ta = time.time()
@@ -960,6 +982,41 @@ class SFRdata(object):
     def __init__(self, reach_data, segment_data):
         pass
 
+def _get_grid_index(grid_index, mf_grid=None, node_col=None, sr=None, mfdis=None):
+    """Get a persistent spatial index for the model grid (see gridindex.GridIndex).
+
+    Parameters
+    ----------
+    grid_index : bool or gridindex.GridIndex instance
+        True to get an index for mf_grid (or sr); None or False for no persistent index.
+    mf_grid : str or dataframe
+        Model grid shapefile; the index is stored next to it.
+    node_col : str
+        Attribute field in mf_grid with model node numbers.
+    sr : flopy SpatialReference, optional
+        Structured grid, if no grid shapefile was supplied.
+    mfdis : str, optional
+        MODFLOW DIS file; an index for sr is stored next to it
+        (otherwise in the current folder, with a name unique to the grid).
+
+    Returns
+    -------
+    grid_index : gridindex.GridIndex instance or None
+    """
+    if grid_index is None or grid_index is False:
+        return None
+    if grid_index is True:
+        from gridindex import GridIndex
+        if isinstance(mf_grid, str):
+            return GridIndex(mf_grid, node_col=node_col)
+        elif sr is not None:
+            basename = os.path.splitext(mfdis)[0] + '_grid_rtree' if isinstance(mfdis, str) else None
+            return GridIndex(sr, basename=basename)
+        print('A persistent grid index requires a grid shapefile or SpatialReference; '
+              'building index in memory...')
+        return None
+    return grid_index
+
 def _in_order(nseg, outseg):
     """Check that segment numbering increases in downstream direction.
 
@@ -1012,6 +1069,116 @@ def _get_outlets(segment_seguences_array):
             else i + 1
             for i, r in enumerate(segment_seguences_array.T)}
 
+def clip_lines_to_domain(geoms, domain, tile_vertices=1000):
+    """Clip lines to a model domain polygon, only computing intersections for
+    lines that cross the domain boundary.
+
+    Parameters
+    ----------
+    geoms : list of LineStrings
+    domain : Polygon or MultiPolygon
+    tile_vertices : int
+        Domains with more than this number of vertices are split into tiles,
+        each with roughly this number of vertices. Lines crossing the boundary are then
+        only intersected with the tiles they overlap.
+
+    Returns
+    -------
+    inside : 1-D array of bools
+        True for lines that intersect the domain.
+    clipped : list of geometries
+        Lines clipped to the domain, for the lines where inside is True.
+    """
+    if len(geoms) == 0:
+        return np.zeros(0, dtype=bool), []
+    geoms_array = np.empty(len(geoms), dtype=object)
+    geoms_array[:] = geoms
+
+    # classify the lines as fully inside, fully outside, or crossing the boundary,
+    # using the (prepared) domain for the predicates
+    try:
+        # vectorized in shapely 2
+        import shapely
+        shapely.prepare(domain)
+        within = shapely.contains(domain, geoms_array)
+        intersects = shapely.intersects(domain, geoms_array)
+    except (ImportError, AttributeError):
+        from shapely.prepared import prep
+        pdomain = prep(domain)
+        intersects = np.array([pdomain.intersects(g) for g in geoms])
+        within = intersects & np.array([pdomain.contains(g) for g in geoms])
+    crossing = intersects & ~within
+
+    clipped = geoms_array.copy()
+    crossing_inds = np.where(crossing)[0]
+    if len(crossing_inds) == 0:
+        return intersects, clipped[intersects].tolist()
+    tiles = tile_polygon(domain, tile_vertices=tile_vertices)
+    if len(tiles) == 1:
+        clipped[crossing_inds] = [geoms_array[i].intersection(domain) for i in crossing_inds]
+    else:
+        # intersect the crossing lines with only the tiles that they overlap
+        tile_bounds = np.array([t.bounds for t in tiles])
+        for i in crossing_inds:
+            g = geoms_array[i]
+            if not g.is_simple:
+                # the tile pieces of a self-crossing line can't be merged back into its parts unambiguously
+                clipped[i] = g.intersection(domain)
+                continue
+            minx, miny, maxx, maxy = g.bounds
+            overlapping = (tile_bounds[:, 0] <= maxx) & (tile_bounds[:, 2] >= minx) & \
+                          (tile_bounds[:, 1] <= maxy) & (tile_bounds[:, 3] >= miny)
+            pieces = []
+            for t in np.where(overlapping)[0]:
+                piece = g.intersection(tiles[t])
+                if piece.length > 0:
+                    pieces.append(piece)
+            if len(pieces) == 0:
+                clipped[i] = g.intersection(domain)
+                continue
+            union = unary_union(pieces)
+            parts = [part for part in getattr(union, 'geoms', [union]) if part.geom_type == 'LineString']
+            merged = linemerge(parts) if len(parts) > 1 else parts[0]
+            if merged.geom_type == 'MultiLineString':
+                # put the parts back in their order along the line (as returned by g.intersection(domain)),
+                # so that reaches are numbered in the downstream direction
+                parts = sorted(merged.geoms, key=lambda part: g.project(Point(part.coords[0])))
+                merged = MultiLineString(parts)
+            clipped[i] = merged
+    return intersects, clipped[intersects].tolist()
+
+def tile_polygon(polygon, tile_vertices=1000):
+    """Split a polygon with many vertices into a grid of tiles.
+
+    Parameters
+    ----------
+    polygon : Polygon or MultiPolygon
+    tile_vertices : int
+        Approximate number of vertices in each tile.
+
+    Returns
+    -------
+    tiles : list of Polygons or MultiPolygons
+        Non-empty intersections of polygon with a regular grid of boxes covering its extent.
+        If polygon has tile_vertices or fewer vertices, a list containing only polygon is returned.
+    """
+    polygons = polygon.geoms if hasattr(polygon, 'geoms') else [polygon]
+    nvertices = np.sum([len(p.exterior.coords) + np.sum([len(i.coords) for i in p.interiors])
+                        for p in polygons])
+    if nvertices <= tile_vertices:
+        return [polygon]
+    ntiles = int(np.ceil(np.sqrt(nvertices / float(tile_vertices))))
+    minx, miny, maxx, maxy = polygon.bounds
+    x = np.linspace(minx, maxx, ntiles + 1)
+    y = np.linspace(miny, maxy, ntiles + 1)
+    tiles = []
+    for i in range(ntiles):
+        for j in range(ntiles):
+            tile = polygon.intersection(box(x[j], y[i], x[j+1], y[i+1]))
+            if tile.area > 0:
+                tiles.append(tile)
+    return tiles
+
 def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     """Creates SFR reaches for a segment by ordering model cells intersected by a LineString
 
@@ -1151,6 +1318,246 @@ def get_nearest(starts, ends):
     #        for i, end in enumerate(ends)]
     return nearest
 
+def get_line_coordinates(geoms):
+    """Get the coordinates of a sequence of LineStrings as a single array.
+
+    Parameters
+    ----------
+    geoms : list of LineStrings
+
+    Returns
+    -------
+    coords : 2-D array
+        x, y coordinates of all the vertices, line after line.
+    offsets : 1-D array
+        Index of the first vertex of each line in coords, with the total number of vertices
+        appended (so that the vertices for line i are coords[offsets[i]:offsets[i+1]]).
+    """
+    if len(geoms) == 0:
+        return np.zeros((0, 2)), np.zeros(1, dtype=int)
+    try:
+        # vectorized in shapely 2
+        from shapely import get_coordinates
+        coords, index = get_coordinates(np.array(geoms, dtype=object), return_index=True)
+        nvertices = np.bincount(index, minlength=len(geoms))
+    except ImportError:
+        line_coords = [np.vstack([np.array(p.coords)[:, :2] for p in getattr(g, 'geoms', [g])])
+                       for g in geoms]
+        coords = np.vstack(line_coords)
+        nvertices = np.array([len(c) for c in line_coords])
+    offsets = np.append(0, np.cumsum(nvertices))
+    return coords, offsets
+
+def get_candidate_cells(grid_geoms, line_geoms, nrow=None, ncol=None):
+    """Get the model cells that could intersect a set of lines,
+    using the envelopes of the individual line segments (pairs of vertices).
+
+    Parameters
+    ----------
+    grid_geoms : list of Polygons
+        Model grid cell polygons, sorted by node number.
+    line_geoms : list of LineStrings or MultiLineStrings
+    nrow : int, optional
+        (structured grids) Number of model rows
+    ncol : int, optional
+        (structured grids) Number of model columns
+
+    Returns
+    -------
+    candidates : 1-D array
+        Sorted zero-based indices of the cells in grid_geoms that may intersect the lines.
+
+    Notes
+    -----
+    For unrotated structured grids, the row and column edges are taken from the cells in the first
+    column and row, and the candidate rows and columns are computed arithmetically. Otherwise,
+    the cell envelopes are binned onto a regular lattice with spacing equal to the largest cell dimension.
+    """
+    if len(line_geoms) == 0:
+        return np.zeros(0, dtype=int)
+    coords, offsets = get_line_coordinates(line_geoms)
+    # envelopes of the segments between consecutive vertices on the same line
+    # (single-vertex lines are represented by a zero-length segment)
+    same_line = np.ones(max(len(coords) - 1, 0), dtype=bool)
+    same_line[offsets[1:-1] - 1] = False
+    single = offsets[:-1][np.diff(offsets) == 1]
+    j = np.append(np.where(same_line)[0], single)
+    j1 = np.append(np.where(same_line)[0] + 1, single)
+    xmin = np.minimum(coords[j, 0], coords[j1, 0])
+    xmax = np.maximum(coords[j, 0], coords[j1, 0])
+    ymin = np.minimum(coords[j, 1], coords[j1, 1])
+    ymax = np.maximum(coords[j, 1], coords[j1, 1])
+
+    if nrow is not None and ncol is not None and nrow * ncol == len(grid_geoms):
+        # row and column edges from the first column and row of cells
+        col_bounds = np.array([g.bounds for g in grid_geoms[:ncol]])
+        row_bounds = np.array([g.bounds for g in grid_geoms[::ncol]])
+        xedges = np.append(col_bounds[:, 0], col_bounds[-1, 2])
+        yedges = np.append(row_bounds[:, 3], row_bounds[-1, 1]) # decreasing with row
+        last = np.array(grid_geoms[-1].bounds)
+        unrotated = np.allclose(col_bounds[:, 1], col_bounds[0, 1]) and \
+                    np.allclose(row_bounds[:, 0], row_bounds[0, 0]) and \
+                    np.allclose(last, [xedges[-2], yedges[-1], xedges[-1], yedges[-2]]) and \
+                    np.all(np.diff(xedges) > 0) and np.all(np.diff(yedges) < 0)
+        if unrotated:
+            c0 = np.searchsorted(xedges, xmin, side='right') - 1
+            c1 = np.searchsorted(xedges, xmax, side='left') - 1
+            r0 = np.searchsorted(-yedges, -ymax, side='right') - 1
+            r1 = np.searchsorted(-yedges, -ymin, side='left') - 1
+            c0, r0 = np.clip(c0, 0, ncol - 1), np.clip(r0, 0, nrow - 1)
+            c1, r1 = np.clip(c1, 0, ncol - 1), np.clip(r1, 0, nrow - 1)
+            c1, r1 = np.maximum(c0, c1), np.maximum(r0, r1)
+            return np.unique(_expand_ranges(r0, r1, c0, c1, ncol))
+
+    # generic (rotated or unstructured) grids
+    try:
+        from shapely import bounds
+        grid_bounds = bounds(np.array(grid_geoms, dtype=object))
+    except ImportError:
+        grid_bounds = np.array([g.bounds for g in grid_geoms])
+    binsize = np.max([grid_bounds[:, 2] - grid_bounds[:, 0], grid_bounds[:, 3] - grid_bounds[:, 1]])
+    x0 = min(grid_bounds[:, 0].min(), xmin.min())
+    y0 = min(grid_bounds[:, 1].min(), ymin.min())
+    nx = int(np.floor((max(grid_bounds[:, 2].max(), xmax.max()) - x0) / binsize)) + 1
+    ny = int(np.floor((max(grid_bounds[:, 3].max(), ymax.max()) - y0) / binsize)) + 1
+
+    # mark the bins touched by the line segment envelopes
+    covered = np.zeros(nx * ny, dtype=bool)
+    covered[_expand_ranges(np.floor((ymin - y0) / binsize).astype(int),
+                           np.floor((ymax - y0) / binsize).astype(int),
+                           np.floor((xmin - x0) / binsize).astype(int),
+                           np.floor((xmax - x0) / binsize).astype(int), nx)] = True
+
+    # cells span at most 2 bins in each direction; check the bins at each corner
+    bx0 = np.floor((grid_bounds[:, 0] - x0) / binsize).astype(int)
+    bx1 = np.floor((grid_bounds[:, 2] - x0) / binsize).astype(int)
+    by0 = np.floor((grid_bounds[:, 1] - y0) / binsize).astype(int)
+    by1 = np.floor((grid_bounds[:, 3] - y0) / binsize).astype(int)
+    candidate = covered[by0 * nx + bx0] | covered[by0 * nx + bx1] | \
+                covered[by1 * nx + bx0] | covered[by1 * nx + bx1]
+    return np.where(candidate)[0]
+
+def _expand_ranges(r0, r1, c0, c1, ncol):
+    """Flat (row-major) indices of all cells within a set of row and column ranges
+    (inclusive), without looping over the ranges.
+    """
+    nc = c1 - c0 + 1
+    ncells = (r1 - r0 + 1) * nc
+    rect = np.repeat(np.arange(len(ncells)), ncells)
+    k = np.arange(ncells.sum()) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+    rows = r0[rect] + k // nc[rect]
+    cols = c0[rect] + k % nc[rect]
+    return rows * ncol + cols
+
+def intersect_grid(grid_geoms, line_geoms, nrow=None, ncol=None, grid_index=None):
+    """Intersect lines with model grid cells, only indexing the cells near the lines
+    (unless a persistent index for the whole grid is supplied).
+
+    Parameters
+    ----------
+    grid_geoms : list of Polygons
+        Model grid cell polygons, sorted by node number.
+    line_geoms : list of LineStrings or MultiLineStrings
+    nrow : int, optional
+        (structured grids) Number of model rows
+    ncol : int, optional
+        (structured grids) Number of model columns
+    grid_index : gridindex.GridIndex instance, optional
+        Persistent spatial index for the grid.
+
+    Returns
+    -------
+    intersections : list of lists
+        Zero-based indices of the cells in grid_geoms intersecting each line.
+    """
+    if grid_index is not None:
+        return grid_index.intersect(line_geoms, grid_geoms)
+    candidates = get_candidate_cells(grid_geoms, line_geoms, nrow=nrow, ncol=ncol)
+    print("indexing {} of {} grid cells near the lines...".format(len(candidates), len(grid_geoms)))
+    intersections = GISops.intersect_rtree([grid_geoms[i] for i in candidates], line_geoms)
+    return [candidates[np.array(i, dtype=int)].tolist() for i in intersections]
+
+def get_nearest_points(points, query_points):
+    """Returns index of nearest coordinate in points to each coordinate in query_points,
+    and the distance between them.
+
+    Parameters
+    ----------
+    points : 2-D array of x, y coordinates
+    query_points : 2-D array of x, y coordinates
+    """
+    points = np.asarray(points, dtype=float)
+    query_points = np.asarray(query_points, dtype=float)
+    if len(query_points) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    try:
+        from scipy.spatial import cKDTree
+        distances, nearest = cKDTree(points).query(query_points)
+    except ImportError:
+        try:
+            from rtree import index
+        except:
+            raise ImportError("This method requires the scipy or rtree package.")
+        idx = index.Index()
+        for i, p in enumerate(points):
+            idx.insert(i, tuple(p) + tuple(p))
+        nearest = np.array([next(idx.nearest(tuple(p) + tuple(p), 1)) for p in query_points])
+        distances = distance(query_points, points[nearest])
+    return np.asarray(nearest, dtype=int), distances
+
+def trim_line_ends(coords, offsets, end_cds, trim_buffer=20):
+    """Drop the vertices at the end of each line that are within trim_buffer
+    of the line's end, and connect the line to a new end point.
+
+    Parameters
+    ----------
+    coords : 2-D array
+        Coordinates of the lines, as returned by get_line_coordinates().
+    offsets : 1-D array
+        Starting index of each line in coords, as returned by get_line_coordinates().
+    end_cds : 2-D array
+        New end coordinate for each line.
+    trim_buffer : float
+        Distance from the current end of each line within which vertices are dropped.
+        The first vertex of each line is always retained.
+
+    Returns
+    -------
+    geoms : list of LineStrings
+    """
+    nlines = len(offsets) - 1
+    if nlines == 0:
+        return []
+    end_cds = np.asarray(end_cds, dtype=float)
+    nvertices = np.diff(offsets)
+    line_index = np.repeat(np.arange(nlines), nvertices)
+    vertex_index = np.arange(len(coords)) - offsets[line_index]
+
+    # last vertex of each line that is outside of the buffer around the line end
+    old_ends = coords[offsets[1:] - 1]
+    outside = distance(coords, old_ends[line_index]) > trim_buffer
+    outside[offsets[:-1]] = True
+    last_kept = np.maximum.reduceat(np.where(outside, vertex_index, 0), offsets[:-1])
+
+    # keep vertices up to and including the last one outside of the buffer,
+    # then append the new end (unless it duplicates the last retained vertex)
+    keep = vertex_index <= last_kept[line_index]
+    kept_coords = coords[keep]
+    kept_index = line_index[keep]
+    last_kept_cds = coords[offsets[:-1] + last_kept]
+    add_end = np.any(last_kept_cds != end_cds, axis=1) | (last_kept == 0)
+
+    new_coords = np.vstack([kept_coords, end_cds[add_end]])
+    new_index = np.append(kept_index, np.arange(nlines)[add_end])
+    order = np.argsort(new_index, kind='mergesort')
+    new_coords, new_index = new_coords[order], new_index[order]
+    new_offsets = np.append(0, np.cumsum(np.bincount(new_index, minlength=nlines)))
+    try:
+        from shapely import linestrings
+        return list(linestrings(new_coords, indices=new_index))
+    except ImportError:
+        return [LineString(new_coords[new_offsets[i]:new_offsets[i+1]]) for i in range(nlines)]
+
 def get_upsegs(nseg, outseg):
     """From segment_data, returns nested dict of containing sets of all
     segments upstream of each segment.
@@ -1311,6 +1718,148 @@ def make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_g
     m1['reachID'] = np.arange(len(m1)) + 1
     return m1
 
+def match_grid_cells(previous_grid_geoms, grid_geoms, decimals=4):
+    """Match cells in two versions of a model grid (e.g. before and after local refinement)
+    by their bounding boxes.
+
+    Parameters
+    ----------
+    previous_grid_geoms : list of Polygons
+        Cell polygons of the previous grid, sorted by node number.
+    grid_geoms : list of Polygons
+        Cell polygons of the current grid, sorted by node number.
+    decimals : int
+        Number of decimal places to round the cell bounds to before comparing them.
+
+    Returns
+    -------
+    previous2new : 1-D array
+        Zero-based index of the matching cell in grid_geoms for each cell in previous_grid_geoms
+        (-1 if the cell changed).
+    new_changed : 1-D array of bools
+        True for cells in grid_geoms without a match in previous_grid_geoms.
+    """
+    bounds_cols = ['minx', 'miny', 'maxx', 'maxy']
+    old = pd.DataFrame(np.round([g.bounds for g in previous_grid_geoms], decimals), columns=bounds_cols)
+    old['old_ind'] = np.arange(len(old))
+    new = pd.DataFrame(np.round([g.bounds for g in grid_geoms], decimals), columns=bounds_cols)
+    new['new_ind'] = np.arange(len(new))
+
+    # cells with identical bounds in both grids are considered unchanged
+    old.drop_duplicates(subset=bounds_cols, keep=False, inplace=True)
+    new.drop_duplicates(subset=bounds_cols, keep=False, inplace=True)
+    matched = old.merge(new, on=bounds_cols, how='inner')
+
+    previous2new = -np.ones(len(previous_grid_geoms), dtype=int)
+    previous2new[matched.old_ind.values] = matched.new_ind.values
+    new_changed = np.ones(len(grid_geoms), dtype=bool)
+    new_changed[matched.new_ind.values] = False
+    return previous2new, new_changed
+
+def update_mat1(previous_mat1, previous_grid, grid_geoms,
+                flowline_geoms, fl_segments, fl_comids,
+                previous_grid_node_col=None, grid_index=None, tol=0.01):
+    """Update a previous set of SFR reaches after local changes to the model grid
+    or active area, re-intersecting only the flowlines affected by the changes.
+
+    Parameters
+    ----------
+    previous_mat1 : str (shapefile) or dataframe
+        Reaches from a previous intersection, with comid, reach, node and geometry columns.
+    previous_grid : str (shapefile) or dataframe
+        Model grid used for previous_mat1.
+    grid_geoms : list of Polygons
+        Current model grid cell polygons, sorted by node number.
+    flowline_geoms : list of LineStrings
+        Flowlines (clipped to the active area).
+    fl_segments : list of ints
+        Segment numbers for each flowline.
+    fl_comids : list of ints
+        COMIDs for each flowline.
+    previous_grid_node_col : str, optional
+        Column in previous_grid with unique node numbers.
+    grid_index : gridindex.GridIndex instance, optional
+        Persistent spatial index for the current grid.
+
+    Returns
+    -------
+    m1 : dataframe
+        Mat1 table (same format as make_mat1), with node numbers referencing the current grid.
+
+    Notes
+    -----
+    Flowlines are re-intersected if their bounding box touches a changed model cell (in either grid),
+    if they aren't in previous_mat1, or if their clipped length differs from the total length of their
+    previous reaches (i.e., the active area changed). Reaches for all other flowlines are
+    carried over, so reach numbering within those segments is unchanged.
+    """
+    try:
+        from rtree import index
+    except:
+        raise ImportError("This method requires the rtree package.")
+
+    if isinstance(previous_mat1, pd.DataFrame):
+        prev = previous_mat1.copy()
+    else:
+        prev = shp2df(previous_mat1)
+    if isinstance(previous_grid, pd.DataFrame):
+        prev_grid = previous_grid
+    else:
+        prev_grid = shp2df(previous_grid)
+    if previous_grid_node_col is not None:
+        prev_grid = prev_grid.sort_values(by=previous_grid_node_col)
+    previous_grid_geoms = prev_grid.geometry.tolist()
+
+    previous2new, new_changed = match_grid_cells(previous_grid_geoms, grid_geoms)
+    changed = [previous_grid_geoms[i] for i in np.where(previous2new < 0)[0]] + \
+              [grid_geoms[i] for i in np.where(new_changed)[0]]
+
+    # index the bounds of the changed cells
+    idx = index.Index()
+    for i, g in enumerate(changed):
+        idx.insert(i, g.bounds)
+
+    # total length of the previous reaches for each comid
+    prev_lengths = prev.groupby('comid').geometry.agg(lambda x: np.sum([g.length for g in x]))
+    # flowlines with any previous reaches in changed cells
+    prev_in_changed = set(prev.comid.values[previous2new[prev.node.values.astype(int) - 1] < 0])
+
+    affected = np.zeros(len(flowline_geoms), dtype=bool)
+    for i, g in enumerate(flowline_geoms):
+        comid = fl_comids[i]
+        if comid not in prev_lengths.index or comid in prev_in_changed:
+            affected[i] = True
+        elif not np.isclose(g.length, prev_lengths[comid], rtol=1e-6):
+            affected[i] = True
+        elif len(changed) > 0 and len(list(idx.intersection(g.bounds))) > 0:
+            affected[i] = True
+    print("re-intersecting {} of {} flowlines affected by changes to the grid or active area..."
+          .format(affected.sum(), len(affected)))
+
+    # new reaches for the affected flowlines
+    affected_inds = np.where(affected)[0]
+    affected_geoms = [flowline_geoms[i] for i in affected_inds]
+    grid_intersections = intersect_grid(grid_geoms, affected_geoms, grid_index=grid_index)
+    m1_new = make_mat1(affected_geoms,
+                       [fl_segments[i] for i in affected_inds],
+                       [fl_comids[i] for i in affected_inds],
+                       grid_intersections, grid_geoms, tol=tol)
+
+    # carry over the reaches for the remaining flowlines
+    # (segment numbers are reassigned from the current flowlines, nodes are mapped to the current grid)
+    segments = dict(zip(fl_comids, fl_segments))
+    unaffected_comids = set(np.array(fl_comids)[~affected])
+    m1_prev = prev.loc[prev.comid.isin(unaffected_comids), ['reach', 'comid', 'node', 'geometry']].copy()
+    m1_prev['segment'] = m1_prev.comid.map(segments).astype(int)
+    m1_prev['node'] = previous2new[m1_prev.node.values.astype(int) - 1] + 1
+
+    m1 = pd.concat([m1_new[['reach', 'segment', 'node', 'geometry', 'comid']],
+                    m1_prev[['reach', 'segment', 'node', 'geometry', 'comid']]])
+    m1.sort_values(by=['segment', 'reach'], inplace=True)
+    m1.index = np.arange(len(m1))
+    m1['reachID'] = np.arange(len(m1)) + 1
+    return m1
+
 def renumber_segments(nseg, outseg):
     """Renumber segments so that segment numbering is continuous, starts at 1, and always increases
         in the downstream direction. Experience suggests that this can substantially speed
@@ -0,0 +1,487 @@
+__author__ = 'aleaf'
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+try:
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.windows import Window
+except:
+    print('Warning: rasterio not imported.')
+
+
+def _geometry_bounds(geoms):
+    """Array of (minx, miny, maxx, maxy) for a sequence of shapely geometries."""
+    try:
+        import shapely
+        return shapely.bounds(np.asarray(geoms, dtype=object))
+    except (ImportError, AttributeError):
+        return np.array([g.bounds for g in geoms])
+
+
+def _geometry_hash(geoms, nodes):
+    """md5 hash of the geometries (well-known binary) and their node numbers."""
+    md5 = hashlib.md5()
+    md5.update(np.asarray(nodes, dtype=np.int64).tobytes())
+    try:
+        import shapely
+        wkb = shapely.to_wkb(np.asarray(geoms, dtype=object))
+    except (ImportError, AttributeError):
+        wkb = [g.wkb for g in geoms]
+    for b in wkb:
+        md5.update(b)
+    return md5.hexdigest()
+
+
+class CellPixelIndex(object):
+
+    def __init__(self, geoms, raster, nodes=None, basename=None, rebuild=False, tile_size=1024):
+        """Persistent (file-backed) index of the raster pixels within each model cell.
+
+        The cell polygons are rasterized once, a tile of the raster at a time, and the row and column
+        of every pixel with its center in each cell are stored in compressed sparse row form
+        (the pixels for cell i are rows[indptr[i]:indptr[i+1]], cols[indptr[i]:indptr[i+1]]).
+        Cells too small to contain any pixel centers are assigned the pixel containing their centroid.
+        The index is written to <basename>.npz, with a metadata file (<basename>.json) recording the
+        raster modification time, size, and geometry, and a hash of the cell geometries;
+        it is rebuilt if any of these change.
+
+        Parameters
+        ----------
+        geoms : sequence of shapely Polygons
+            Model cell geometries (each cell only once, e.g. the unique cells containing SFR reaches),
+            in the raster coordinate system.
+        raster : str
+            Raster file (any format supported by GDAL).
+        nodes : sequence of ints, optional
+            Node numbers for the cells; by default cells are numbered in the order they are supplied.
+        basename : str, optional
+            Path (without extension) for the index files. By default the index is stored next to the raster,
+            with a name including the hash of the cell geometries (so that indices for different grids
+            or sets of cells can coexist).
+        rebuild : bool
+            Rebuild the index even if an up-to-date index is found.
+        tile_size : int
+            Number of raster rows and columns in each tile that is rasterized (or read) at once.
+        """
+        self.raster = raster
+        self.nodes = np.arange(1, len(geoms) + 1) if nodes is None else np.asarray(nodes, dtype=int)
+        self.tile_size = tile_size
+        self.geom_hash = _geometry_hash(geoms, self.nodes)
+        if basename is None:
+            basename = '{}_cellpixels_{}'.format(os.path.splitext(raster)[0], self.geom_hash[:10])
+        self.basename = basename
+        self.metadata_file = basename + '.json'
+
+        if rebuild or not self.is_valid():
+            self.build(geoms)
+        else:
+            print('using cell to pixel index {}.npz'.format(self.basename))
+            self.load()
+
+    def _file_info(self):
+        with rasterio.open(self.raster) as src:
+            return {'mtime': os.path.getmtime(self.raster),
+                    'size': os.path.getsize(self.raster),
+                    'transform': list(src.transform)[:6],
+                    'shape': [src.height, src.width],
+                    'geom_hash': self.geom_hash}
+
+    def is_valid(self):
+        """Check that an index exists, and that it was built from the current raster and cells."""
+        if not os.path.exists(self.metadata_file) or not os.path.exists(self.basename + '.npz'):
+            return False
+        with open(self.metadata_file) as src:
+            metadata = json.load(src)
+        return metadata == self._file_info()
+
+    def load(self):
+        with np.load(self.basename + '.npz') as data:
+            self.indptr = data['indptr']
+            self.rows = data['rows']
+            self.cols = data['cols']
+
+    def save(self):
+        np.savez(self.basename + '.npz', indptr=self.indptr, rows=self.rows, cols=self.cols)
+        with open(self.metadata_file, 'w') as dest:
+            json.dump(self._file_info(), dest)
+
+    def build(self, geoms):
+        print('building cell to pixel index {}.npz (only needs to be done once)...'.format(self.basename))
+        with rasterio.open(self.raster) as src:
+            transform = src.transform
+            height, width = src.height, src.width
+
+        # pixel rows and columns spanned by each cell
+        bounds = _geometry_bounds(geoms)
+        inverse = ~transform
+        c0, r0 = inverse * (bounds[:, 0], bounds[:, 3])
+        c1, r1 = inverse * (bounds[:, 2], bounds[:, 1])
+        row0 = np.clip(np.floor(np.minimum(r0, r1)).astype(int), 0, height)
+        row1 = np.clip(np.ceil(np.maximum(r0, r1)).astype(int), 0, height)
+        col0 = np.clip(np.floor(np.minimum(c0, c1)).astype(int), 0, width)
+        col1 = np.clip(np.ceil(np.maximum(c0, c1)).astype(int), 0, width)
+
+        # rasterize the cells a tile at a time (cells are grouped by the tile containing their upper left pixel);
+        # cells don't overlap, so each pixel is assigned to at most one cell
+        tiles = (row0 // self.tile_size) * (width // self.tile_size + 1) + col0 // self.tile_size
+        inside = (row1 > row0) & (col1 > col0)
+        cells, rows, cols = [], [], []
+        for tile in np.unique(tiles[inside]):
+            tile_cells = np.where(inside & (tiles == tile))[0]
+            window = Window(col0[tile_cells].min(), row0[tile_cells].min(),
+                            col1[tile_cells].max() - col0[tile_cells].min(),
+                            row1[tile_cells].max() - row0[tile_cells].min())
+            burned = rasterize([(geoms[i], n + 1) for n, i in enumerate(tile_cells)],
+                               out_shape=(int(window.height), int(window.width)),
+                               transform=rasterio.windows.transform(window, transform),
+                               fill=0, dtype='int32')
+            r, c = np.nonzero(burned)
+            cells.append(tile_cells[burned[r, c] - 1])
+            rows.append(r + int(window.row_off))
+            cols.append(c + int(window.col_off))
+
+        # cells without any pixel centers get the pixel containing the centroid
+        cells = np.concatenate(cells) if len(cells) > 0 else np.array([], dtype=int)
+        empty = np.setdiff1d(np.arange(len(geoms)), cells)
+        if len(empty) > 0:
+            cx = 0.5 * (bounds[empty, 0] + bounds[empty, 2])
+            cy = 0.5 * (bounds[empty, 1] + bounds[empty, 3])
+            c, r = inverse * (cx, cy)
+            r, c = np.floor(r).astype(int), np.floor(c).astype(int)
+            on_raster = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+            cells = np.concatenate((cells, empty[on_raster]))
+            rows.append(r[on_raster])
+            cols.append(c[on_raster])
+
+        rows = np.concatenate(rows) if len(rows) > 0 else np.array([], dtype=int)
+        cols = np.concatenate(cols) if len(cols) > 0 else np.array([], dtype=int)
+        order = np.argsort(cells, kind='mergesort')
+        self.rows = rows[order].astype(np.int32)
+        self.cols = cols[order].astype(np.int32)
+        counts = np.bincount(cells, minlength=len(geoms))
+        self.indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.save()
+
+    @property
+    def counts(self):
+        """Number of pixels in each cell."""
+        return np.diff(self.indptr)
+
+    def chunks(self):
+        """Groups of cells by raster tile (cells are grouped by the tile containing their first pixel).
+        Yields the cells (positions in nodes), the positions of their pixels in rows and cols
+        (consecutive by cell), and the window of the raster (row_off, col_off, height, width)
+        containing all of the pixels."""
+        counts = self.counts
+        if len(self.rows) == 0:
+            return
+        has_pixels = np.where(counts > 0)[0]
+        first = self.indptr[:-1][has_pixels]
+        ntile_cols = self.cols.max() // self.tile_size + 1
+        cell_tiles = np.zeros(len(counts), dtype=int)
+        cell_tiles[has_pixels] = (self.rows[first] // self.tile_size) * ntile_cols + \
+                                 self.cols[first] // self.tile_size
+        pixel_tiles = np.repeat(cell_tiles, counts)
+
+        # sorting by tile keeps the pixels in each tile in cell order
+        pixels = np.argsort(pixel_tiles, kind='mergesort')
+        cells = has_pixels[np.argsort(cell_tiles[has_pixels], kind='mergesort')]
+        tiles, cell_counts = np.unique(cell_tiles[cells], return_counts=True)
+        pixel_counts = np.bincount(np.searchsorted(tiles, pixel_tiles), minlength=len(tiles))
+        cell_stop, pixel_stop = np.cumsum(cell_counts), np.cumsum(pixel_counts)
+        for i in range(len(tiles)):
+            tile_cells = cells[cell_stop[i] - cell_counts[i]:cell_stop[i]]
+            tile_pixels = pixels[pixel_stop[i] - pixel_counts[i]:pixel_stop[i]]
+            rows, cols = self.rows[tile_pixels], self.cols[tile_pixels]
+            window = (int(rows.min()), int(cols.min()),
+                      int(rows.max() - rows.min() + 1), int(cols.max() - cols.min() + 1))
+            yield tile_cells, tile_pixels, window
+
+
+class RasterReader(object):
+
+    def __init__(self, raster, band=1, max_tiles=128, tile_shape=None):
+        """Read access to one band of a raster (e.g. a DEM, or a VRT mosaic of DEMs), through a bounded,
+        least-recently-used cache of tiles. Tiles are aligned with the raster blocks, so that
+        repeated and overlapping queries don't reread or redecode the same blocks.
+        Use open_raster() to share a reader between routines working with the same raster.
+
+        Parameters
+        ----------
+        raster : str
+            Raster file (any format supported by GDAL).
+        band : int
+            Raster band to read.
+        max_tiles : int
+            Maximum number of tiles to keep in memory.
+        tile_shape : tuple, optional
+            (rows, columns) in each tile. By default, whole raster blocks, at least 256 pixels on a side
+            (e.g. several strips for rasters stored in single-row strips).
+        """
+        self.raster = raster
+        self.band = band
+        self.src = rasterio.open(raster)
+        self.mtime = os.path.getmtime(raster) if os.path.exists(raster) else None
+        self.transform = self.src.transform
+        self.height, self.width = self.src.height, self.src.width
+        if tile_shape is None:
+            bh, bw = self.src.block_shapes[band - 1]
+            tile_shape = (bh * int(np.ceil(256. / bh)), bw * int(np.ceil(256. / bw)))
+        self.tile_shape = tile_shape
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+
+    def close(self):
+        self._tiles.clear()
+        self.src.close()
+
+    def tile(self, i, j):
+        """Raster values (float, with nodata as nan) in tile row i, column j."""
+        key = (i, j)
+        if key in self._tiles:
+            data = self._tiles.pop(key)
+        else:
+            th, tw = self.tile_shape
+            window = Window(j * tw, i * th, min(tw, self.width - j * tw), min(th, self.height - i * th))
+            data = self.src.read(self.band, window=window, masked=True).astype(float).filled(np.nan)
+            if len(self._tiles) >= self.max_tiles:
+                self._tiles.popitem(last=False)
+        self._tiles[key] = data
+        return data
+
+    def values_at(self, rows, cols):
+        """Raster values at zero-based pixel rows and columns; nan for nodata or pixels off of the raster."""
+        rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+        values = np.empty(len(rows))
+        values[:] = np.nan
+        on_raster = np.where((rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width))[0]
+        th, tw = self.tile_shape
+        ntile_cols = (self.width - 1) // tw + 1
+        tiles = (rows[on_raster] // th) * ntile_cols + cols[on_raster] // tw
+        order = np.argsort(tiles, kind='mergesort')
+        tiles, starts = np.unique(tiles[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        for tile, start, stop in zip(tiles, starts, stops):
+            i, j = divmod(tile, ntile_cols)
+            pos = on_raster[order[start:stop]]
+            values[pos] = self.tile(i, j)[rows[pos] - i * th, cols[pos] - j * tw]
+        return values
+
+    def sample(self, x, y):
+        """Raster values at points (sequences of x and y coordinates in the raster coordinate system)."""
+        cols, rows = ~self.transform * (np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        return self.values_at(np.floor(rows).astype(int), np.floor(cols).astype(int))
+
+
+_readers = {}
+
+
+def open_raster(raster, band=1, max_tiles=128):
+    """Get a RasterReader for a raster band, shared by all callers (in the current process);
+    the raster is only reopened if it has been modified."""
+    key = (raster, band)
+    reader = _readers.get(key)
+    mtime = os.path.getmtime(raster) if os.path.exists(raster) else None
+    if reader is None or reader.mtime != mtime:
+        if reader is not None:
+            reader.close()
+        reader = RasterReader(raster, band=band, max_tiles=max_tiles)
+        _readers[key] = reader
+    return reader
+
+
+def _zonal_chunk(args):
+    """Compute zonal statistics for a group of cells in one tile of the raster."""
+    raster, band, rows, cols, counts = args
+    values = open_raster(raster, band).values_at(rows, cols)
+    return _reduce_pixels(values, counts)
+
+
+def _reduce_pixels(values, counts):
+    """min, mean, max and count of valid (not nan) pixel values for cells with pixels in consecutive order."""
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid.astype(int), starts)
+    total = np.add.reduceat(np.where(valid, values, 0.), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return np.fmin.reduceat(values, starts), mean, np.fmax.reduceat(values, starts), count
+
+
+def zonal_statistics(raster, index, band=1, processes=1):
+    """Compute the minimum, mean, maximum and count of raster values within each cell in a CellPixelIndex.
+    Cells are processed in groups by raster tile, and the raster is read through a shared RasterReader
+    (see open_raster), so that each block is only read once.
+
+    Parameters
+    ----------
+    raster : str
+        Raster file (any format supported by GDAL).
+    index : CellPixelIndex
+        Pixels in each cell.
+    band : int
+        Raster band to sample.
+    processes : int, optional
+        Number of processes for computing the statistics in parallel (by tile); with processes > 1,
+        scripts need to be protected by "if __name__ == '__main__':" on Windows. None uses all available CPUs.
+
+    Returns
+    -------
+    zstats : DataFrame
+        min, mean, max and count columns, indexed by node. Cells without any valid pixels
+        have nan values and a count of 0.
+    """
+    tasks, task_cells = [], []
+    for cells, pixels, window in index.chunks():
+        tasks.append((raster, band, index.rows[pixels], index.cols[pixels], index.counts[cells]))
+        task_cells.append(cells)
+
+    if processes == 1 or len(tasks) < 2:
+        results = [_zonal_chunk(t) for t in tasks]
+    else:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        try:
+            results = pool.map(_zonal_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    ncells = len(index.nodes)
+    zstats = pd.DataFrame({'min': np.nan, 'mean': np.nan, 'max': np.nan, 'count': 0},
+                          index=index.nodes, columns=['min', 'mean', 'max', 'count'])
+    if len(results) > 0:
+        cells = np.concatenate(task_cells)
+        for i, c in enumerate(['min', 'mean', 'max', 'count']):
+            values = np.zeros(ncells) if c == 'count' else np.nan * np.ones(ncells)
+            values[cells] = np.concatenate([r[i] for r in results])
+            zstats[c] = values.astype(int) if c == 'count' else values
+    zstats.index.name = 'node'
+    return zstats
+
+
+def _line_vertices(geoms):
+    """x, y coordinates of the vertices of a sequence of LineStrings, and the index of the line for each vertex."""
+    try:
+        import shapely
+        coords, line = shapely.get_coordinates(np.asarray(geoms, dtype=object), return_index=True)
+    except (ImportError, AttributeError):
+        line_coords = [np.array(g.coords)[:, :2].reshape(-1, 2) for g in geoms]
+        line = np.repeat(np.arange(len(geoms)), [len(c) for c in line_coords])
+        coords = np.vstack(line_coords) if len(line_coords) > 0 else np.zeros((0, 2))
+    return coords[:, 0], coords[:, 1], line
+
+
+def line_points(geoms, spacing=None):
+    """Points along a sequence of LineStrings, computed for all of the lines at once.
+
+    Parameters
+    ----------
+    geoms : sequence of LineStrings
+    spacing : float, optional
+        Distance between points along each line (starting at the beginning of the line, and including its end).
+        By default, the line vertices are used.
+
+    Returns
+    -------
+    x, y : 1-D arrays
+        Point coordinates, line after line.
+    distance : 1-D array
+        Distance of each point from the start of its line.
+    line : 1-D array
+        Index of the line for each point.
+    """
+    x, y, line = _line_vertices(geoms)
+    new_line = np.ones(len(x), dtype=bool)
+    new_line[1:] = line[1:] != line[:-1]
+    step = np.zeros(len(x))
+    step[1:] = np.hypot(np.diff(x), np.diff(y))
+    step[new_line] = 0.
+    cumulative = np.cumsum(step)
+    starts = np.where(new_line)[0]
+    distance = cumulative - np.repeat(cumulative[starts], np.diff(np.append(starts, len(x))))
+    if spacing is None:
+        return x, y, distance, line
+
+    # interpolate the points along the vertices of all of the lines;
+    # lines are separated by a gap of 1 distance unit, so that their ends don't coincide
+    along = cumulative + np.cumsum(new_line)
+    ends = np.append(starts[1:], len(x)) - 1
+    lengths = np.zeros(len(geoms))
+    lengths[line[ends]] = distance[ends]
+    npoints = np.ceil(lengths / spacing).astype(int) + 1
+    pt_line = np.repeat(np.arange(len(geoms)), npoints)
+    pt_first = np.cumsum(npoints) - npoints
+    pt_distance = np.minimum((np.arange(len(pt_line)) - pt_first[pt_line]) * float(spacing), lengths[pt_line])
+    line_start = np.zeros(len(geoms))
+    line_start[line[starts]] = along[starts]
+    pt_along = line_start[pt_line] + pt_distance
+    has_vertices = np.zeros(len(geoms), dtype=bool)
+    has_vertices[line] = True
+    keep = has_vertices[pt_line]
+    pt_along, pt_distance, pt_line = pt_along[keep], pt_distance[keep], pt_line[keep]
+    return np.interp(pt_along, along, x), np.interp(pt_along, along, y), pt_distance, pt_line
+
+
+def sample_lines(raster, geoms, spacing=None, percentiles=(), band=1):
+    """Sample a raster along a sequence of LineStrings (e.g. a DEM along SFR reach linework),
+    and summarize the values for each line. The raster is read through a shared RasterReader (see open_raster).
+
+    Parameters
+    ----------
+    raster : str
+        Raster file (any format supported by GDAL).
+    geoms : sequence of LineStrings
+    spacing : float, optional
+        Distance between sample points along each line (see line_points). By default, the line vertices are sampled.
+    percentiles : sequence of floats, optional
+        Percentiles (0-100) of the sampled values to compute for each line.
+    band : int
+        Raster band to sample.
+
+    Returns
+    -------
+    stats : DataFrame
+        min, mean, max, count and pct<q> (for each percentile) of the valid (not nodata) raster values
+        along each line, and slope (decrease in raster value per unit distance along the line,
+        from a least-squares fit of the sampled values).
+    """
+    x, y, distance, line = line_points(geoms, spacing=spacing)
+    values = open_raster(raster, band).sample(x, y)
+    valid = ~np.isnan(values)
+    line, distance, values = line[valid], distance[valid], values[valid]
+    nlines = len(geoms)
+
+    count = np.bincount(line, minlength=nlines)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(line, weights=values, minlength=nlines) / count
+        dmean = np.bincount(line, weights=distance, minlength=nlines) / count
+        dd = distance - dmean[line]
+        sxy = np.bincount(line, weights=dd * (values - mean[line]), minlength=nlines)
+        sxx = np.bincount(line, weights=dd ** 2, minlength=nlines)
+        slope = -sxy / sxx
+    minimum, maximum = np.nan * np.ones(nlines), np.nan * np.ones(nlines)
+    np.fmin.at(minimum, line, values)
+    np.fmax.at(maximum, line, values)
+    stats = pd.DataFrame({'min': minimum, 'mean': mean, 'max': maximum, 'count': count},
+                         columns=['min', 'mean', 'max', 'count'])
+
+    # percentiles (linear interpolation, as in np.percentile) from the sorted values for each line
+    sorted_values = values[np.lexsort((values, line))]
+    first = np.cumsum(count) - count
+    has_values = count > 0
+    for q in percentiles:
+        position = first + (count - 1) * q / 100.
+        lower = np.clip(np.floor(position).astype(int), 0, max(len(values) - 1, 0))
+        upper = np.clip(np.ceil(position).astype(int), 0, max(len(values) - 1, 0))
+        pct = np.nan * np.ones(nlines)
+        pct[has_values] = sorted_values[lower[has_values]] + (position - lower)[has_values] * \
+                          (sorted_values[upper[has_values]] - sorted_values[lower[has_values]])
+        stats['pct{:g}'.format(q)] = pct
+    stats['slope'] = slope
+    return stats
@@ -0,0 +1,40 @@
+"""Synthetic SFR networks for testing the postproc routines.
+"""
+import numpy as np
+import pandas as pd
+
+
+def random_network(nseg=100, seed=0, nreach_max=6, nnodes=2000):
+    """Random SFR network (Mat1 and Mat2 tables) with segments numbered in the downstream direction.
+    About 10% of the segments are outlets (outseg 0 or 999999)."""
+    rng = np.random.default_rng(seed)
+    outseg = np.zeros(nseg, dtype=int)
+    for i in range(nseg - 1):
+        if rng.random() < 0.9:
+            outseg[i] = rng.integers(i + 2, nseg + 1)
+        else:
+            outseg[i] = rng.choice([0, 999999])
+    segments = np.arange(1, nseg + 1)
+    m2 = pd.DataFrame({'segment': segments, 'outseg': outseg, 'icalc': 1})
+    m2.index = m2.segment.values
+
+    nreaches = rng.integers(1, nreach_max + 1, nseg)
+    n = nreaches.sum()
+    m1 = pd.DataFrame({'segment': np.repeat(segments, nreaches),
+                       'reach': np.concatenate([np.arange(1, r + 1) for r in nreaches]),
+                       'node': rng.integers(1, nnodes, n),
+                       'length': rng.uniform(10, 500, n),
+                       'sbtop': rng.uniform(0, 100, n),
+                       'width': 5., 'sbK': 1., 'sbthick': 1.,
+                       'row': 1, 'column': 1, 'layer': 1})
+    return m1, m2
+
+
+def reach_connections(topology):
+    """Upstream and downstream reach positions for each routing connection, by looping over the segments."""
+    connections = []
+    for s in range(topology.nseg):
+        connections += [(k, k + 1) for k in range(topology.reach_start[s], topology.reach_stop[s] - 1)]
+        if topology.parent[s] >= 0:
+            connections.append((topology.reach_stop[s] - 1, topology.reach_start[topology.parent[s]]))
+    return connections
@@ -0,0 +1,157 @@
+"""Tests for the vectorized preproc routines, against the original (looping) algorithms
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, LineString, box
+from shapely import affinity
+import preproc
+
+
+def grid_cells(nrow, ncol, spacing=10.):
+    """Cell polygons for a structured grid, in node order."""
+    return [box(c * spacing, (nrow - r - 1) * spacing, (c + 1) * spacing, (nrow - r) * spacing)
+            for r in range(nrow) for c in range(ncol)]
+
+
+def brute_force_intersections(grid_geoms, line_geoms):
+    return [sorted([i for i, c in enumerate(grid_geoms) if c.intersects(l)]) for l in line_geoms]
+
+
+def random_lines(n, extent, nvertices=5, seed=0):
+    rng = np.random.default_rng(seed)
+    return [LineString(rng.uniform(0, extent, (nvertices, 2))) for i in range(n)]
+
+
+def test_update_mat1():
+    nrow, ncol = 20, 20
+    previous_grid = grid_cells(nrow, ncol)
+    lines = random_lines(8, 200, seed=1) + [LineString([(1, 195), (199, 195)])]
+    segments = list(range(1, len(lines) + 1))
+    comids = [100 + s for s in segments]
+    previous_m1 = preproc.make_mat1(lines, segments, comids,
+                                    preproc.intersect_grid(previous_grid, lines), previous_grid, tol=.001)
+
+    # change a block of cells, and drop one flowline from the active area
+    grid = list(previous_grid)
+    for i in [42, 43, 62, 63]:
+        minx, miny, maxx, maxy = grid[i].bounds
+        grid[i] = box(minx, miny, maxx, maxy - 2.)
+    lines[0] = LineString(list(lines[0].coords)[:3])
+
+    m1 = preproc.update_mat1(previous_m1, pd.DataFrame({'geometry': previous_grid}), grid,
+                             lines, segments, comids, tol=.001)
+    # full rebuild (as in NHDdata.to_sfr)
+    rebuilt = preproc.make_mat1(lines, segments, comids,
+                                preproc.intersect_grid(grid, lines), grid, tol=.001)
+    cols = ['segment', 'reach', 'node', 'comid']
+    assert np.array_equal(m1[cols].values, rebuilt[cols].values)
+    assert np.allclose([g.length for g in m1.geometry], [g.length for g in rebuilt.geometry])
+
+
+def test_get_nearest_points():
+    rng = np.random.default_rng(2)
+    points = rng.uniform(0, 1000, (500, 2))
+    query_points = rng.uniform(0, 1000, (200, 2))
+    nearest, distances = preproc.get_nearest_points(points, query_points)
+    for i, p in enumerate(query_points):
+        d = np.sqrt(np.sum((points - p)**2, axis=1))
+        assert nearest[i] == np.argmin(d)
+        assert np.isclose(distances[i], d.min())
+
+
+def test_trim_line_ends():
+    rng = np.random.default_rng(3)
+    trim_buffer = 20
+    lines, new_ends = [], []
+    for i in range(50):
+        # lines moving away from their starts, so that they only cross the end buffer once
+        x = np.cumsum(rng.uniform(1, 15, rng.integers(2, 12)))
+        lines.append(LineString(np.column_stack([x, rng.uniform(-2, 2, len(x))])))
+        new_ends.append(np.array(lines[-1].coords[-1]) + rng.uniform(5, 10, 2))
+    coords, offsets = preproc.get_line_coordinates(lines)
+    trimmed = preproc.trim_line_ends(coords, offsets, np.array(new_ends), trim_buffer=trim_buffer)
+
+    for line, new_end, new in zip(lines, new_ends, trimmed):
+        # original algorithm: difference with a buffer around the line end, then connect to the new end
+        diff = line.difference(Point(line.coords[-1]).buffer(trim_buffer))
+        if diff.length > 0:
+            old = LineString(list(diff.coords) + [tuple(new_end)])
+        else:
+            old = LineString([line.coords[0], tuple(new_end)])
+        # the new algorithm drops the vertices within the buffer, instead of cutting the line at the buffer
+        new_coords = np.array(new.coords)
+        old_coords = np.array(old.coords)
+        assert np.allclose(new_coords[-1], new_end)
+        assert np.allclose(new_coords[:-1], old_coords[:len(new_coords) - 1])
+        assert np.all(np.sqrt(np.sum((new_coords[1:-1] - line.coords[-1])**2, axis=1)) > trim_buffer)
+
+
+def line_parts(geom):
+    """Parts of a (Multi)LineString, in order."""
+    return list(geom.geoms) if geom.geom_type == 'MultiLineString' else [geom]
+
+
+def test_clip_lines_to_domain():
+    domain = Point(0, 0).buffer(100, 400)  # many vertices, so that the domain is tiled
+    lines = random_lines(400, 300, seed=4)
+    lines = [affinity.translate(l, -150, -150) for l in lines]
+    # lines that leave and re-enter the domain several times
+    x = np.linspace(-150, 150, 31)
+    lines += [LineString(np.column_stack([x, 100 + 15 * (-1)**np.arange(len(x))])),
+              LineString(np.column_stack([x, -100 + 15 * (-1)**np.arange(len(x))])[::-1])]
+    lines += [LineString([(0, 0), (10, 10)]), LineString([(300, 300), (400, 400)])]
+    for tile_vertices in [100, 100000]:
+        inside, clipped = preproc.clip_lines_to_domain(lines, domain, tile_vertices=tile_vertices)
+        assert np.array_equal(inside, [domain.intersects(l) for l in lines])
+        kept = [l for l, i in zip(lines, inside) if i]
+        expected = [l.intersection(domain) for l in kept]
+        assert len(clipped) == len(expected)
+        for l, c, e in zip(kept, clipped, expected):
+            assert np.isclose(c.length, e.length)
+            assert c.hausdorff_distance(e) < 1e-6
+            if domain.contains(l):
+                assert c.equals(l)
+                continue
+            # same parts as the intersection, in the same order and direction
+            c_parts, e_parts = line_parts(c), line_parts(e)
+            assert len(c_parts) == len(e_parts)
+            for cp, ep in zip(c_parts, e_parts):
+                assert np.allclose(cp.coords[0], ep.coords[0])
+                assert np.allclose(cp.coords[-1], ep.coords[-1])
+                assert np.isclose(cp.length, ep.length)
+
+    # no lines crossing the domain boundary
+    inside, clipped = preproc.clip_lines_to_domain(lines[-2:], domain, tile_vertices=100)
+    assert inside.tolist() == [True, False]
+    assert clipped[0].equals(lines[-2])
+
+
+def test_intersect_grid():
+    nrow, ncol = 40, 50
+    grid = grid_cells(nrow, ncol)
+    lines = random_lines(6, 400, seed=0) + [LineString([(55, 55), (56, 56)]),
+                                            LineString([(-10, -10), (5, 5)])]
+    expected = brute_force_intersections(grid, lines)
+    for kwargs in [dict(nrow=nrow, ncol=ncol), {}]:
+        candidates = preproc.get_candidate_cells(grid, lines, **kwargs)
+        for e in expected:
+            assert set(e).issubset(set(candidates))
+        intersections = preproc.intersect_grid(grid, lines, **kwargs)
+        assert [sorted(i) for i in intersections] == expected
+
+    # rotated grid
+    grid = [affinity.rotate(c, 30, origin=(0, 0)) for c in grid]
+    lines = [affinity.rotate(l, 30, origin=(0, 0)) for l in lines]
+    intersections = preproc.intersect_grid(grid, lines, nrow=nrow, ncol=ncol)
+    assert [sorted(i) for i in intersections] == brute_force_intersections(grid, lines)
+
+
+if __name__ == '__main__':
+    test_update_mat1()
+    test_get_nearest_points()
+    test_trim_line_ends()
+    test_clip_lines_to_domain()
+    test_intersect_grid()
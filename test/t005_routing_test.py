@@ -0,0 +1,179 @@
+"""Tests for the SFR routing topology, and the routines that propagate elevations along it,
+against the original (looping) algorithms
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import numpy as np
+import postproc
+from networks import random_network
+
+
+def all_upsegs(segment, outsegs):
+    """All segments upstream of segment, by walking up the routing (stopping at routing circles)."""
+    upsegs = []
+    current = [segment]
+    while len(current) > 0:
+        current = [s for s, o in outsegs.items() if o in current and s not in upsegs and s != segment]
+        upsegs += current
+    return upsegs
+
+
+def test_topology():
+    m1, m2 = random_network(300, seed=5)
+    # add a routing circle, with a segment routed into it
+    m2.loc[150, 'outseg'] = 300
+    m2.loc[300, 'outseg'] = 150
+    m2.loc[149, 'outseg'] = 150
+    t = postproc.Topology(m2.segment.values, m2.outseg.values)
+    outsegs = dict(zip(m2.segment, m2.outseg))
+
+    circle = set([150, 300])
+    # segments in, or routed to, the circle
+    circular = circle.union(all_upsegs(150, outsegs))
+    # every segment (outside of the circle) comes in a later level than its upsegs
+    level = {}
+    for k, segments in enumerate(t.levels):
+        for i in segments:
+            level[t.segments[i]] = k
+    assert set(level.keys()) == set(m2.segment) - circle
+    for s, o in outsegs.items():
+        if o in level:
+            assert level[s] < level[o]
+
+    # outlets
+    for i, s in enumerate(t.segments):
+        if s in circular:
+            assert t.outlets[i] == 0
+            continue
+        current = s
+        while outsegs[current] not in (0, 999999):
+            current = outsegs[current]
+        assert t.outlets[i] == current
+
+    # accumulate
+    values = np.random.default_rng(0).uniform(0, 10, len(m2))
+    total = t.accumulate(values)
+    lowest = t.accumulate(values, np.minimum)
+    value = dict(zip(m2.segment, values))
+    for i, s in enumerate(t.segments):
+        if s in circular:
+            continue
+        upstream = [value[u] for u in all_upsegs(s, outsegs)] + [value[s]]
+        assert np.isclose(total[i], np.sum(upstream))
+        assert lowest[i] == np.min(upstream)
+
+
+def reset_segment_ends_reference(m1, m2):
+    """Original algorithm for SFRdata.reset_segment_ends_from_dem."""
+    nseg = m2.segment.values
+    outseg = m2.outseg.values
+    elevmin = m2.Min.values.copy()
+    elevmax = m2.Max.values.copy()
+    dem_min = np.array([m1.loc[m1.segment == s, 'DEMmin'].min() for s in nseg])
+    dem_reach1 = np.array([m1.loc[(m1.segment.values == s) & (m1.reach.values == 1), 'DEMmin'].values[0]
+                           for s in nseg])
+
+    def get_nextupsegs(upsegs):
+        nextupsegs = []
+        for s in upsegs:
+            nextupsegs += nseg[outseg == s].tolist()
+        return nextupsegs
+
+    def get_upsegs(seg):
+        upsegs = nseg[outseg == seg].tolist()
+        all_upsegs = upsegs
+        for i in range(len(nseg)):
+            upsegs = get_nextupsegs(upsegs)
+            if len(upsegs) > 0:
+                all_upsegs.extend(upsegs)
+            else:
+                break
+        return all_upsegs
+
+    def get_upseg_levels(seg):
+        upsegs = nseg[outseg == seg].tolist()
+        all_upsegs = [upsegs]
+        for i in range(len(nseg)):
+            upsegs = get_nextupsegs(upsegs)
+            if len(upsegs) > 0:
+                all_upsegs.append(upsegs)
+            else:
+                break
+        return all_upsegs
+
+    def reset_elevations(seg):
+        oseg = outseg[seg - 1]
+        all_upsegs = np.array(get_upsegs(seg) + [seg])
+        oldmin = elevmin[(all_upsegs - 1)].min()
+        smin = dem_min[(all_upsegs - 1)].min()
+        if oseg > 0:
+            outseg_max = elevmax[oseg - 1]
+            smin = np.min([outseg_max, smin])
+        if smin < oldmin:
+            elevmin[seg - 1] = smin
+        if oseg > 0:
+            elevmax[outseg[seg - 1] - 1] = np.min([smin, oldmin, outseg_max])
+        if len(all_upsegs) == 1:
+            elevmax[seg - 1] = np.min([elevmax[seg - 1], dem_reach1[seg - 1]])
+
+    for level in get_upseg_levels(0):
+        [reset_elevations(s) for s in level]
+    return elevmax, elevmin
+
+
+def segment_elevations(m1, m2, seed):
+    rng = np.random.default_rng(seed)
+    m2['Max'] = np.round(rng.uniform(20, 120, len(m2)))
+    m2['Min'] = np.round(rng.uniform(0, 80, len(m2)))
+    if seed % 4 == 0:
+        m2.loc[m2.index[rng.random(len(m2)) < 0.03], 'Min'] = np.nan
+    return m1, m2
+
+
+def test_reset_segment_ends_from_dem(tmpdir):
+    tmpdir.chdir()
+    for seed in range(200):
+        m1, m2 = segment_elevations(*random_network(30, seed=seed), seed=seed)
+        rng = np.random.default_rng(seed)
+        m1['DEMmin'] = np.round(rng.uniform(0, 100, len(m1)))
+        if seed % 3 == 0:
+            m1.loc[rng.random(len(m1)) < 0.05, 'DEMmin'] = np.nan
+        elevmax, elevmin = reset_segment_ends_reference(m1, m2)
+
+        sfr = postproc.SFRdata(Mat1=m1.copy(), Mat2=m2.copy())
+        sfr.reset_segment_ends_from_dem()
+        assert np.array_equal(sfr.m2.Max.values, elevmax, equal_nan=True), seed
+        assert np.array_equal(sfr.m2.Min.values, elevmin, equal_nan=True), seed
+
+
+def map_confluences_reference(m2):
+    """Original algorithm for Elevations.map_confluences, iterated until the elevations stop changing."""
+    m2 = m2.copy()
+    confluences = m2[[len(u) > 0 for u in m2.upsegs]]
+    upsegs = confluences.upsegs.tolist()
+    while True:
+        previous = m2[['Max', 'Min']].copy()
+        elevs = m2.loc[confluences.segment.values, 'Max'].tolist()
+        elevs = [np.min([m2.Min[m2.segment.isin(u)].min(), elevs[i]]) for i, u in enumerate(upsegs)]
+        m2.loc[confluences.segment.values, 'Max'] = elevs
+        rises = (m2.Max - m2.Min) < 0
+        m2.loc[rises, 'Min'] = m2.loc[rises, 'Max']
+        if previous.equals(m2[['Max', 'Min']]):
+            return m2
+
+
+def test_map_confluences(tmpdir):
+    tmpdir.chdir()
+    for seed in range(200):
+        m1, m2 = segment_elevations(*random_network(30, seed=seed), seed=seed)
+        e = postproc.Elevations(Mat1=m1, Mat2=m2)
+        expected = map_confluences_reference(e.m2)
+        e.map_confluences()
+        assert np.array_equal(e.m2.Max.values, expected.Max.values, equal_nan=True), seed
+        assert np.array_equal(e.m2.Min.values, expected.Min.values, equal_nan=True), seed
+
+
+if __name__ == '__main__':
+    test_topology()
@@ -0,0 +1,201 @@
+"""Tests for the streambed elevation smoothing and fits, layer assignment and external array output in postproc
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import numpy as np
+import pandas as pd
+import pytest
+import postproc
+from networks import random_network, reach_connections
+
+
+def routing_matrix(topology, nreach):
+    """Dense matrix with a row for each connection (upstream reach - downstream reach >= 0)."""
+    connections = reach_connections(topology)
+    A = np.zeros((len(connections), nreach))
+    for i, (up, down) in enumerate(connections):
+        A[i, up] = 1
+        A[i, down] = -1
+    return A
+
+
+def smooth_segment_interiors_reference(m1, m2, tol=1e-5):
+    """Original (segment by segment) algorithm for Elevations.smooth_segment_interiors."""
+    sbtop = m1.sbtop.values.copy()
+    for seg in m2.segment:
+        in_segment = (m1.segment == seg).values
+        df = m1[in_segment]
+        segelevs = df.landsurface.values.copy()
+        start, end = m2.loc[seg, ['Max', 'Min']]
+        if start == end:
+            sbtop[in_segment] = start
+            continue
+        sm = [start]
+        segelevs[-1] = end
+        lengths = df.length.values
+        cdist = np.cumsum(lengths) - 0.5 * lengths
+        minelev = start
+
+        def interpolate(istart, istop, minelev):
+            dx = cdist[istart] - cdist[istop]
+            dS = minelev - segelevs[istop]
+            slope = 0 if dS == 0 else dS / dx
+            dist = 0
+            for i in np.arange(istart + 1, istop + 1):
+                dist += cdist[i - 1] - cdist[i]
+                sm.append(minelev - dist * slope)
+            return sm[-1]
+
+        minloc = 0
+        nreaches = len(segelevs)
+        for i in range(nreaches)[1:]:
+            if segelevs[i] < minelev or abs(segelevs[i] - minelev) < tol:
+                if minelev > segelevs[i] > end or abs(segelevs[i] - end) < tol:
+                    minelev = interpolate(minloc, i, minelev)
+                    minloc = i
+                elif segelevs[i] < end:
+                    minelev = interpolate(minloc, nreaches - 1, minelev)
+                    break
+        sbtop[in_segment] = sm
+    return sbtop
+
+
+def test_smooth_segment_interiors(tmpdir):
+    tmpdir.chdir()
+    for seed in range(60):
+        m1, m2 = random_network(100, seed=seed, nreach_max=15)
+        rng = np.random.default_rng(seed)
+        m1['landsurface'] = np.round(rng.uniform(0, 100, len(m1)))
+        m2['Max'] = np.round(rng.uniform(40, 100, len(m2)))
+        m2['Min'] = m2.Max - np.round(rng.uniform(0, 40, len(m2)))
+        m2.loc[m2.index[rng.random(len(m2)) < 0.05], 'Min'] = m2.Max
+        expected = smooth_segment_interiors_reference(m1, m2)
+
+        e = postproc.Elevations(Mat1=m1, Mat2=m2)
+        e.smooth_segment_interiors(report_file='report.csv' if seed == 0 else None)
+        assert np.allclose(e.m1.sbtop.values, expected, rtol=0, atol=1e-9), seed
+        if seed == 0:
+            # one report row per reach
+            report = pd.read_csv('report.csv')
+            assert report[['segment', 'reach']].values.tolist() == e.m1[['segment', 'reach']].values.tolist()
+            assert np.allclose(report.sb_elev.values, expected)
+
+
+def test_reach_connections():
+    m1, m2 = random_network(200, seed=3, nreach_max=5)
+    e = postproc.Elevations(Mat1=m1, Mat2=m2)
+    upstream, downstream = e.topology.reach_connections()
+    assert sorted(zip(upstream.tolist(), downstream.tolist())) == sorted(reach_connections(e.topology))
+
+
+def test_smooth_isotonic(tmpdir):
+    minimize = pytest.importorskip('scipy.optimize').minimize
+    tmpdir.chdir()
+    for seed in range(8):
+        m1, m2 = random_network(12, seed=seed, nreach_max=3)
+        rng = np.random.default_rng(seed)
+        m1['landsurface'] = rng.uniform(0, 100, len(m1))
+        m1['weight'] = rng.uniform(0.5, 3, len(m1))
+        e = postproc.Elevations(Mat1=m1, Mat2=m2)
+        e.smooth_isotonic(weight_column='weight')
+        fit = e.m1.sbtop.values
+        y, w = e.m1.landsurface.values, e.m1.weight.values
+
+        # feasibility: elevations never increase downstream
+        A = routing_matrix(e.topology, len(y))
+        assert np.all(A.dot(fit) >= -1e-9)
+
+        # optimality: compare with a general-purpose solver for the same quadratic program
+        result = minimize(lambda x: np.sum(w * (x - y)**2), y.copy(), jac=lambda x: 2 * w * (x - y),
+                          constraints=[{'type': 'ineq', 'fun': lambda x: A.dot(x), 'jac': lambda x: A}],
+                          method='SLSQP', options={'ftol': 1e-12, 'maxiter': 1000})
+        assert np.sum(w * (fit - y)**2) <= result.fun * (1 + 1e-6) + 1e-9
+        assert np.allclose(fit, result.x, atol=1e-3)
+
+
+def test_optimize_streambed(tmpdir):
+    pytest.importorskip('scipy')
+    tmpdir.chdir()
+    m1, m2 = random_network(60, seed=3, nreach_max=6)
+    rng = np.random.default_rng(0)
+    e = postproc.Elevations(Mat1=m1, Mat2=m2)
+    # routed model top, so that a solution without floating reaches exists
+    m1['landsurface'] = rng.uniform(50, 100, len(m1))
+    e.m1['landsurface'] = m1.landsurface.values
+    e.smooth_isotonic()
+    e.m1['model_top'] = e.m1.sbtop.values
+    e.m1['sbtop'] = e.m1.model_top.values - rng.uniform(-5, 10, len(m1))
+    max_float, max_incise = 1., 8.
+
+    e.optimize_streambed(max_float=max_float, max_incise=max_incise, minimum_slope=1e-4)
+    sbtop = e.m1.sbtop.values
+    upstream, downstream = e.topology.reach_connections()
+    lengths = e.m1.length.values
+    min_drop = 1e-4 * 0.5 * (lengths[upstream] + lengths[downstream])
+    assert np.all(sbtop[upstream] - sbtop[downstream] >= min_drop - 1e-7)
+    assert np.all(sbtop - e.m1.model_top.values <= max_float + 1e-7)
+    assert np.allclose(e.m2.Max.values, e.m1.groupby('segment').sbtop.max().values)
+    assert np.allclose(e.m2.Min.values, e.m1.groupby('segment').sbtop.min().values)
+
+
+def test_assign_layers():
+    rng = np.random.default_rng(0)
+    nlay, nrow, ncol = 5, 40, 50
+    top = rng.uniform(90, 110, (nrow, ncol))
+    elevs = np.concatenate([top[np.newaxis],
+                            top[np.newaxis] - np.cumsum(rng.uniform(2, 20, (nlay, nrow, ncol)), axis=0)])
+    m1, m2 = random_network(500, seed=1, nnodes=nrow * ncol)
+    m1['sbtop'] = rng.uniform(-20, 110, len(m1))
+    sfr = postproc.SFRdata(Mat1=m1, Mat2=m2)
+    sfr.elevs = elevs.copy()
+    buffer = 0.5
+    summary = sfr.assign_layers(buffer=buffer, lower_bottom=True)
+
+    # original algorithm: first layer with a bottom at or below the streambed bottom
+    botm = elevs[1:].reshape(nlay, -1)
+    sbbot = (sfr.m1.sbtop - sfr.m1.sbthick).values - buffer
+    for i, n in enumerate(sfr.m1.node.values):
+        layer = nlay
+        for k in range(nlay):
+            if sbbot[i] >= botm[k, n - 1]:
+                layer = k + 1
+                break
+        assert sfr.m1.layer.values[i] == layer
+    below = sbbot < botm[-1, sfr.m1.node.values - 1]
+    assert len(sfr.below_bottom) == below.sum()
+    assert summary.nreaches.tolist() == np.bincount(sfr.m1.layer.values, minlength=nlay + 1)[1:].tolist()
+    assert summary.below_bottom.sum() == below.sum()
+
+    # model bottom lowered to the lowest streambed bottom in each cell
+    lowest = pd.Series(sbbot).groupby(sfr.m1.node.values).min()
+    new_bottom = sfr.elevs[-1].ravel()
+    assert np.allclose(new_bottom[lowest.index - 1], np.minimum(botm[-1, lowest.index - 1], lowest.values))
+    assert np.array_equal(sfr.elevs[:-1], elevs[:-1])
+
+
+def test_write_external_array(tmpdir):
+    array = np.random.default_rng(0).uniform(0, 100, (30, 40))
+    binfile = str(tmpdir.join('botm2.bin'))
+    record = postproc.write_external_array(binfile, array, binary=True, text='botm', ilay=3)
+    assert record == 'OPEN/CLOSE {} 1.0 (BINARY) -1'.format(binfile)
+
+    header_dtype = np.dtype([('kstp', '<i4'), ('kper', '<i4'), ('pertim', '<f4'), ('totim', '<f4'),
+                             ('text', 'S16'), ('ncol', '<i4'), ('nrow', '<i4'), ('ilay', '<i4')])
+    with open(binfile, 'rb') as src:
+        header = np.fromfile(src, dtype=header_dtype, count=1)[0]
+        data = np.fromfile(src, dtype='<f4')
+    assert header_dtype.itemsize == 44
+    assert (header['kstp'], header['kper'], header['ncol'], header['nrow'], header['ilay']) == (1, 1, 40, 30, 3)
+    assert header['text'].strip() == b'botm'
+    assert np.allclose(data.reshape(30, 40), array, rtol=1e-6)
+
+    txtfile = str(tmpdir.join('top.dat'))
+    record = postproc.write_external_array(txtfile, array)
+    assert record == 'OPEN/CLOSE {} 1.0 (FREE) -1'.format(txtfile)
+    assert np.allclose(np.loadtxt(txtfile), array, atol=0.005)
+
+
+if __name__ == '__main__':
+    test_smooth_segment_interiors()
@@ -0,0 +1,120 @@
+"""Tests for zonal statistics and line sampling in rasterops, on a small synthetic raster
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+from shapely.geometry import Point, LineString, box
+from shapely import affinity
+
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin
+import rasterops
+
+nodata = -9999.
+height, width = 60, 80
+xul, yul, spacing = 1000., 9000., 10.
+
+
+@pytest.fixture
+def dem(tmpdir):
+    """60 x 80 pixel raster with random values and a few nodata pixels."""
+    rng = np.random.default_rng(0)
+    array = rng.uniform(0, 100, (height, width)).astype('float32')
+    array[rng.random((height, width)) < 0.02] = nodata
+    path = str(tmpdir.join('dem.tif'))
+    with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=1, dtype='float32',
+                       transform=from_origin(xul, yul, spacing, spacing), nodata=nodata,
+                       tiled=True, blockxsize=16, blockysize=16) as dest:
+        dest.write(array, 1)
+    return path, np.where(array == nodata, np.nan, array).astype(float)
+
+
+def pixel_values(array, x, y):
+    """Raster values at points, from the row and column arithmetic."""
+    rows = np.floor((yul - np.asarray(y)) / spacing).astype(int)
+    cols = np.floor((np.asarray(x) - xul) / spacing).astype(int)
+    values = np.nan * np.ones(len(rows))
+    on_raster = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    values[on_raster] = array[rows[on_raster], cols[on_raster]]
+    return values
+
+
+def test_zonal_statistics(dem):
+    path, array = dem
+    # rotated grid of model cells, and a cell partly off of the raster
+    cells = [box(xul + 100 + 30 * j, yul - 100 - 40 * (i + 1), xul + 100 + 30 * (j + 1), yul - 100 - 40 * i)
+             for i in range(5) for j in range(8)]
+    cells = [affinity.rotate(c, 20, origin=(xul + 220, yul - 200)) for c in cells]
+    cells.append(box(xul + width * spacing - 25, yul - height * spacing - 25,
+                     xul + width * spacing + 25, yul - height * spacing + 25))
+    nodes = np.arange(1, len(cells) + 1) * 7
+
+    index = rasterops.CellPixelIndex(cells, path, nodes=nodes, tile_size=16)
+    zstats = rasterops.zonal_statistics(path, index)
+    assert zstats.index.tolist() == nodes.tolist()
+
+    # pixels with centers inside of each cell
+    rows, cols = np.mgrid[0:height, 0:width]
+    x, y = xul + (cols.ravel() + 0.5) * spacing, yul - (rows.ravel() + 0.5) * spacing
+    for i, cell in enumerate(cells):
+        inside = np.array([cell.contains(Point(xy)) for xy in zip(x, y)])
+        values = array.ravel()[inside]
+        values = values[~np.isnan(values)]
+        assert zstats['count'].values[i] == len(values)
+        assert np.isclose(zstats['min'].values[i], values.min())
+        assert np.isclose(zstats['mean'].values[i], values.mean())
+        assert np.isclose(zstats['max'].values[i], values.max())
+
+    # the index is reused until the cells or the raster change
+    cached = rasterops.CellPixelIndex(cells, path, nodes=nodes, tile_size=16)
+    assert cached.is_valid()
+    assert np.array_equal(cached.rows, index.rows) and np.array_equal(cached.cols, index.cols)
+    moved = rasterops.CellPixelIndex([affinity.translate(c, 10) for c in cells], path, nodes=nodes)
+    assert moved.basename != index.basename
+
+
+def test_sample_lines(dem):
+    path, array = dem
+    rng = np.random.default_rng(1)
+    lines = []
+    for i in range(40):
+        vertices = rng.uniform(0, 40, (rng.integers(2, 7), 2)).cumsum(axis=0)
+        lines.append(LineString(vertices + [xul + 20, yul - 500]))
+    lines.append(LineString([(xul - 500, yul + 500), (xul - 400, yul + 400)]))  # off of the raster
+
+    percentiles = [10, 50, 90]
+    for spacing in [None, 7.5]:
+        stats = rasterops.sample_lines(path, lines, spacing=spacing, percentiles=percentiles)
+        for i, line in enumerate(lines):
+            if spacing is None:
+                points = np.array(line.coords)
+                distance = np.append(0, np.cumsum(np.sqrt(np.sum(np.diff(points, axis=0)**2, axis=1))))
+            else:
+                distance = np.append(np.arange(0, line.length, spacing), line.length)
+                points = np.array([line.interpolate(d).coords[0] for d in distance])
+            values = pixel_values(array, points[:, 0], points[:, 1])
+            valid = ~np.isnan(values)
+            assert stats['count'].values[i] == valid.sum()
+            if valid.sum() == 0:
+                assert np.isnan(stats['min'].values[i]) and np.isnan(stats['slope'].values[i])
+                continue
+            assert np.isclose(stats['min'].values[i], values[valid].min())
+            assert np.isclose(stats['mean'].values[i], values[valid].mean())
+            for q in percentiles:
+                assert np.isclose(stats['pct{}'.format(q)].values[i], np.percentile(values[valid], q))
+            if valid.sum() > 1:
+                # decrease in elevation per unit distance along the line (least-squares fit)
+                assert np.isclose(stats['slope'].values[i], -np.polyfit(distance[valid], values[valid], 1)[0])
+
+
+def test_raster_reader(dem):
+    path, array = dem
+    reader = rasterops.open_raster(path, max_tiles=4)
+    assert rasterops.open_raster(path) is reader
+    rng = np.random.default_rng(2)
+    x = rng.uniform(xul - 50, xul + width * spacing + 50, 1000)
+    y = rng.uniform(yul - height * spacing - 50, yul + 50, 1000)
+    assert np.array_equal(reader.sample(x, y), pixel_values(array, x, y), equal_nan=True)
+    assert len(reader._tiles) <= 4
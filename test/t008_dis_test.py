@@ -0,0 +1,85 @@
+"""Tests for the binary cache of DIS arrays, and the model top and bottom adjustments in postproc
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import numpy as np
+import pytest
+import postproc
+from networks import random_network
+
+nlay, nrow, ncol = 3, 12, 15
+
+
+def cached_model(tmpdir, seed=0, laycbd=None):
+    """SFRdata object for a random network, with the DIS arrays read from a binary cache.
+    The botm array includes the bottoms of any Quasi-3D confining beds (laycbd)."""
+    rng = np.random.default_rng(seed)
+    if laycbd is None:
+        laycbd = np.zeros(nlay, dtype=int)
+    top = rng.uniform(90, 110, (nrow, ncol))
+    botm = top[np.newaxis] - np.cumsum(rng.uniform(2, 20, (nlay + np.sum(laycbd), nrow, ncol)), axis=0)
+    delr, delc = rng.uniform(50, 100, ncol), rng.uniform(50, 100, nrow)
+    mfdis = str(tmpdir.join('model.dis'))
+    with open(mfdis, 'w') as dest:
+        dest.write('# stands in for a DIS file; the arrays are read from the cache\n')
+    postproc.DisArrays.save(postproc.DisArrays(top, botm, np.array(laycbd), delr, delc),
+                            mfdis, str(tmpdir))
+
+    m1, m2 = random_network(80, seed=seed, nnodes=nrow * ncol)
+    m1['row'] = (m1.node.values - 1) // ncol + 1
+    m1['column'] = (m1.node.values - 1) % ncol + 1
+    m1['sbtop'] = np.take(top, m1.node.values - 1) - rng.uniform(-5, 10, len(m1))
+    sfr = postproc.SFRdata(Mat1=m1, Mat2=m2, mfdis=mfdis, dis_cache=True)
+    assert isinstance(sfr.dis, postproc.DisArrays)
+    return sfr, top, botm, delr, delc
+
+
+def test_reset_model_top_2streambed_cached(tmpdir):
+    flopy = pytest.importorskip('flopy')
+    tmpdir.chdir()
+    sfr, top, botm, delr, delc = cached_model(tmpdir)
+    outdisfile = str(tmpdir.join('adjusted.dis'))
+    sfr.reset_model_top_2streambed(minimum_thickness=1, outdisfile=outdisfile)
+
+    m = flopy.modflow.Modflow(model_ws=str(tmpdir))
+    dis = flopy.modflow.ModflowDis.load(outdisfile, m)
+    assert np.allclose(dis.delr.array, delr)
+    assert np.allclose(dis.delc.array, delc)
+    assert np.allclose(dis.top.array, sfr.elevs[0])
+    assert np.allclose(dis.botm.array, sfr.elevs[1:])
+
+
+def test_lowered_bottom_in_output(tmpdir):
+    tmpdir.chdir()
+    laycbd = np.array([1, 0, 0])
+    sfr, top, botm, delr, delc = cached_model(tmpdir, laycbd=laycbd)
+    # streambeds below the model bottom in some cells
+    deep = np.random.default_rng(1).random(len(sfr.m1)) < 0.1
+    sfr.m1.loc[deep, 'sbtop'] = np.take(botm[-1], sfr.m1.node.values[deep] - 1) - 5
+    sfr.assign_layers(buffer=2, lower_bottom=True)
+    lowered = sfr.elevs[-1].copy()
+    assert np.all(lowered <= botm[-1]) and np.any(lowered < botm[-1])
+
+    # the external folder is made if it doesn't exist
+    external_path = os.path.join('external', 'arrays')
+    sfr.reset_model_top_2streambed(minimum_thickness=0.01, external_files='binary', external_path=external_path)
+    assert list(sfr.external_arrays.keys()) == ['top'] + ['botm{}'.format(i) for i in range(len(botm))]
+    arrays = []
+    for name in sfr.external_arrays.keys():
+        with open(os.path.join(external_path, name + '.bin'), 'rb') as src:
+            src.seek(44)
+            arrays.append(np.fromfile(src, dtype='<f4').reshape(nrow, ncol))
+    # the bottom written is at or below the one lowered by assign_layers
+    assert np.all(arrays[-1] <= lowered.astype('f4'))
+    assert np.allclose(arrays[-1], sfr.elevs[-1], rtol=1e-6)
+    # the confining bed bottom (below layer 1) is kept in the botm array, but not in elevs
+    assert np.allclose(arrays[1], sfr.elevs[1], rtol=1e-6)
+    assert np.allclose(arrays[3], sfr.elevs[2], rtol=1e-6)
+    assert np.all(arrays[2] <= botm[1].astype('f4') + 1e-3)
+
+
+if __name__ == '__main__':
+    test_reset_model_top_2streambed_cached()
+    test_lowered_bottom_in_output()
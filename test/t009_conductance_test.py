@@ -0,0 +1,60 @@
+"""Tests for the consolidation of SFR conductance in cells with multiple reaches, against the original algorithm
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import numpy as np
+import postproc
+from networks import random_network
+
+
+def consolidate_conductance_reference(m1, bedKmin=1e-8):
+    """Original algorithm for SFRdata.consolidate_conductance."""
+    m1 = m1.copy()
+    m1['Cond'] = m1.apply(lambda X: X['sbK'] * X['width'] * X['length'] / X['sbthick'], axis=1)
+    m1['Dominant'] = [True] * len(m1)
+    for c in np.unique(m1.loc[m1.node.duplicated(), 'node']):
+        df = m1[m1.node == c].sort_values(by='width', ascending=False)
+        m1.loc[df.index[1:], 'Dominant'] = False
+    Cond_sums = m1[['node', 'Cond']].groupby('node').agg('sum').Cond
+    m1['Cond_sum'] = [Cond_sums[c] for c in m1.node]
+
+    def consolidate_lengths(X):
+        if X['Dominant']:
+            lnew = X['Cond_sum'] * X['sbthick'] / (X['sbK'] * X['width'])
+        else:
+            lnew = 1.0
+        return lnew
+
+    m1['SFRlength'] = m1.apply(consolidate_lengths, axis=1)
+    m1['sbK'] = [r['sbK'] if r['Dominant'] else bedKmin for i, r in m1.iterrows()]
+    return m1
+
+
+def test_consolidate_conductance():
+    for seed in range(5):
+        # many reaches per cell
+        m1, m2 = random_network(200, seed=seed, nnodes=150)
+        rng = np.random.default_rng(seed)
+        m1['width'] = rng.uniform(1, 20, len(m1))
+        m1['sbK'] = rng.uniform(0.1, 2, len(m1))
+        m1['sbthick'] = rng.uniform(0.5, 2, len(m1))
+        sfr = postproc.SFRdata(Mat1=m1, Mat2=m2)
+        expected = consolidate_conductance_reference(sfr.m1, bedKmin=1e-6)
+        sfr.consolidate_conductance(bedKmin=1e-6)
+        assert sfr.m1.Dominant.tolist() == expected.Dominant.tolist()
+        for column in ['Cond', 'Cond_sum', 'SFRlength', 'sbK']:
+            assert np.allclose(sfr.m1[column].values, expected[column].values, rtol=1e-12), column
+
+    # with equal widths, the first reach in Mat1 is dominant
+    m1, m2 = random_network(50, seed=0, nnodes=20)
+    sfr = postproc.SFRdata(Mat1=m1, Mat2=m2)
+    sfr.consolidate_conductance()
+    first = ~sfr.m1.node.duplicated().values
+    assert sfr.m1.Dominant.tolist() == first.tolist()
+    assert np.allclose(sfr.m1.SFRlength.values[first], sfr.m1.groupby('node').length.transform('sum').values[first])
+
+
+if __name__ == '__main__':
+    test_consolidate_conductance()